@@ -0,0 +1,161 @@
+import math
+import time
+from .printlog import timestamp_to_ms, ms_to_timestamp
+
+DEFAULT_BACKFILL_MIN_GAP = 30.0  # seconds
+GAP_INTERVALS = 3  # sampling intervals a gap must also exceed
+STORE_INTERVAL = 1.0  # seconds between Moonraker's temperature_store readings
+BACKFILL_COLUMN = ("backfilled", "bool")
+
+# Print log column of each temperature_store series, per heater
+STORE_COLUMNS = {
+    "extruder": {"temperatures": "hotend", "targets": "target_hotend"},
+    "heater_bed": {"temperatures": "bed", "targets": "target_bed"},
+}
+
+
+def store_readings(store, end_ms):
+    """
+    Turns Moonraker's temperature_store into timestamped readings.
+
+    The store holds a reading per heater every STORE_INTERVAL, newest last,
+    without timestamps, so the readings are timed back from the request.
+
+    Args:
+        store (dict): The temperature_store result, {heater: {series: list}}.
+        end_ms (int): The epoch time of the request in milliseconds.
+
+    Returns:
+        list: The (epoch milliseconds, {column: value}) of each reading,
+            oldest first.
+    """
+    series = {}
+    for heater, columns in STORE_COLUMNS.items():
+        for key, column in columns.items():
+            values = (store.get(heater) or {}).get(key)
+            if values:
+                series[column] = values
+    length = max((len(values) for values in series.values()), default=0)
+    readings = []
+    for index in range(length):
+        age = length - 1 - index
+        values = {}
+        for column, column_values in series.items():
+            # series are aligned on their newest reading
+            position = len(column_values) - 1 - age
+            if position >= 0:
+                values[column] = column_values[position]
+        readings.append((end_ms - int(age * STORE_INTERVAL * 1000), values))
+    return readings
+
+
+class TelemetryBackfill:
+    """
+    Finds gaps in the print log, e.g. while the plugin was restarting or
+    Moonraker could not be reached, and fills them from the temperature
+    history Moonraker keeps (about 20 minutes at one reading a second).
+
+    A gap is the time between two logged samples when it exceeds both
+    `backfill_min_gap` and GAP_INTERVALS sampling intervals. It is filled
+    with one request for the whole history, keeping only the readings
+    strictly between the two samples, so the rows can be appended before
+    the sample ending the gap and the log stays in time order.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self.enabled = bool(settings.get("telemetry_backfill", False))
+        try:
+            self.min_gap = float(
+                settings.get("backfill_min_gap", DEFAULT_BACKFILL_MIN_GAP)
+            )
+        except (TypeError, ValueError):
+            self.min_gap = DEFAULT_BACKFILL_MIN_GAP
+        self.last_ms = None
+        self.gaps = 0
+        self.rows = 0
+
+    def reset(self):
+        self.last_ms = None
+
+    def record(self, timestamp):
+        """Records the timestamp of the latest logged sample."""
+        if timestamp is not None:
+            self.last_ms = timestamp_to_ms(timestamp)
+
+    def find_gap(self, timestamp, interval):
+        """
+        Checks whether a sample follows a gap in the log.
+
+        Args:
+            timestamp (str): The sample's timestamp.
+            interval (float): The current sampling interval in seconds.
+
+        Returns:
+            tuple: The epoch milliseconds of the samples either side of the
+                gap, or None if there is no gap.
+        """
+        if not self.enabled or self.last_ms is None:
+            return None
+        end_ms = timestamp_to_ms(timestamp)
+        gap = (end_ms - self.last_ms) / 1000
+        if gap <= max(self.min_gap, GAP_INTERVALS * interval):
+            return None
+        return self.last_ms, end_ms
+
+    def fill(self, store, start_ms, end_ms, request_ms=None):
+        """
+        Picks the stored readings falling in a gap.
+
+        Args:
+            store (dict): The temperature_store result.
+            start_ms (int): The epoch milliseconds of the sample before the gap.
+            end_ms (int): The epoch milliseconds of the sample after the gap.
+            request_ms (int): The epoch milliseconds of the store request, or
+                None for now.
+
+        Returns:
+            list: The (timestamp, {column: value}) of each reading in the gap,
+                oldest first.
+        """
+        if request_ms is None:
+            request_ms = int(time.time() * 1000)
+        margin = int(STORE_INTERVAL * 1000) // 2
+        readings = [
+            (ms_to_timestamp(ms), values)
+            for ms, values in store_readings(store, request_ms)
+            if start_ms + margin < ms < end_ms - margin
+        ]
+        self.gaps += 1
+        self.rows += len(readings)
+        gap = (end_ms - start_ms) / 1000
+        covered = min(len(readings) * STORE_INTERVAL / gap, 1.0)
+        self._logger.info(
+            f"Backfilled {len(readings)} readings into a {gap:.0f}s gap in the "
+            f"print log ({covered:.0%} covered)"
+        )
+        return readings
+
+    def get_stats(self):
+        """Returns the backfill counters for logging and reporting."""
+        return {"enabled": self.enabled, "gaps": self.gaps, "rows": self.rows}
+
+
+def make_row(columns, values):
+    """
+    Makes a print log row from the values known for it, leaving the other
+    columns unknown: NaN floats, zero integers and empty strings.
+    """
+    row = []
+    for name, kind in columns:
+        if name in values:
+            row.append(values[name])
+        elif kind in ("f", "d"):
+            row.append(math.nan)
+        elif kind == "str":
+            row.append("")
+        elif kind == "bool":
+            row.append(False)
+        else:
+            row.append(0)
+    return row
@@ -0,0 +1,124 @@
+import time
+from dataclasses import dataclass
+from typing import Any, Dict
+
+DEFAULT_BATCH_MAX = 8  # frames per request, 1 disables batching
+DEFAULT_BATCH_WINDOW = 10.0  # seconds a frame may wait for its batch
+LATENCY_HEADROOM = 1.5  # keep uploads this much faster than sampling
+LATENCY_SMOOTHING = 0.3  # EWMA weight of the newest request latency
+
+# Responses to a batch upload meaning the server has no batch endpoint
+UNSUPPORTED_STATUSES = (404, 405, 501)
+
+
+@dataclass
+class BatchedImage:
+    name: str
+    data: Any
+    mime_type: str
+    metadata: Dict
+    added: float
+
+
+class ImageBatcher:
+    """
+    Collects encoded frames into batches uploaded in a single request.
+
+    The batch size follows the upload latency: while a request takes less
+    than a sampling interval frames go one per request, and as requests slow
+    down enough frames are packed into each that uploads keep up with
+    sampling. A frame never waits more than `image_batch_window` seconds,
+    and frames are sent one at a time while a user is watching live.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self._settings = settings
+        try:
+            self.max_size = int(settings.get("image_batch_max", DEFAULT_BATCH_MAX))
+            self.window = float(
+                settings.get("image_batch_window", DEFAULT_BATCH_WINDOW)
+            )
+        except (TypeError, ValueError):
+            self.max_size = DEFAULT_BATCH_MAX
+            self.window = DEFAULT_BATCH_WINDOW
+        self.max_size = max(self.max_size, 1)
+        self.supported = self.max_size > 1
+        # whether the server has accepted a batch, before which batches are
+        # not spooled, as the spool cannot tell if the server has the endpoint
+        self.confirmed = False
+        self.pending = []
+        self.target = 1
+        self.latency = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, name, encoded, metadata):
+        """
+        Queues an encoded frame.
+
+        Args:
+            name (str): The image file name.
+            encoded (EncodedImage): The encoded frame.
+            metadata (dict): The frame's metadata.
+        """
+        self.pending.append(
+            BatchedImage(
+                name, encoded.data, encoded.mime_type, metadata, time.monotonic()
+            )
+        )
+
+    def retain(self):
+        """
+        Copies queued frames out of buffers which are about to be reused, e.g.
+        passthrough frames which are still views of their frame buffers.
+        """
+        for image in self.pending:
+            if isinstance(image.data, memoryview):
+                image.data = image.data.tobytes()
+
+    def should_flush(self, live=False):
+        """Checks whether the queued frames should be uploaded now."""
+        if not self.pending:
+            return False
+        if live or not self.supported:
+            return True
+        return (
+            len(self.pending) >= min(self.target, self.max_size)
+            or time.monotonic() - self.pending[0].added >= self.window
+        )
+
+    def take(self):
+        """Returns and clears the queued frames."""
+        batch, self.pending = self.pending, []
+        return batch
+
+    def record_latency(self, seconds, frames, interval):
+        """
+        Adapts the batch size to the latency of an upload request.
+
+        A batch keeps up with sampling if it uploads in less time than its
+        frames took to capture. The size grows by one while batches fall
+        behind, and shrinks by one while a smaller batch would keep up too,
+        so a single slow request moves it by at most one frame.
+
+        Args:
+            seconds (float): How long the request took.
+            frames (int): The number of frames in the request.
+            interval (float): The current sampling interval in seconds.
+        """
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+        needed = seconds * LATENCY_HEADROOM
+        target = self.target
+        if needed > frames * interval:
+            target = frames + 1
+        elif needed < (frames - 1) * interval:
+            target = frames - 1
+        target = min(max(target, 1), self.max_size)
+        if target != self.target:
+            self._logger.debug(f"Image batch size {self.target} -> {target}")
+            self.target = target
@@ -0,0 +1,302 @@
+import os
+import queue
+import uuid
+import weakref
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+DEFAULT_BUFFER_COUNT = 4
+DEFAULT_BUFFER_CAPACITY = 1024 * 1024  # 1MB, grown on demand
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class FrameBuffer:
+    """
+    A reusable buffer holding one camera frame.
+
+    Backed by a shared memory block when available and `shared` is set, so
+    encoder workers can read the frame without it being copied or pickled.
+    """
+
+    def __init__(self, capacity, shared=True):
+        self.block = None
+        self.data = None
+        self.size = 0
+        self.shared = shared
+        # weak references to the views handed out of a shared block, which
+        # are released before it is closed
+        self.views = []
+        self.allocate(capacity)
+
+    @property
+    def name(self):
+        """The shared memory block name, or None for a local buffer."""
+        return self.block.name if self.block is not None else None
+
+    @property
+    def capacity(self):
+        return len(self.data)
+
+    def allocate(self, capacity):
+        """(Re)allocates the buffer, discarding its contents."""
+        self.free()
+        if self.shared and shared_memory is not None:
+            self.block = shared_memory.SharedMemory(create=True, size=capacity)
+            self.data = self.block.buf
+        else:
+            self.data = memoryview(bytearray(capacity))
+        self.size = 0
+
+    def grow(self, capacity):
+        """Grows the buffer to at least `capacity`, keeping its contents."""
+        if capacity <= self.capacity:
+            return
+        old = bytes(self.data[: self.size])
+        self.allocate(max(capacity, self.capacity * 2))
+        self.data[: len(old)] = old
+        self.size = len(old)
+
+    def view(self):
+        """Returns a memoryview of the frame, without copying it."""
+        view = self.data[: self.size]
+        if self.block is not None:
+            self.views = [ref for ref in self.views if ref() is not None]
+            self.views.append(weakref.ref(view))
+        return view
+
+    def write(self, data):
+        """
+        Copies a whole frame into the buffer.
+
+        Args:
+            data (bytes-like): The frame.
+
+        Returns:
+            FrameBuffer: The buffer itself.
+        """
+        self.size = 0
+        self.grow(len(data))
+        self.data[: len(data)] = data
+        self.size = len(data)
+        return self
+
+    def read_from(self, raw, content_length=None):
+        """
+        Reads a whole stream into the buffer.
+
+        Args:
+            raw: A binary stream supporting readinto (e.g. a urllib3 response).
+            content_length (int): The expected size, if known.
+
+        Returns:
+            FrameBuffer: The buffer itself.
+        """
+        self.size = 0
+        if content_length:
+            self.grow(content_length)
+        while True:
+            if self.size == self.capacity:
+                self.grow(self.capacity * 2)
+            read = raw.readinto(self.data[self.size : self.size + READ_CHUNK_SIZE])
+            if not read:
+                break
+            self.size += read
+        return self
+
+    def free(self):
+        """
+        Frees the buffer. Views of a shared block still held elsewhere are
+        released first, as the block cannot be closed while they exist.
+        """
+        if self.block is not None:
+            for ref in self.views:
+                view = ref()
+                if view is None:
+                    continue
+                try:
+                    view.release()
+                except BufferError:
+                    pass  # itself exported, e.g. to a numpy array
+            self.views = []
+            self.data = None
+            try:
+                self.block.close()
+            except BufferError:
+                # a slice of a view is still held: the segment is unlinked
+                # anyway, and unmapped once the slice is collected
+                pass
+            self.block.unlink()
+            self.block = None
+        self.data = None
+
+
+class FrameBufferPool:
+    """A fixed set of preallocated frame buffers, reused for every frame."""
+
+    def __init__(self, count=DEFAULT_BUFFER_COUNT, capacity=DEFAULT_BUFFER_CAPACITY):
+        self.buffers = [FrameBuffer(capacity) for _ in range(count)]
+        self.free_buffers = queue.Queue()
+        for buffer in self.buffers:
+            self.free_buffers.put(buffer)
+
+    def acquire(self, timeout=None):
+        """
+        Takes a free buffer from the pool, waiting if they are all in use.
+
+        Raises:
+            queue.Empty: If no buffer was freed within the timeout.
+        """
+        return self.free_buffers.get(timeout=timeout)
+
+    def release(self, buffer):
+        """Returns a buffer to the pool."""
+        buffer.size = 0
+        self.free_buffers.put(buffer)
+
+    def close(self):
+        """Frees every buffer, e.g. as the plugin exits."""
+        for buffer in self.buffers:
+            buffer.free()
+
+
+class ChunkStream:
+    """
+    A file part generated as it is sent, e.g. a CSV written from the print log.
+
+    Args:
+        factory (callable): Returns an iterable of str or bytes chunks. It is
+            called again to restart the stream when the body is resent.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.restart()
+
+    def restart(self):
+        self.chunks = iter(self.factory())
+
+    def read(self, size=-1):
+        """Returns the next chunk, whatever its size, or b"" at the end."""
+        for chunk in self.chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if chunk:
+                return chunk
+        return b""
+
+
+class MultipartBody:
+    """
+    A multipart/form-data body streamed straight from its parts' buffers.
+
+    Unlike `requests`' `files=` handling, the body is never joined into one
+    bytes object: file parts are sent as slices of their memoryviews, or read
+    from their open files in chunks.
+
+    A body with a generated part has no length up front, and is sent with
+    chunked transfer encoding (see `request_data`).
+
+    Args:
+        fields (dict): Form field names and string values.
+        files (dict): Form field names and (filename, data, content type)
+            tuples, where data is any bytes-like object, a binary file opened
+            for reading, or a callable returning an iterable of chunks.
+    """
+
+    def __init__(self, fields, files):
+        self.boundary = uuid.uuid4().hex
+        self.parts = []
+        for name, value in fields.items():
+            self.parts.append(
+                self.header(f'Content-Disposition: form-data; name="{name}"')
+            )
+            self.parts.append(memoryview(str(value).encode("utf-8")))
+            self.parts.append(memoryview(b"\r\n"))
+        for name, (filename, data, content_type) in files.items():
+            self.parts.append(
+                self.header(
+                    f'Content-Disposition: form-data; name="{name}"; '
+                    f'filename="{filename}"\r\nContent-Type: {content_type}'
+                )
+            )
+            if callable(data):
+                self.parts.append(ChunkStream(data))
+            elif hasattr(data, "read"):
+                self.parts.append(data)
+            else:
+                self.parts.append(memoryview(data).cast("B"))
+            self.parts.append(memoryview(b"\r\n"))
+        self.parts.append(memoryview(f"--{self.boundary}--\r\n".encode("utf-8")))
+        lengths = [self.part_length(part) for part in self.parts]
+        self.length = None if None in lengths else sum(lengths)
+        self.file_starts = {
+            index: part.tell()
+            for index, part in enumerate(self.parts)
+            if not isinstance(part, (memoryview, ChunkStream))
+        }
+        self.rewind()
+
+    def header(self, disposition):
+        return memoryview(f"--{self.boundary}\r\n{disposition}\r\n\r\n".encode("utf-8"))
+
+    @staticmethod
+    def part_length(part):
+        if isinstance(part, memoryview):
+            return len(part)
+        if isinstance(part, ChunkStream):
+            return None
+        return os.fstat(part.fileno()).st_size - part.tell()
+
+    def rewind(self):
+        """Starts the body again from the beginning, e.g. to resend it."""
+        for index, start in self.file_starts.items():
+            self.parts[index].seek(start)
+        for part in self.parts:
+            if isinstance(part, ChunkStream):
+                part.restart()
+        self.part_index = 0
+        self.part_offset = 0
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self.length or 0
+
+    def request_data(self):
+        """
+        Returns the body to pass to `requests` as `data`: the body itself when
+        its length is known, or a generator of its chunks to send chunked.
+        """
+        if self.length is None:
+            return iter(self)
+        return self
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        """Returns the next slice of the body, as a memoryview where possible."""
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(READ_CHUNK_SIZE), b""))
+        while self.part_index < len(self.parts):
+            part = self.parts[self.part_index]
+            if not isinstance(part, memoryview):
+                chunk = part.read(size)
+                if chunk:
+                    return chunk
+            elif self.part_offset < len(part):
+                chunk = part[self.part_offset : self.part_offset + size]
+                self.part_offset += len(chunk)
+                return chunk
+            self.part_index += 1
+            self.part_offset = 0
+        return b""
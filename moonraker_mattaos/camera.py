@@ -0,0 +1,475 @@
+import time
+import threading
+from collections import ChainMap
+import requests
+from .buffers import DEFAULT_BUFFER_CAPACITY, FrameBuffer
+from .change_detection import ChangeDetector
+from .quality import QualityGate
+
+CAMERA_SOURCES = ("snapshot", "stream")
+DEFAULT_CAMERA_SOURCE = "snapshot"
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # drop the buffer if no frame ends within this
+MAX_FRAME_AGE = 2.0  # seconds before a streamed frame counts as stale
+DEFAULT_FRAME_MAX_AGE = 0.5  # seconds a fetched frame is shared for
+FIRST_FRAME_TIMEOUT = 5.0  # seconds
+STREAM_IDLE_TIMEOUT = 30.0  # seconds without a request before the stream closes
+RECONNECT_BASE = 1.0  # seconds
+RECONNECT_MAX = 30.0  # seconds
+
+
+def get_stream_url(settings):
+    """
+    Gets the MJPEG stream URL, from the setting or from the snapshot URL.
+
+    Handles the mjpg-streamer/ustreamer "?action=snapshot" style and
+    crowsnest's ".../snapshot" style of URL.
+
+    Args:
+        settings (dict): The plugin settings.
+
+    Returns:
+        str: The stream URL, or "" if it cannot be worked out.
+    """
+    url = settings.get("stream_url") or ""
+    if url:
+        return url
+    snapshot_url = settings.get("snapshot_url") or ""
+    if "action=snapshot" in snapshot_url:
+        return snapshot_url.replace("action=snapshot", "action=stream")
+    if snapshot_url.rstrip("/").endswith("/snapshot"):
+        return snapshot_url.rstrip("/")[: -len("snapshot")] + "stream"
+    return ""
+
+
+def get_camera_stream(logger, settings):
+    """
+    Makes the MJPEG stream reader if the stream camera source is selected.
+
+    Returns:
+        MjpegStreamReader: The reader, or None to take snapshots.
+    """
+    source = str(settings.get("camera_source", DEFAULT_CAMERA_SOURCE)).lower()
+    if source not in CAMERA_SOURCES:
+        logger.error(f"Unknown camera source {source}, taking snapshots")
+        return None
+    if source != "stream":
+        return None
+    if get_stream_url(settings) == "":
+        logger.error("No camera stream URL could be found, taking snapshots")
+        return None
+    return MjpegStreamReader(logger, settings)
+
+
+def get_boundary(content_type):
+    """
+    Gets the multipart boundary from a Content-Type header.
+
+    Args:
+        content_type (str): E.g. "multipart/x-mixed-replace;boundary=frame".
+
+    Returns:
+        str: The boundary, or None if there is none.
+    """
+    for param in (content_type or "").split(";")[1:]:
+        name, _, value = param.strip().partition("=")
+        if name.strip().lower() == "boundary":
+            return value.strip().strip('"') or None
+    return None
+
+
+class MjpegParser:
+    """
+    Splits a multipart/x-mixed-replace MJPEG stream into JPEG frames.
+
+    A part's body is read by its Content-Length header when the streamer
+    sends one, and otherwise runs up to the next boundary. The JPEG end
+    marker is not used to find a frame's end, as a frame carrying an EXIF
+    thumbnail holds a complete JPEG, end marker included, before its own.
+
+    Some streamers repeat the boundary's leading dashes in its delimiter
+    lines and some do not, so the delimiter searched for is "--" and the
+    boundary without its leading dashes, which matches either way.
+
+    Args:
+        boundary (str): The boundary from the response's Content-Type, or
+            None to take it from the stream's first delimiter line.
+    """
+
+    def __init__(self, boundary=None):
+        self.buffer = bytearray()
+        self.delimiter = None
+        if boundary:
+            self.delimiter = b"--" + boundary.lstrip("-").encode("latin-1")
+        self.body_start = None  # buffer offset of the current part's body
+        self.length = None  # the current part's Content-Length
+        self.scanned = 0
+
+    def feed(self, data):
+        """
+        Adds stream data.
+
+        Args:
+            data (bytes-like): The next chunk of the stream.
+
+        Returns:
+            bytes: The last complete frame in the data, or None.
+        """
+        self.buffer += data
+        frame = None
+        while True:
+            body = self.next_part()
+            if body is None:
+                break
+            if body:
+                frame = body
+        if len(self.buffer) > MAX_FRAME_SIZE:
+            self.buffer.clear()
+            self.body_start = None
+            self.scanned = 0
+        return frame
+
+    def next_part(self):
+        """Returns the next complete part's body, or None if it is incomplete."""
+        if self.body_start is None and not self.read_headers():
+            return None
+        if self.length is not None:
+            end = self.body_start + self.length
+            if len(self.buffer) < end:
+                return None
+            with memoryview(self.buffer) as view:
+                body = bytes(view[self.body_start : end])
+        else:
+            end = self.buffer.find(self.delimiter, max(self.scanned, self.body_start))
+            if end < 0:
+                self.scanned = max(len(self.buffer) - len(self.delimiter) + 1, 0)
+                return None
+            with memoryview(self.buffer) as view:
+                # the line break before the delimiter, and any dashes of it
+                # beyond those searched for, are not part of the body
+                body = bytes(view[self.body_start : end]).rstrip(b"-").rstrip(b"\r\n")
+        # a delimiter left at the start of the buffer begins the next part
+        del self.buffer[:end]
+        self.body_start = None
+        self.scanned = 0
+        return body
+
+    def read_headers(self):
+        """
+        Reads the headers of the next part once they have all arrived.
+
+        Returns:
+            bool: True if the part's body starts at `body_start`.
+        """
+        if self.delimiter is None and not self.find_delimiter():
+            return False
+        start = self.buffer.find(self.delimiter)
+        if start < 0:
+            # keep a tail which may begin the delimiter
+            del self.buffer[: max(len(self.buffer) - len(self.delimiter) + 1, 0)]
+            return False
+        if start > 0:
+            del self.buffer[:start]
+        header_end = self.buffer.find(b"\r\n\r\n")
+        if header_end < 0:
+            return False
+        self.length = None
+        for line in bytes(self.buffer[:header_end]).split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                try:
+                    self.length = int(value)
+                except ValueError:
+                    pass
+        if self.length is not None and not 0 <= self.length <= MAX_FRAME_SIZE:
+            self.length = None
+        self.body_start = header_end + 4
+        self.scanned = self.body_start
+        return True
+
+    def find_delimiter(self):
+        """Takes the boundary from the stream's first delimiter line."""
+        start = self.buffer.find(b"--")
+        line_end = self.buffer.find(b"\r\n", start) if start >= 0 else -1
+        if line_end < 0:
+            return False
+        boundary = bytes(self.buffer[start:line_end]).strip().lstrip(b"-")
+        if not boundary:
+            del self.buffer[:line_end]
+            return False
+        self.delimiter = b"--" + boundary
+        return True
+
+
+class MjpegStreamReader:
+    """
+    Keeps one MJPEG stream open to the camera streamer, holding on to the
+    latest frame so a capture returns at once instead of waiting for a
+    snapshot request.
+
+    Frames are kept as the camera's JPEG bytes and only decoded when used.
+    The stream is opened on the first request and closed again after
+    STREAM_IDLE_TIMEOUT without one, so the camera is not streamed to the
+    plugin while nothing is printing.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self._settings = settings
+        self.url = get_stream_url(settings)
+        self.condition = threading.Condition()
+        self.frame = None
+        self.frame_time = None
+        self.frame_count = 0
+        self.last_request = 0.0
+        self.thread = None
+
+    def start(self):
+        """Starts the stream thread if it is not running."""
+        with self.condition:
+            self.last_request = time.monotonic()
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.stream_thread_loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def is_idle(self):
+        return time.monotonic() - self.last_request > STREAM_IDLE_TIMEOUT
+
+    def stream_thread_loop(self):
+        """Reads the stream until idle, reconnecting with backoff on errors."""
+        attempts = 0
+        while True:
+            with self.condition:
+                # checked under the lock so a concurrent start() is not lost
+                if self.is_idle():
+                    self.frame = None
+                    self.frame_time = None
+                    self.thread = None
+                    break
+            try:
+                with requests.get(self.url, stream=True, timeout=5) as resp:
+                    resp.raise_for_status()
+                    self._logger.info(f"Camera stream opened: {self.url}")
+                    parser = MjpegParser(
+                        get_boundary(resp.headers.get("Content-Type"))
+                    )
+                    for chunk in resp.iter_content(STREAM_CHUNK_SIZE):
+                        frame = parser.feed(chunk)
+                        if frame is not None:
+                            attempts = 0
+                            with self.condition:
+                                self.frame = frame
+                                self.frame_time = time.monotonic()
+                                self.frame_count += 1
+                                self.condition.notify_all()
+                        if self.is_idle():
+                            break
+            except Exception as e:
+                delay = min(RECONNECT_MAX, RECONNECT_BASE * 2**attempts)
+                attempts += 1
+                self._logger.info(
+                    f"Camera stream failed ({e}), reconnecting in {delay:.0f}s"
+                )
+                time.sleep(delay)
+        self._logger.info("Camera stream closed after being idle")
+
+    def latest(self, timeout=FIRST_FRAME_TIMEOUT):
+        """
+        Returns the latest frame from the stream.
+
+        Waits for a frame only if the stream has just been opened or the
+        held frame is stale.
+
+        Args:
+            timeout (float): The longest time to wait for a fresh frame.
+
+        Returns:
+            tuple: The JPEG bytes and the monotonic time they arrived.
+
+        Raises:
+            TimeoutError: If no fresh frame arrived within the timeout.
+        """
+        self.start()
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while (
+                self.frame_time is None
+                or time.monotonic() - self.frame_time > MAX_FRAME_AGE
+            ):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No frame from camera stream {self.url}")
+                self.condition.wait(remaining)
+            return self.frame, self.frame_time
+
+
+class FrameProvider:
+    """
+    The one source of camera frames for the data loop, snapshots and the
+    web interface, so the camera load does not grow with the consumers.
+
+    The latest frame is cached, and a request is served from the cache if
+    the frame is at most `max_age` seconds old. Otherwise a single fetch is
+    made, from the MJPEG stream or a snapshot request, and concurrent
+    requests wait for that fetch rather than starting their own.
+
+    The cached frame is held in a reusable buffer, and a snapshot is read
+    straight from the socket into a spare buffer which replaces it once the
+    fetch completes, so consumers never see a half-read frame.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self._settings = settings
+        self.stream = get_camera_stream(logger, settings)
+        try:
+            self.max_age = float(settings.get("frame_max_age", DEFAULT_FRAME_MAX_AGE))
+        except (TypeError, ValueError):
+            self.max_age = DEFAULT_FRAME_MAX_AGE
+        self.condition = threading.Condition()
+        self.frame = FrameBuffer(DEFAULT_BUFFER_CAPACITY, shared=False)
+        self.spare = FrameBuffer(DEFAULT_BUFFER_CAPACITY, shared=False)
+        self.frame_time = None
+        self.fetching = False
+        self.fetch_count = 0
+        self.error = None
+
+    def fetch(self, buffer):
+        """
+        Fetches a frame from the camera into a buffer.
+
+        Args:
+            buffer (FrameBuffer): The buffer to fill.
+
+        Returns:
+            float: The monotonic time the camera responded.
+        """
+        if self.stream is not None:
+            try:
+                frame, frame_time = self.stream.latest()
+                buffer.write(frame)
+                return frame_time
+            except TimeoutError as e:
+                self._logger.warning(f"{e}, taking a snapshot instead")
+        with requests.get(self._settings["snapshot_url"], stream=True, timeout=5) as resp:
+            capture_time = time.monotonic()
+            resp.raise_for_status()
+            try:
+                content_length = int(resp.headers.get("Content-Length") or 0)
+            except ValueError:
+                content_length = 0
+            buffer.read_from(resp.raw, content_length)
+            return capture_time
+
+    def refresh(self, max_age):
+        """
+        Makes sure the cached frame is at most `max_age` seconds old,
+        fetching a new one or waiting for the fetch already in flight.
+
+        Raises:
+            Exception: The error of the fetch, if it failed.
+        """
+        with self.condition:
+            if self.frame_time is not None and time.monotonic() - self.frame_time <= max_age:
+                return
+            if self.fetching:
+                # share the fetch already in flight
+                fetch_count = self.fetch_count
+                self.condition.wait_for(lambda: self.fetch_count != fetch_count)
+                if self.error is not None:
+                    raise self.error
+                return
+            self.fetching = True
+
+        frame_time, error = None, None
+        try:
+            frame_time = self.fetch(self.spare)
+        except Exception as e:
+            error = e
+        with self.condition:
+            if error is None:
+                self.frame, self.spare = self.spare, self.frame
+                self.frame_time = frame_time
+            self.error = error
+            self.fetching = False
+            self.fetch_count += 1
+            self.condition.notify_all()
+        if error is not None:
+            raise error
+
+    def get(self, max_age=None, into=None):
+        """
+        Gets a copy of a camera frame, at most `max_age` seconds old.
+
+        Args:
+            max_age (float): The oldest acceptable frame, defaulting to the
+                `frame_max_age` setting.
+            into (FrameBuffer): A buffer to copy the frame into, or None to
+                get it as bytes.
+
+        Returns:
+            tuple: The FrameBuffer, or the JPEG bytes, and the monotonic time
+                the camera responded.
+
+        Raises:
+            Exception: The error of the fetch, if it failed.
+        """
+        self.refresh(self.max_age if max_age is None else max_age)
+        with self.condition:
+            view = self.frame.view()
+            frame = into.write(view) if into is not None else bytes(view)
+            return frame, self.frame_time
+
+
+class Camera:
+    """
+    One of the printer's cameras, with its own settings, frame provider,
+    quality gate and change detector.
+
+    Args:
+        name (str): The name the camera's frames are tagged with.
+        settings (Mapping): The plugin settings, or a ChainMap of the
+            camera's overrides over them, so changes made to the plugin
+            settings at runtime still apply.
+    """
+
+    def __init__(self, logger, name, settings):
+        self.name = name
+        self.settings = settings
+        self.frame_provider = FrameProvider(logger, settings)
+        self.quality_gate = QualityGate(logger, settings)
+        self.change_detector = ChangeDetector(logger, settings)
+        self.last_image_name = None  # of the job's last uploaded frame
+
+    def reset(self):
+        """Forgets the per-job state, e.g. for a new print job."""
+        self.quality_gate.reset()
+        self.change_detector.reset()
+        self.last_image_name = None
+
+
+def make_cameras(logger, settings):
+    """
+    Makes the configured cameras, the one in the plugin settings first and
+    then those in the `cameras` setting.
+
+    Returns:
+        list: The cameras.
+    """
+    cameras = [Camera(logger, str(settings.get("camera_name") or "main"), settings)]
+    names = {cameras[0].name}
+    for definition in settings.get("cameras") or []:
+        overrides = dict(definition)
+        name = str(overrides.pop("name", "") or f"camera{len(cameras)}")
+        if name in names:
+            logger.error(f"Duplicate camera name {name}, ignoring the camera")
+            continue
+        names.add(name)
+        # a stream URL is never shared between cameras
+        overrides.setdefault("stream_url", "")
+        cameras.append(Camera(logger, name, ChainMap(overrides, settings)))
+    if len(cameras) > 1:
+        logger.info(f"Cameras: {', '.join(camera.name for camera in cameras)}")
+    return cameras
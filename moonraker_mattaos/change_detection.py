@@ -0,0 +1,111 @@
+import io
+import numpy as np
+from PIL import Image
+from .images import get_raw_roi_box, get_roi_settings, get_transpose_method
+
+DEFAULT_CHANGE_THRESHOLD = 0.02  # fraction of changed pixels
+DEFAULT_KEYFRAME_INTERVAL = 10  # frames
+DETECTION_SIZE = 32  # side length of the compared thumbnails, in pixels
+PIXEL_DELTA = 16  # grey levels a pixel must move by to count as changed
+
+
+class ChangeDetector:
+    """
+    Decides whether a camera frame differs enough from the last uploaded one
+    to be worth uploading.
+
+    Each frame is decoded at a reduced scale in greyscale with PIL's draft
+    mode, cropped to the window around the nozzle and shrunk to a small
+    thumbnail. The thumbnail is compared with that of the last uploaded frame
+    by the fraction of pixels whose grey level moved by more than
+    PIXEL_DELTA, so sensor noise and slow exposure drift are ignored.
+
+    Every `change_keyframe_interval` frames a frame is uploaded regardless.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self._settings = settings
+        self.enabled = bool(settings.get("change_detection", False))
+        try:
+            self.threshold = float(
+                settings.get("change_threshold", DEFAULT_CHANGE_THRESHOLD)
+            )
+            self.keyframe_interval = int(
+                settings.get("change_keyframe_interval", DEFAULT_KEYFRAME_INTERVAL)
+            )
+        except (TypeError, ValueError):
+            self.threshold = DEFAULT_CHANGE_THRESHOLD
+            self.keyframe_interval = DEFAULT_KEYFRAME_INTERVAL
+        self.keyframe_interval = max(self.keyframe_interval, 1)
+        self.reset()
+
+    def reset(self):
+        """Forgets the reference frame, so the next frame is uploaded."""
+        self.reference = None
+        self.skipped = 0
+
+    def thumbnail(self, image):
+        """
+        Makes the greyscale thumbnail of the nozzle window of a frame.
+
+        Args:
+            image (bytes-like): The JPEG frame from the camera.
+
+        Returns:
+            numpy.ndarray: The thumbnail as a 2D array of int16 grey levels.
+        """
+        _, roi_size, _ = get_roi_settings(self._settings)
+        method = get_transpose_method(
+            self._settings["flip_h"], self._settings["flip_v"], self._settings["rotate"]
+        )
+        pil_image = Image.open(io.BytesIO(image))
+        raw_size = pil_image.size
+        _, raw_box = get_raw_roi_box(raw_size, self._settings, method, roi_size)
+        # decode at the smallest scale that keeps the window DETECTION_SIZE wide
+        roi_width = max(raw_box[2] - raw_box[0], 1)
+        pil_image.draft(
+            "L",
+            (
+                -(-raw_size[0] * DETECTION_SIZE // roi_width),
+                -(-raw_size[1] * DETECTION_SIZE // roi_width),
+            ),
+        )
+        scale = raw_size[0] / pil_image.size[0]
+        pil_image = pil_image.crop(tuple(round(edge / scale) for edge in raw_box))
+        pil_image = pil_image.convert("L").resize(
+            (DETECTION_SIZE, DETECTION_SIZE), Image.BILINEAR
+        )
+        return np.asarray(pil_image, dtype=np.int16)
+
+    def check(self, image):
+        """
+        Checks whether a frame should be uploaded.
+
+        Args:
+            image (bytes-like): The JPEG frame from the camera.
+
+        Returns:
+            tuple: Whether to upload the frame, and the fraction of the
+                nozzle window that changed (None if it was not compared).
+        """
+        if not self.enabled:
+            return True, None
+        try:
+            thumbnail = self.thumbnail(image)
+        except Exception as e:
+            self._logger.error(f"Change detection failed: {e}")
+            return True, None
+
+        score = None
+        if self.reference is not None:
+            score = float(
+                np.count_nonzero(np.abs(thumbnail - self.reference) > PIXEL_DELTA)
+                / thumbnail.size
+            )
+            if score < self.threshold and self.skipped + 1 < self.keyframe_interval:
+                self.skipped += 1
+                return False, score
+        self.reference = thumbnail
+        self.skipped = 0
+        return True, score
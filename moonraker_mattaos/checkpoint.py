@@ -0,0 +1,91 @@
+import os
+import json
+import time
+from .spool import fsync_dir
+from .utils import MATTA_TMP_DATA_DIR
+
+CHECKPOINT_PATH = os.path.join(MATTA_TMP_DATA_DIR, "checkpoint.json")
+DEFAULT_CHECKPOINT_INTERVAL = 30.0  # seconds
+CHECKPOINT_VERSION = 1
+
+
+class JobCheckpoint:
+    """
+    A small file recording the running job, so a restarted plugin can
+    reattach to it instead of starting it over under a new name.
+
+    The checkpoint is written atomically, to a temporary file which is
+    synced and renamed over the old one, every `checkpoint_interval`
+    seconds. It records the job name, the G-code file, its hash and layer
+    index, the print log and its flushed size, and the sample and image
+    counters.
+    """
+
+    def __init__(self, logger, settings, path=CHECKPOINT_PATH):
+        self._logger = logger
+        self.path = path
+        try:
+            self.interval = float(
+                settings.get("checkpoint_interval", DEFAULT_CHECKPOINT_INTERVAL)
+            )
+        except (TypeError, ValueError):
+            self.interval = DEFAULT_CHECKPOINT_INTERVAL
+        self.last_save = None
+        self.saved = os.path.exists(path)
+
+    def load(self):
+        """
+        Reads the checkpoint.
+
+        Returns:
+            dict: The checkpointed job state, or None if there is none.
+        """
+        try:
+            with open(self.path, "r") as checkpoint:
+                state = json.load(checkpoint)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self._logger.error(f"Failed to read the job checkpoint: {e}")
+            return None
+        if not isinstance(state, dict) or state.get("version") != CHECKPOINT_VERSION:
+            return None
+        return state
+
+    def is_due(self):
+        """Checks whether `checkpoint_interval` has passed since the last save."""
+        if self.interval <= 0:
+            return False
+        return self.last_save is None or time.monotonic() - self.last_save >= self.interval
+
+    def save(self, state):
+        """Writes the checkpoint atomically."""
+        state = dict(state, version=CHECKPOINT_VERSION, saved_at=time.time())
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w") as checkpoint:
+                json.dump(state, checkpoint)
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+            os.replace(tmp_path, self.path)
+            fsync_dir(os.path.dirname(self.path))
+        except OSError as e:
+            self._logger.error(f"Failed to write the job checkpoint: {e}")
+            return
+        self.last_save = time.monotonic()
+        self.saved = True
+
+    def clear(self):
+        """Removes the checkpoint, once its job has ended."""
+        self.last_save = None
+        if not self.saved:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self._logger.error(f"Failed to remove the job checkpoint: {e}")
+            return
+        self.saved = False
@@ -0,0 +1,197 @@
+import zlib
+import threading
+import requests
+
+try:
+    import zstandard
+except ImportError:  # optional, gzip is used without it
+    zstandard = None
+
+UPLOAD_COMPRESSIONS = ("auto", "zstd", "gzip", "none")
+DEFAULT_UPLOAD_COMPRESSION = "auto"
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+PROBE_TIMEOUT = 5  # seconds
+
+
+def available_encodings():
+    """Returns the content encodings this install can produce, best first."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    encodings.append("gzip")
+    return encodings
+
+
+def parse_accept_encoding(value):
+    """
+    Parses an Accept-Encoding header into the set of accepted codings.
+
+    Args:
+        value (str): The header value, e.g. "zstd, gzip;q=0.5".
+
+    Returns:
+        set: The lowercase codings with a non-zero quality.
+    """
+    codings = set()
+    for item in (value or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if coding == "":
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, number = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    pass
+        if quality > 0:
+            codings.add(coding)
+    return codings
+
+
+def make_compressor(encoding):
+    """Returns a streaming compressor with compress() and flush() methods."""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    # wbits 31 writes a gzip header and trailer
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def compress_stream(chunks, encoding):
+    """
+    Compresses a stream of chunks as they are read.
+
+    Args:
+        chunks (iterable): The bytes-like chunks of the uncompressed body.
+        encoding (str): "zstd" or "gzip".
+
+    Yields:
+        bytes: Compressed chunks, for a chunked request body.
+    """
+    compressor = make_compressor(encoding)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class UploadCompressor:
+    """
+    Negotiates and applies Content-Encoding for large text uploads.
+
+    The server advertises the request codings it accepts in an Accept-Encoding
+    response header (RFC 7694), learned from an OPTIONS probe and from every
+    response. Until the server advertises a coding we share, uploads are sent
+    uncompressed. A 415 response to a compressed upload turns compression off
+    and the upload is resent as is.
+
+    With `upload_compression` set to "zstd" or "gzip" that coding is used
+    without waiting for the server to advertise it.
+
+    The compressor is shared by the threads which upload, and each posts on
+    its own `requests.Session`, as sessions are not thread-safe.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self._settings = settings
+        self.lock = threading.Lock()
+        self.accepted = None  # codings the server accepts, None until known
+        self.mode = str(
+            settings.get("upload_compression", DEFAULT_UPLOAD_COMPRESSION)
+        ).lower()
+        if self.mode not in UPLOAD_COMPRESSIONS:
+            self._logger.error(f"Unknown upload compression {self.mode}")
+            self.mode = DEFAULT_UPLOAD_COMPRESSION
+        if self.mode == "zstd" and zstandard is None:
+            self._logger.warning("zstandard is not installed, using gzip")
+            self.mode = "gzip"
+
+    def update(self, resp):
+        """Records the codings advertised in a response, if any."""
+        value = resp.headers.get("Accept-Encoding")
+        if value is not None:
+            with self.lock:
+                self.accepted = parse_accept_encoding(value)
+
+    def probe(self, session, url, headers):
+        """
+        Asks the server which request codings it accepts. If the server
+        cannot be reached they stay unknown, and the next upload probes again.
+        """
+        try:
+            resp = session.options(
+                url=url, headers=headers, timeout=PROBE_TIMEOUT
+            )
+        except requests.exceptions.RequestException as e:
+            self._logger.debug(f"Upload compression probe failed: {e}")
+            return
+        self.update(resp)
+        with self.lock:
+            if self.accepted is None:
+                self.accepted = set()
+
+    def select(self, session, url, headers):
+        """
+        Chooses the content encoding for an upload, probing on `session`.
+
+        Returns:
+            str: "zstd" or "gzip", or None to send the upload uncompressed.
+        """
+        if self.mode == "none":
+            return None
+        if self.mode != "auto":
+            return self.mode
+        if self.accepted is None:
+            self.probe(session, url, headers)
+            if self.accepted is None:
+                return None
+        for encoding in available_encodings():
+            if encoding in self.accepted:
+                return encoding
+        return None
+
+    def post(self, session, url, body, headers, timeout=None):
+        """
+        Posts a MultipartBody, compressing it if the server accepts it.
+
+        Args:
+            session (requests.Session): The calling thread's session.
+            url (str): The full URL.
+            body (MultipartBody): The request body.
+            headers (dict): The request headers.
+            timeout (float): The request timeout, or None.
+
+        Returns:
+            requests.Response: The server's response.
+        """
+        headers = dict(headers, **{"Content-Type": body.content_type})
+        encoding = self.select(session, url, headers)
+        if encoding is not None:
+            resp = session.post(
+                url=url,
+                data=compress_stream(body, encoding),
+                headers=dict(headers, **{"Content-Encoding": encoding}),
+                timeout=timeout,
+            )
+            self.update(resp)
+            if resp.status_code != 415:
+                return resp
+            self._logger.info(
+                f"Server rejected {encoding} upload, sending it uncompressed"
+            )
+            with self.lock:
+                self.accepted = self.accepted or set()
+                self.accepted.discard(encoding)
+            if self.mode != "auto":
+                self.mode = "none"
+            body.rewind()
+        resp = session.post(
+            url=url, data=body.request_data(), headers=headers, timeout=timeout
+        )
+        self.update(resp)
+        return resp
@@ -1,7 +1,7 @@
 import time
+import atexit
 import threading
 import requests
-import csv
 import json
 from .utils import (
     clean_gcode_list,
@@ -9,18 +9,41 @@ from .utils import (
     get_gcode_upload_dir,
     make_timestamp,
     generate_auth_headers,
-    SAMPLING_TIMEOUT,
     MATTA_TMP_DATA_DIR,
     read_gcode_file,
 )
 import os
 import shutil
-from PIL import Image
-import io
+from contextlib import ExitStack
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from .backfill import BACKFILL_COLUMN, TelemetryBackfill, make_row
+from .batching import BatchedImage, ImageBatcher, UNSUPPORTED_STATUSES
+from .buffers import DEFAULT_BUFFER_COUNT, FrameBufferPool, MultipartBody
+from .camera import make_cameras
+from .checkpoint import JobCheckpoint
+from .compression import UploadCompressor
+from .encoder import ImageEncoder
+from .gcode_hashes import GcodeHashStore
+from .governor import ResourceGovernor
+from .layers import LayerTrigger
+from .printlog import PrintLog, PRINT_LOG_COLUMNS, iter_csv
+from .rate_control import UploadRateController
+from .scheduler import SamplingScheduler
+from .spool import UploadSpool, is_retryable
+from .storage import StorageManager, mark_job_dir
+from .telemetry import TelemetryCollector, telemetry_columns
+from .telemetry_batch import (
+    BATCH_MIME_TYPE,
+    BATCH_VERSION,
+    TelemetryBatcher,
+    encode_batch,
+)
+from .ws_frames import WebsocketFrameSender
 import pandas as pd
 
 class DataEngine:
-    def __init__(self, logger, logger_cmd, settings, matta_printer):
+    def __init__(self, logger, logger_cmd, settings, matta_printer, frame_sender=None):
         self._printer = matta_printer
         self._settings = settings
         self._logger = logger
@@ -30,14 +53,59 @@ class DataEngine:
         self.gcode_file = None
         self.gcode_lines = None
         self.last_gcode_line = 0
-        self.csv_print_log = None
-        self.csv_writer = None
-        self.csv_path = None
+        self.print_log = None
+        self.print_log_path = None
+        self.layer_index_path = None
+        self.last_file_position = 0
         self.upload_attempts = 0
+        self.sample_count = 0
+        self.analysis_pending = False
+        self.cameras = make_cameras(self._logger, self._settings)
+        # snapshots and the web interface use the first camera
+        self.frame_provider = self.cameras[0].frame_provider
+        self.capture_executor = ThreadPoolExecutor(max_workers=len(self.cameras))
+        self.image_encoder = ImageEncoder(self._logger, self._settings)
+        self.frame_buffers = FrameBufferPool(
+            max(DEFAULT_BUFFER_COUNT, 2 * len(self.cameras))
+        )
+        self.layer_trigger = LayerTrigger(self._logger, self._settings)
+        self.gcode_hashes = GcodeHashStore(self._logger)
+        self.session = requests.Session()
+        self.session.hooks["response"].append(self.gcode_hashes.update)
+        self.image_batcher = ImageBatcher(self._logger, self._settings)
+        self.rate_controller = UploadRateController(self._logger, self._settings)
+        # without the cloud websocket's sender frames are always posted
+        self.frame_sender = frame_sender or WebsocketFrameSender(
+            self._logger, self._settings
+        )
+        self.upload_compressor = UploadCompressor(self._logger, self._settings)
+        self.upload_spool = UploadSpool(
+            self._logger, self._settings, compressor=self.upload_compressor
+        )
+        self.storage = StorageManager(self._logger, self._settings)
+        self.job_checkpoint = JobCheckpoint(self._logger, self._settings)
+        self.scheduler = SamplingScheduler(self._logger, self._settings)
+        self.governor = ResourceGovernor(self._logger, self._settings)
+        self.governor.start()
+        self.telemetry = TelemetryCollector(
+            self._logger, self._settings, self._printer
+        )
+        self.telemetry.start()
+        self.telemetry_batcher = TelemetryBatcher(self._logger, self._settings)
+        self.backfill = TelemetryBackfill(self._logger, self._settings)
+        atexit.register(self.shutdown)
 
         self._logger.info("Starting data thread")
         self.start_data_thread()
 
+    def shutdown(self):
+        """
+        Stops the image encoder workers and frees the shared memory of the
+        frame buffers, e.g. as the plugin exits.
+        """
+        self.image_encoder.shutdown()
+        self.frame_buffers.close()
+
     def start_data_thread(self):
         """
         Start the main combined thread for capturing both CSV and images
@@ -72,21 +140,27 @@ class DataEngine:
                 f"Failed to create directory - OS Error ({e.errno}): {e.strerror}, Directory: {data_path}"
             )
             self._logger.error(f"Current directory: {os.getcwd()}")
+        try:
+            mark_job_dir(data_path)
+        except OSError as e:
+            self._logger.error(f"Failed to mark job directory {data_path}: {e}")
         return data_path
 
     def reset_job_data(self):
         """
         Reset the job-related data after a print job.
         """
-        self.csv_print_log = None
-        self.csv_writer = None
+        self.print_log = None
+        self.print_log_path = None
         try:
             shutil.rmtree(self.get_job_dir())
         except OSError as e:
             pass
         except TypeError as e:
             pass
-        self.csv_path = None
+        self.layer_index_path = None
+        self.last_file_position = 0
+        self.job_checkpoint.clear()
         self._printer.new_print_job = True
         self._printer.current_job = None
         self.gcode_path = None
@@ -96,65 +170,224 @@ class DataEngine:
             self._logger.error(f"Failed to close gcode file: {e}")
         self.gcode_file = None
         self.image_count = 0
+        self.sample_count = 0
+        self.analysis_pending = False
+        for camera in self.cameras:
+            camera.reset()
+        self.layer_trigger.reset()
+        # frames still queued or in flight on the websocket are the ended
+        # job's and must not go out under the next one, and dropping them
+        # frees their data
+        dropped = len(self.image_batcher.take())
+        dropped += self.frame_sender.drop_pending()
+        if dropped:
+            self._logger.info(f"Dropped {dropped} frames queued by the ended job")
+        self.telemetry_batcher.reset()
+        self.backfill.reset()
         self._printer.gcode_line_num_no_comments = None
         self._printer.gcode_cmd = None
 
-    def create_metadata(self):
-        temps = self._printer.get_printer_temp_object()
-        printer_objects = self._printer.get_printer_objects()
+    def create_metadata(self, sample, camera):
         metadata = {
             "count": self.image_count,
-            "timestamp": make_timestamp(),
-            "flow_rate": printer_objects["flow_rate"] * 100,
-            "feed_rate": printer_objects["feed_rate"] * 100,
-            "z_offset": printer_objects["z_offset"],
-            "hotend_target": temps["tool0"]["target"],
-            "hotend_actual": temps["tool0"]["actual"],
-            "bed_target": temps["bed"]["target"],
-            "bed_actual": temps["bed"]["actual"],
-            "nozzle_tip_coords_x": int(self._settings["nozzle_tip_coords_x"]),
-            "nozzle_tip_coords_y": int(self._settings["nozzle_tip_coords_y"]),
-            "flip_h": self._settings["flip_h"],
-            "flip_v": self._settings["flip_v"],
-            "rotate": self._settings["rotate"],
+            "sample_id": sample["sample_id"],
+            "camera": camera.name,
+            "timestamp": sample["timestamp"],
+            "capture_time": sample["frame_capture_times"].get(camera.name),
+            "state_capture_time": sample["capture_time"],
+            "eventtime": sample["eventtime"],
+            "flow_rate": sample["flow_rate"],
+            "feed_rate": sample["feed_rate"],
+            "z_offset": sample["z_offset"],
+            "hotend_target": sample["hotend_target"],
+            "hotend_actual": sample["hotend_actual"],
+            "bed_target": sample["bed_target"],
+            "bed_actual": sample["bed_actual"],
+            "nozzle_tip_coords_x": int(camera.settings["nozzle_tip_coords_x"]),
+            "nozzle_tip_coords_y": int(camera.settings["nozzle_tip_coords_y"]),
+            "flip_h": camera.settings["flip_h"],
+            "flip_v": camera.settings["flip_v"],
+            "rotate": camera.settings["rotate"],
         }
+        if sample.get("telemetry") is not None:
+            metadata["telemetry"] = sample["telemetry"]
         return metadata
 
-    def gcode_upload(self, job_name, gcode_path):
+    def image_file_name(self, camera, count):
+        """Names a camera's image, the first camera's without a suffix."""
+        if camera is self.cameras[0]:
+            return f"image_{count}"
+        return f"image_{count}_{camera.name}"
+
+    def post_upload(
+        self,
+        kind,
+        endpoint,
+        data,
+        files,
+        timeout=None,
+        compress=False,
+        unsupported_statuses=(),
+        spool=True,
+    ):
         """
-        Uploads G-code files to the specified base URL.
+        Posts an upload to the Matta API, spooling it to be retried if it fails.
+
+        While earlier uploads are still spooled, new ones are spooled behind
+        them so the server receives everything in order.
 
         Args:
-            files (dict): A dictionary containing the files to upload.
-            headers (dict): Additional headers to include in the request.
+            kind (str): The kind of upload, e.g. "image", "gcode" or "finished".
+            endpoint (str): The API endpoint, relative to the API URL.
+            data (dict): The form fields.
+            files (dict): Form field names and (filename, source, content type)
+                tuples, where source is a file path, bytes-like data, or a
+                callable returning an iterable of chunks.
+            timeout (float): The request timeout, or None.
+            compress (bool): Whether to compress the body as it is streamed,
+                for large text uploads.
+            unsupported_statuses (tuple): HTTP statuses meaning the endpoint
+                is not supported, which are raised rather than handled.
+            spool (bool): Whether to spool the upload. If not, it is only
+                sent if nothing is spooled, and is dropped if it fails.
+
+        Returns:
+            bool: True if the upload was sent now, False otherwise.
 
         Raises:
-            requests.exceptions.RequestException: If an error occurs during the upload.
+            requests.exceptions.HTTPError: For `unsupported_statuses`.
         """
-        self._logger.debug("Posting gcode")
-        with open(gcode_path, "rb") as gcode:
-            gcode_name = os.path.basename(
-                gcode_path
-            )  # ? Check if it needs that, since we're just getting the filename
-            metadata = {
-                "name": os.path.splitext(gcode_name)[0],
-                "long_name": job_name,
-                "gcode_file": gcode_name,
-                "start_time": make_timestamp(),
-            }
-            data = {"data": json.dumps(metadata)}
-            files = {
-                "gcode_obj": (job_name, gcode, "text/plain"),
-            }
-            full_url = get_api_url() + "print-jobs/remote/start-job"
-            headers = generate_auth_headers(self._settings["auth_token"])
-            try:
-                resp = requests.post(
-                    url=full_url, data=data, files=files, headers=headers
+        if not self.upload_spool.is_empty():
+            if spool:
+                self.upload_spool.add(kind, endpoint, data, files, timeout, compress)
+            return False
+        full_url = get_api_url() + endpoint
+        headers = generate_auth_headers(self._settings["auth_token"])
+        try:
+            with ExitStack() as stack:
+                body = MultipartBody(
+                    data,
+                    {
+                        field: (
+                            name,
+                            stack.enter_context(open(source, "rb"))
+                            if isinstance(source, str)
+                            else source,
+                            mime,
+                        )
+                        for field, (name, source, mime) in files.items()
+                    },
                 )
-                resp.raise_for_status()
-            except requests.exceptions.RequestException as e:
-                self._logger.error(e)
+                if compress:
+                    resp = self.upload_compressor.post(
+                        self.session, full_url, body, headers, timeout
+                    )
+                else:
+                    headers["Content-Type"] = body.content_type
+                    resp = self.session.post(
+                        url=full_url,
+                        data=body.request_data(),
+                        headers=headers,
+                        timeout=timeout,
+                    )
+            resp.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as e:
+            if (
+                isinstance(e, requests.exceptions.HTTPError)
+                and e.response is not None
+                and e.response.status_code in unsupported_statuses
+            ):
+                raise
+            self._logger.info(f"Failed to post {kind} upload: {e}")
+            if spool and is_retryable(e):
+                self.upload_spool.add(kind, endpoint, data, files, timeout, compress)
+            return False
+
+    def gcode_upload(self, job_name, gcode_path):
+        """
+        Uploads G-code files to the specified base URL.
+
+        The G-code's SHA-256 is sent with the job metadata. If the server
+        starts jobs by hash and has already confirmed holding a file with that
+        hash, only the metadata is sent, and the full file is uploaded unless
+        the server accepts the hash.
+
+        Args:
+            job_name (str): The name of the print job.
+            gcode_path (str): The path of the G-code file.
+        """
+        self._logger.debug("Posting gcode")
+        gcode_name = os.path.basename(
+            gcode_path
+        )  # ? Check if it needs that, since we're just getting the filename
+        gcode_hash = self.gcode_hashes.get_hash(gcode_path)
+        metadata = {
+            "name": os.path.splitext(gcode_name)[0],
+            "long_name": job_name,
+            "gcode_file": gcode_name,
+            "gcode_sha256": gcode_hash,
+            "start_time": make_timestamp(),
+        }
+        data = {"data": json.dumps(metadata)}
+        if (
+            self.gcode_hashes.server_support
+            and self.gcode_hashes.is_confirmed(gcode_hash)
+            and self.upload_spool.is_empty()
+        ):
+            if self.known_gcode_upload(data, gcode_hash):
+                self.gcode_hashes.confirm(gcode_hash)
+                self._logger.debug("G-code already uploaded, sent its hash only")
+                return
+        files = {
+            "gcode_obj": (job_name, gcode_path, "text/plain"),
+        }
+        if self.post_upload(
+            "gcode", "print-jobs/remote/start-job", data, files, compress=True
+        ):
+            self.gcode_hashes.confirm(gcode_hash)
+
+    def known_gcode_upload(self, data, gcode_hash):
+        """
+        Starts a job with a G-code file the server already holds, by its hash.
+
+        Only a response accepting the hash with a `X-Gcode-Hash-Start: known`
+        header counts: on any other answer the file is uploaded in full. The
+        hash is forgotten only if the server answers that it does not know
+        it, not if the server could not be reached, and a success without
+        the header means the server no longer starts jobs by hash.
+
+        Args:
+            data (dict): The form fields, including the G-code hash.
+            gcode_hash (str): The G-code file's SHA-256.
+
+        Returns:
+            bool: True if the server accepted the hash, False if it did not
+                know it or could not be reached.
+        """
+        body = MultipartBody(data, {})
+        headers = generate_auth_headers(self._settings["auth_token"])
+        headers["Content-Type"] = body.content_type
+        try:
+            resp = self.session.post(
+                url=get_api_url() + "print-jobs/remote/start-job",
+                data=body,
+                headers=headers,
+                timeout=self.rate_controller.timeout(len(body)),
+            )
+            resp.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if e.response is not None and 400 <= e.response.status_code < 500:
+                self._logger.info(f"G-code hash not known, uploading the file: {e}")
+                self.gcode_hashes.forget(gcode_hash)
+            else:
+                self._logger.info(f"Failed to send the G-code hash: {e}")
+            return False
+        if not self.gcode_hashes.is_known(resp):
+            self._logger.info("G-code hash not accepted, uploading the file")
+            self.gcode_hashes.server_support = False
+            return False
+        return True
 
     def gcode_analyse(self):
         """
@@ -167,102 +400,240 @@ class DataEngine:
         # sort the gcode_lines by line_number
         self.gcode_lines = self.gcode_lines.sort_values(by="line_number")
 
-    def image_upload(self, image):
+    def encode_frame(self, frame, camera):
+        """
+        Starts encoding a camera's frame for upload, in the encoder workers
+        when they are used, so the frames of every camera encode at once.
+
+        Returns:
+            PendingEncode: The encoding. The frame must not be released
+                until its result has been collected.
+        """
+        quality = None
+        scale = None
+        if self.rate_controller.enabled:
+            if self.rate_controller.adapts_quality:
+                quality = self.rate_controller.quality
+            if self.rate_controller.adapts_scale:
+                scale = self.rate_controller.scale
+        return self.image_encoder.submit(
+            frame,
+            quality,
+            passthrough=self.governor.skip_encoding,
+            settings=camera.settings,
+            scale=scale,
+        )
+
+    def image_upload(self, encoded, sample, camera, details=None):
         """
         Uploads image files to the specified base URL.
 
-        Args:
-            files (dict): A dictionary containing the files to upload.
-            headers (dict): Additional headers to include in the request.
+        Frames are queued in the image batcher and uploaded once it decides
+        the batch is due, straight away while a user is watching live. The
+        multipart body is streamed from the frame and encoder buffers rather
+        than built in memory.
 
-        Raises:
-            requests.exceptions.RequestException: If an error occurs during the upload.
+        Args:
+            encoded (EncodedImage): The encoded camera frame to upload.
+            sample (dict): The printer state captured alongside the frame.
+            camera (Camera): The camera the frame came from.
+            details (dict): Extra metadata about the frame, e.g. its change
+                and quality scores.
         """
         self._logger.debug("Posting image")
-        image_name = f"image_{self.image_count}.png"
-
-        # Load the image using PIL
-        pil_image = Image.open(io.BytesIO(image))
-
-        # Flip the image if necessary
-        if self._settings["flip_h"]:
-            pil_image = pil_image.transpose(Image.FLIP_LEFT_RIGHT)
-        if self._settings["flip_v"]:
-            pil_image = pil_image.transpose(Image.FLIP_TOP_BOTTOM)
-        if self._settings["rotate"]:
-            pil_image = pil_image.transpose(Image.ROTATE_90)
-
-        self._logger.debug("Image transforms complete")
-        # Convert the PIL image back to bytes
-        byte_arr = io.BytesIO()
-        pil_image.save(byte_arr, format="PNG")
-        image = byte_arr.getvalue()
-
-        self._logger.debug("Image loaded")
+        image_name = (
+            f"{self.image_file_name(camera, self.image_count)}.{encoded.extension}"
+        )
+        self._logger.debug("Image encoded")
+
         metadata = {
             "name": image_name,
             "img_file": image_name,
+            "transforms_applied": encoded.transforms_applied,
         }
-        metadata.update(self.create_metadata())
-        data = {"data": json.dumps(metadata)}
-        files = {
-            "image_obj": (image_name, image, "image/png"),
-        }
-        full_url = get_api_url() + "images/print/predict/new-image"
-        headers = generate_auth_headers(self._settings["auth_token"])
-        try:
-            resp = requests.post(
-                url=full_url,
-                data=data,
-                files=files,
-                headers=headers,
-                timeout=5,
-            )
-            self._logger.debug("Image posted")
-            resp.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            self._logger.info(e)
+        if encoded.roi is not None:
+            metadata["roi"] = encoded.roi
+        if details:
+            metadata.update(details)
+        metadata.update(self.create_metadata(sample, camera))
+        self.image_batcher.add(image_name, encoded, metadata)
+        camera.last_image_name = image_name
+        if self.image_batcher.should_flush(self._settings.get("live_upload", False)):
+            self.flush_images()
+        else:
+            # the frame buffer is reused once this returns
+            self.image_batcher.retain()
 
-    def finished_upload(self, job_name, gcode_path, csv_path):
+    def flush_images(self):
         """
-        Notifies the server that the print job has finished.
+        Uploads the frames queued in the image batcher.
 
-        Args:
-            job_name (str): The name of the print job.
-
-        Raises:
-            requests.exceptions.RequestException: If an error occurs during the upload.
-        """
-        self._logger.debug(csv_path)
-        with open(csv_path, "rb") as csv:
-            gcode_name = os.path.basename(gcode_path)
-            csv_name = os.path.basename(csv_path)
-            self._logger.debug(gcode_name)
-            self._logger.debug(csv_name)
-            metadata = {
-                "name": os.path.splitext(gcode_name)[0],
-                "long_name": job_name,
-                "csv_file": csv_name,
-                "end_time": make_timestamp(),
-            }
-            data = {"data": json.dumps(metadata)}
+        While the server accepts binary websocket frames, they are sent one
+        by one over the cloud websocket. Otherwise several frames go in one
+        request to the batch endpoint, with a list of per-frame metadata. If
+        the server has no batch endpoint, batching is turned off and the
+        frames are sent one per request. Batches are only spooled once the
+        server has accepted one, so until then frames which cannot be sent
+        are spooled one per request. Frames the websocket lost before they
+        were acknowledged are posted ahead of the new ones.
+        """
+        self.record_frame_acks()
+        batch = [
+            BatchedImage(name, data, mime_type, metadata, time.monotonic())
+            for name, data, mime_type, metadata in self.frame_sender.take_unacked()
+        ]
+        batch += self.image_batcher.take()
+        if not batch:
+            return
+        start_time = time.monotonic()
+        if self.frame_sender.available() and self.upload_spool.is_empty():
+            sent = self.send_frames(batch)
+            if sent:
+                self.record_image_latency(time.monotonic() - start_time, sent)
+            batch = batch[sent:]
+            if not batch:
+                return
+            start_time = time.monotonic()
+        if len(batch) > 1 and self.image_batcher.supported:
+            data = {"data": json.dumps([image.metadata for image in batch])}
             files = {
-                "csv_obj": (csv_name, csv, "text/csv"),
+                f"image_obj_{index}": (image.name, image.data, image.mime_type)
+                for index, image in enumerate(batch)
             }
-            self._logger.debug(json.dumps(data))
-            full_url = get_api_url() + "print-jobs/remote/end-job"
-            self._logger.debug(full_url)
-            headers = generate_auth_headers(self._settings["auth_token"])
-            self._logger.debug(headers)
+            size = sum(len(image.data) for image in batch)
+            spooled = not self.upload_spool.is_empty()
             try:
-                resp = requests.post(
-                    url=full_url, data=data, files=files, headers=headers
+                sent = self.post_upload(
+                    "image_batch",
+                    "images/print/predict/new-images",
+                    data,
+                    files,
+                    timeout=self.rate_controller.timeout(size) + len(batch),
+                    unsupported_statuses=UNSUPPORTED_STATUSES,
+                    spool=self.image_batcher.confirmed,
                 )
-                resp.raise_for_status()
-                self._logger.debug("Posting finished")
-                self._logger.debug(resp)
-            except requests.exceptions.RequestException as e:
-                self._logger.error(e)
+                if sent:
+                    self._logger.debug(f"Posted a batch of {len(batch)} images")
+                    self.image_batcher.confirmed = True
+                if not spooled:
+                    self.rate_controller.record(start_time, size, len(batch), sent)
+                if sent or self.image_batcher.confirmed:
+                    self.record_image_latency(
+                        time.monotonic() - start_time, len(batch)
+                    )
+                    return
+            except requests.exceptions.HTTPError as e:
+                self._logger.info(f"Image batches not supported, disabling: {e}")
+                self.image_batcher.supported = False
+        for image in batch:
+            data = {"data": json.dumps(image.metadata)}
+            files = {
+                "image_obj": (image.name, image.data, image.mime_type),
+            }
+            size = len(image.data)
+            spooled = not self.upload_spool.is_empty()
+            image_start_time = time.monotonic()
+            sent = self.post_upload(
+                "image",
+                "images/print/predict/new-image",
+                data,
+                files,
+                timeout=self.rate_controller.timeout(size),
+            )
+            if sent:
+                self._logger.debug("Image posted")
+            if not spooled:
+                self.rate_controller.record(image_start_time, size, 1, sent)
+        self.record_image_latency(time.monotonic() - start_time, len(batch))
+
+    def send_frames(self, batch):
+        """
+        Sends frames over the cloud websocket, stopping at the first which
+        must be posted instead.
+
+        Returns:
+            int: The number of frames sent.
+        """
+        for index, image in enumerate(batch):
+            if not self.frame_sender.send(
+                image.name,
+                image.data,
+                image.mime_type,
+                image.metadata,
+                timeout=self.rate_controller.timeout(len(image.data)),
+            ):
+                return index
+        return len(batch)
+
+    def record_frame_acks(self):
+        """Feeds acknowledged websocket frames to the upload rate controller."""
+        for sent_time, ack_time, size in self.frame_sender.take_acked():
+            self.rate_controller.record(sent_time, size, 1, True, end_time=ack_time)
+
+    def record_image_latency(self, seconds, frames):
+        """Feeds an image upload's latency to the batcher and the scheduler."""
+        self.image_batcher.record_latency(seconds, frames, self.scheduler.interval)
+        self.scheduler.record_latency(seconds / frames)
+
+    def heartbeat_upload(self, sample, camera, details):
+        """
+        Sends the metadata of a frame which was skipped, as unchanged or by
+        the quality gate, in place of the image. It refers to the camera's
+        last uploaded frame, if the job has uploaded one.
+
+        Args:
+            sample (dict): The printer state captured alongside the frame.
+            camera (Camera): The camera the frame came from.
+            details (dict): Why the frame was skipped, e.g. its change and
+                quality scores.
+        """
+        metadata = {"heartbeat": True}
+        if camera.last_image_name is not None:
+            metadata["reference_img_file"] = camera.last_image_name
+        metadata.update(details)
+        metadata.update(self.create_metadata(sample, camera))
+        data = {"data": json.dumps(metadata)}
+        start_time = time.monotonic()
+        if self.post_upload(
+            "heartbeat", "images/print/predict/new-image", data, {}, timeout=5
+        ):
+            self._logger.debug("Frame skipped, heartbeat posted")
+        self.scheduler.record_latency(time.monotonic() - start_time)
+
+    def finished_upload(self, job_name, gcode_path, print_log_path):
+        """
+        Notifies the server that the print job has finished.
+
+        The print log is uploaded as CSV, generated from its blocks as the
+        request is sent rather than written out first. If the upload fails the
+        CSV is written to the upload spool, so it survives the job directory
+        being reset.
+
+        Args:
+            job_name (str): The name of the print job.
+            gcode_path (str): The path of the G-code file.
+            print_log_path (str): The path of the print log.
+        """
+        self._logger.debug(print_log_path)
+        gcode_name = os.path.basename(gcode_path)
+        csv_name = os.path.splitext(os.path.basename(print_log_path))[0] + ".csv"
+        self._logger.debug(gcode_name)
+        self._logger.debug(csv_name)
+        metadata = {
+            "name": os.path.splitext(gcode_name)[0],
+            "long_name": job_name,
+            "csv_file": csv_name,
+            "end_time": make_timestamp(),
+        }
+        data = {"data": json.dumps(metadata)}
+        files = {
+            "csv_obj": (csv_name, partial(iter_csv, print_log_path), "text/csv"),
+        }
+        self._logger.debug(json.dumps(data))
+        if self.post_upload(
+            "finished", "print-jobs/remote/end-job", data, files, compress=True
+        ):
+            self._logger.debug("Posting finished")
 
     def is_new_job(self):
         """
@@ -283,23 +654,34 @@ class DataEngine:
         # TODO remove try except big block later
         try:
             if self._printer.has_job():
-                if self._printer.new_print_job:
-                    self._logger.debug("New job.")
+                # a job already running when the plugin started has no name
+                if self._printer.new_print_job or self._printer.current_job is None:
                     self._printer.new_print_job = False
-                    self._printer.current_job = self._printer.make_job_name()
                     job_data = self._printer.get_job_data()
+                    if self.resume_job(job_data):
+                        return True
+                    self._logger.debug("New job.")
+                    self._printer.current_job = self._printer.make_job_name()
                     gcode_path = job_data["status"]["virtual_sdcard"]["file_path"]
                     # open file store in self.gcode_file
                     try:
                         self.gcode_file = open(gcode_path, "rb")
                     except Exception as e:
                         self._logger.error(f"Failed to open gcode file: {e}")
+                    self.layer_trigger.load(gcode_path)
                     self._logger.debug(f"New job: {self._printer.current_job}")
                     try:
                         self.setup_print_log()
+                        self.layer_index_path = self.layer_trigger.save_index(
+                            os.path.join(self.get_job_dir(), "layers.idx")
+                        )
                         self.gcode_upload(self._printer.current_job, self.gcode_path)
-                        # analyse the gcode store
-                        self.gcode_analyse()
+                        # analyse the gcode store, once the host has the
+                        # CPU to spare
+                        if self.governor.defer_analysis:
+                            self.analysis_pending = True
+                        else:
+                            self.gcode_analyse()
                     except Exception as e:
                         self._logger.error(
                             f"Failed to set up data collection for print job: {e}"
@@ -310,10 +692,13 @@ class DataEngine:
                 if self._printer.just_finished():
                     self._logger.debug("Just finished a print job.")
                     try:
+                        self.flush_images()
                         self.cleanup_print_log()
                         self._logger.debug("Print log cleaned up.")
                         self.finished_upload(
-                            self._printer.current_job, self.gcode_path, self.csv_path
+                            self._printer.current_job,
+                            self.gcode_path,
+                            self.print_log_path,
                         )
                         self._logger.debug("Posted!")
                         self.finished = True
@@ -332,71 +717,172 @@ class DataEngine:
 
         return False
 
+    def resume_job(self, job_data):
+        """
+        Reattaches to the running job from the checkpoint written before the
+        plugin restarted, keeping its name, print log, counters and layer
+        index instead of starting it over.
+
+        The checkpoint is only used if the printer is still printing the
+        same G-code file, unchanged, from a job started before the
+        checkpoint was written.
+
+        Args:
+            job_data (dict): The printer's print_stats and virtual_sdcard.
+
+        Returns:
+            bool: True if the job was resumed, False to start a new one.
+        """
+        state = self.job_checkpoint.load()
+        if state is None:
+            return False
+        start_time = time.monotonic()
+        print_log = None
+        try:
+            status = job_data["status"]
+            virtual_sdcard = status["virtual_sdcard"]
+            total_duration = status["print_stats"].get("total_duration")
+            reason = None
+            if virtual_sdcard["file_path"] != state["gcode_file_path"]:
+                reason = "a different file is printing"
+            elif virtual_sdcard["file_position"] < state["file_position"]:
+                reason = "the print is behind the checkpoint"
+            elif (
+                total_duration is not None
+                and total_duration < time.time() - state["saved_at"]
+            ):
+                reason = "the job started after the checkpoint"
+            elif self.gcode_hashes.get_hash(state["gcode_path"]) != state["gcode_sha256"]:
+                reason = "the G-code file has changed"
+            else:
+                print_log = PrintLog(
+                    state["print_log_path"],
+                    compression=self._settings.get("print_log_compression", "zlib"),
+                    resume=True,
+                )
+                if print_log.offset < state["print_log_offset"]:
+                    reason = "the print log is shorter than the checkpoint"
+            if reason is not None:
+                self._logger.info(f"Not resuming {state['job_name']}: {reason}")
+                if print_log is not None:
+                    print_log.close()
+                self.job_checkpoint.clear()
+                return False
+            gcode_file = open(state["gcode_file_path"], "rb")
+        except Exception as e:
+            self._logger.error(f"Failed to resume from the job checkpoint: {e}")
+            if print_log is not None:
+                print_log.close()
+            self.job_checkpoint.clear()
+            return False
+
+        self._printer.current_job = state["job_name"]
+        self.gcode_file = gcode_file
+        self.gcode_path = state["gcode_path"]
+        self.print_log = print_log
+        self.print_log_path = state["print_log_path"]
+        self.image_count = state["image_count"]
+        self.sample_count = state["sample_count"]
+        if print_log.last_row is not None:
+            names = [name for name, _ in print_log.columns]
+            self.sample_count = max(
+                self.sample_count, print_log.last_row[names.index("sample_id")] + 1
+            )
+            # the time the plugin was down is backfilled on the next sample
+            self.backfill.record(print_log.last_row[names.index("timestamp")])
+        self.last_file_position = state["file_position"]
+        self.layer_index_path = state.get("layer_index_path")
+        self.layer_trigger.load_index(self.layer_index_path)
+        if self.layer_trigger.mode == "layer" and not self.layer_trigger.offsets:
+            self.layer_trigger.load(state["gcode_file_path"])
+        # the analysis is only kept in memory, so it is redone off the
+        # critical path
+        self.analysis_pending = True
+        self.storage.claim(self.get_job_dir())
+        self._logger.info(
+            f"Resumed job {state['job_name']} at sample {self.sample_count} "
+            f"in {time.monotonic() - start_time:.3f}s"
+        )
+        return True
+
+    def save_checkpoint(self):
+        """Flushes the print log and checkpoints the running job."""
+        if self.print_log is None or self.gcode_file is None:
+            return
+        try:
+            self.print_log.flush()
+            gcode_hash = self.gcode_hashes.get_hash(self.gcode_path)
+        except (OSError, ValueError) as e:
+            self._logger.error(f"Failed to checkpoint the job: {e}")
+            return
+        self.job_checkpoint.save(
+            {
+                "job_name": self._printer.current_job,
+                "gcode_file_path": self.gcode_file.name,
+                "gcode_path": self.gcode_path,
+                "gcode_sha256": gcode_hash,
+                "layer_index_path": self.layer_index_path,
+                "print_log_path": self.print_log_path,
+                "print_log_offset": self.print_log.offset,
+                "sample_count": self.sample_count,
+                "image_count": self.image_count,
+                "file_position": self.last_file_position,
+            }
+        )
+
     def setup_print_log(self):
         """
         Set up the print log file and start the image thread.
         """
         job_dir = self.create_job_dir()
-        self.csv_path = os.path.join(job_dir, "print_log.csv")
+        self.storage.enforce(job_dir, self.upload_spool, force=True)
+        self.print_log_path = os.path.join(job_dir, "print_log.bin")
         self.gcode_path = os.path.join(
             get_gcode_upload_dir(),
             self._printer.get_gcode_base_name(),
         )
         self._logger.debug("G-code file copied.")
         try:
-            self.csv_print_log = open(self.csv_path, "w")
-            self.csv_writer = csv.writer(self.csv_print_log, delimiter=",")
-            self.csv_writer.writerow(self.csv_headers())
-            self.csv_print_log.flush()
+            self.print_log = PrintLog(
+                self.print_log_path,
+                columns=self.print_log_columns(),
+                compression=self._settings.get("print_log_compression", "zlib"),
+            )
         except IOError as e:
             self._logger.error(f"Failed to open print log file: {e}")
-            self.csv_print_log = None
-            self.csv_writer = None
+            self.print_log = None
 
     def cleanup_print_log(self):
         """
         Clean up the print log file and image thread after the print has finished.
         """
         try:
-            self.csv_print_log.flush()
-            self.csv_print_log.close()
+            self.print_log.close()
         except AttributeError:
             self._logger.error("CSV print log was never made...")
         except Exception as e:
             self._logger.error(f"Failed to close print log file: {e}")
 
+    def print_log_columns(self):
+        """
+        Returns the print log columns, with the telemetry aggregates and the
+        backfilled row flag if on.
+        """
+        columns = PRINT_LOG_COLUMNS
+        if self.telemetry.enabled:
+            columns = columns + telemetry_columns()
+        if self.backfill.enabled:
+            columns = columns + [BACKFILL_COLUMN]
+        return columns
+
     def csv_headers(self):
         """Returns a list of CSV headers used for data collection."""
-        return [
-            "count",
-            "timestamp",
-            "flow_rate",
-            "feed_rate",
-            "z_offset",
-            "target_hotend",
-            "hotend",
-            "target_bed",
-            "bed",
-            "gcode_line_num_no_comments",
-            "gcode_cmd",
-            "file_position_bytes",
-            "nozzle_tip_coords_x",
-            "nozzle_tip_coords_y",
-            "flip_h",
-            "flip_v",
-            "rotate",
-        ]
+        return [name for name, _ in self.print_log_columns()]
+
+    def csv_data_row(self, sample):
+        """Returns a list for populating a row of a CSV from a sample."""
+        file_position_bytes = sample["file_position"]
 
-    def csv_data_row(self):
-        """Fetches data and returns a list for populating a row of a CSV."""
-        temps = self._printer.get_printer_temp_object()
-        printer_objects = self._printer.get_printer_objects()
-        job_data = self._printer.get_job_data()
-        file_position_bytes = job_data["status"]["virtual_sdcard"]["file_position"]
-        file_size = job_data["status"]["virtual_sdcard"]["file_size"]
-        if file_size == 0:
-            file_position_bytes = 0
-        
         # self.gcode_file is the gcode file in string format
         # file_position_bytes is the current position in the gcode file
         # get the gcode line and line number from the gcode file
@@ -410,14 +896,14 @@ class DataEngine:
 
         row = [
             self.image_count,
-            make_timestamp(),
-            printer_objects["flow_rate"] * 100,
-            printer_objects["feed_rate"] * 100,
-            printer_objects["z_offset"],
-            temps["tool0"]["target"],
-            temps["tool0"]["actual"],
-            temps["bed"]["target"],
-            temps["bed"]["actual"],
+            sample["timestamp"],
+            sample["flow_rate"],
+            sample["feed_rate"],
+            sample["z_offset"],
+            sample["hotend_target"],
+            sample["hotend_actual"],
+            sample["bed_target"],
+            sample["bed_actual"],
             line_number,
             gcode_line,
             file_position_bytes,
@@ -426,7 +912,18 @@ class DataEngine:
             self._settings["flip_h"],
             self._settings["flip_v"],
             self._settings["rotate"],
+            sample["sample_id"],
+            sample["capture_time"],
+            sample["eventtime"],
         ]
+        # a resumed log keeps the columns it was created with
+        telemetry = sample.get("telemetry") or {}
+        for name, _ in self.print_log.columns[len(row) :]:
+            if name == BACKFILL_COLUMN[0]:
+                row.append(False)
+                continue
+            channel, _, stat = name.rpartition("_")
+            row.append(telemetry.get(channel, {}).get(stat))
         return row
 
     def generate_auth_headers(self):
@@ -438,21 +935,323 @@ class DataEngine:
         """
         return {"Authorization": self._settings["auth_token"]}
 
-    def update_csv(self):
+    def capture_state(self):
+        """
+        Captures the printer state for a sample with one Moonraker request.
+
+        Returns:
+            dict: The sample, timestamped with the monotonic midpoint of the
+                request and Klipper's eventtime.
+        """
+        request_time = time.monotonic()
+        result = self._printer.get_sample_objects()
+        capture_time = (request_time + time.monotonic()) / 2
+        status = result["status"]
+        gcode_move = status["gcode_move"]
+        virtual_sdcard = status["virtual_sdcard"]
+        extruder = status.get("extruder", {})
+        heater_bed = status.get("heater_bed", {})
+        file_position_bytes = virtual_sdcard["file_position"]
+        if virtual_sdcard["file_size"] == 0:
+            file_position_bytes = 0
+        return {
+            "timestamp": make_timestamp(),
+            "capture_time": capture_time,
+            "eventtime": result.get("eventtime"),
+            "flow_rate": gcode_move["extrude_factor"] * 100,
+            "feed_rate": gcode_move["speed_factor"] * 100,
+            "z_offset": gcode_move["homing_origin"][2],
+            "hotend_target": extruder.get("target", 0.0),
+            "hotend_actual": extruder.get("temperature", 0.0),
+            "bed_target": heater_bed.get("target", 0.0),
+            "bed_actual": heater_bed.get("temperature", 0.0),
+            "file_position": file_position_bytes,
+        }
+
+    def capture_frame(self, max_age=None, camera=None):
+        """
+        Gets a camera frame into a frame buffer (runs on a capture thread).
+
+        The frame comes from the camera's shared frame provider, so it may
+        have been fetched for another consumer within the `frame_max_age`
+        setting.
+
+        Args:
+            max_age (float): The oldest acceptable frame, or None for the
+                `frame_max_age` setting.
+            camera (Camera): The camera, or None for the first camera.
+
+        Returns:
+            tuple: The FrameBuffer, which the caller must release, and the
+                monotonic time the camera responded.
+        """
+        camera = camera or self.cameras[0]
+        frame = self.frame_buffers.acquire(timeout=5)
         try:
-            self.csv_writer.writerow(self.csv_data_row())
-            self.csv_print_log.flush()
+            _, capture_time = camera.frame_provider.get(max_age, into=frame)
+        except Exception:
+            self.frame_buffers.release(frame)
+            raise
+        return frame, capture_time
+
+    def submit_frames(self):
+        """Starts fetching a frame from every camera in parallel."""
+        return [
+            self.capture_executor.submit(self.capture_frame, None, camera)
+            for camera in self.cameras
+        ]
+
+    def collect_frames(self, futures, sample):
+        """
+        Waits for the frames started by `submit_frames`.
+
+        Args:
+            futures (list): The fetches, one per camera.
+            sample (dict): The sample to record the frame capture times in,
+                or None.
+
+        Returns:
+            list: A FrameBuffer per camera, None where the fetch failed.
+        """
+        frames = []
+        for camera, future in zip(self.cameras, futures):
+            frame = None
+            try:
+                frame, frame_capture_time = future.result()
+                if sample is not None:
+                    sample["frame_capture_times"][camera.name] = frame_capture_time
+            except Exception as e:
+                self._logger.error(f"Failed to capture frame from {camera.name}: {e}")
+            frames.append(frame)
+        return frames
+
+    def capture_sample(self, with_frame=True):
+        """
+        Captures the printer state and a frame from every camera
+        concurrently, so all the records describe the same moment and share
+        one sample ID. A tick takes as long as the slowest camera, not the
+        sum of them. With the telemetry collector on, the sample also gets
+        the aggregates of the readings taken since the previous sample.
+
+        Args:
+            with_frame (bool): Whether to capture camera frames.
+
+        Returns:
+            tuple: The sample dict (None if the state query failed) and a
+                list of FrameBuffers, one per camera (None where the camera
+                fetch failed), or an empty list without frames.
+        """
+        futures = self.submit_frames() if with_frame else []
+        sample = {"sample_id": self.sample_count, "frame_capture_times": {}}
+        self.sample_count += 1
+        try:
+            sample.update(self.capture_state())
+            sample["telemetry"] = self.telemetry.summarize(sample["capture_time"])
+        except Exception as e:
+            self._logger.error(f"Failed to capture printer state: {e}")
+            sample = None
+        return sample, self.collect_frames(futures, sample)
+
+    def capture_layer_frames(self, sample):
+        """
+        Captures the frames for a sample taken without them, once its file
+        position shows a layer change the trigger did not predict.
+
+        Returns:
+            list: A FrameBuffer per camera, None where the fetch failed.
+        """
+        return self.collect_frames(self.submit_frames(), sample)
+
+    def update_csv(self, sample):
+        try:
+            row = self.csv_data_row(sample)
+            self.print_log.append(row)
+            self.telemetry_batcher.add(row)
+            self.backfill.record(sample["timestamp"])
         except Exception as e:
             self._logger.error(e)
 
-    def update_image(self):
+    def backfill_gap(self, sample):
+        """
+        Fills a gap in the print log ending at a sample, before the sample
+        is logged, from Moonraker's temperature history, fetched in one
+        request. Only the filled rows are uploaded, as one telemetry batch.
+        """
+        try:
+            gap = self.backfill.find_gap(sample["timestamp"], self.scheduler.interval)
+            if gap is None or self.print_log is None:
+                return
+            store = self._printer.get_temperature_store()
+            if store is None:
+                return
+            readings = self.backfill.fill(store, *gap)
+            if not readings:
+                return
+            columns = self.print_log.columns
+            known = {
+                "count": self.image_count,
+                "nozzle_tip_coords_x": int(self._settings["nozzle_tip_coords_x"]),
+                "nozzle_tip_coords_y": int(self._settings["nozzle_tip_coords_y"]),
+                "flip_h": self._settings["flip_h"],
+                "flip_v": self._settings["flip_v"],
+                "rotate": self._settings["rotate"],
+                BACKFILL_COLUMN[0]: True,
+            }
+            rows = [
+                make_row(columns, dict(known, timestamp=timestamp, **values))
+                for timestamp, values in readings
+            ]
+            for row in rows:
+                self.print_log.append(row)
+            if self.telemetry_batcher.supported:
+                self.send_telemetry_batch(
+                    encode_batch(columns, rows),
+                    {
+                        "rows": len(rows),
+                        "backfill": True,
+                        "start": readings[0][0],
+                        "end": readings[-1][0],
+                    },
+                )
+        except Exception as e:
+            self._logger.error(f"Failed to backfill the print log: {e}")
+
+    def telemetry_upload(self):
+        """
+        Sends the print log rows queued since the last batch, delta and
+        Gorilla encoded and compressed, over the cloud websocket when it
+        takes binary messages and to the telemetry endpoint otherwise. If
+        the server has no telemetry endpoint, batches are turned off.
+        """
+        row_count, batch = self.telemetry_batcher.take(self.print_log.columns)
+        self.send_telemetry_batch(batch, {"rows": row_count})
+
+    def send_telemetry_batch(self, batch, metadata):
+        """
+        Sends an encoded telemetry batch over the cloud websocket, or posts
+        it to the telemetry endpoint.
+
+        Args:
+            batch (bytes): The batch made by `encode_batch`.
+            metadata (dict): What the batch holds, e.g. its number of rows.
+        """
+        metadata = dict(
+            metadata, job_name=self._printer.current_job, version=BATCH_VERSION
+        )
+        if self.frame_sender.send_telemetry(metadata, batch):
+            return
+        data = {"data": json.dumps(metadata)}
+        files = {"telemetry": ("telemetry.bin", batch, BATCH_MIME_TYPE)}
         try:
-            resp = requests.get(self._settings["snapshot_url"], stream=True)
-            self._logger.debug("Image fetched, about to upload")
-            self.image_upload(resp.content)
-            self.image_count += 1
+            self.post_upload(
+                "telemetry",
+                "telemetry/print/new-batch",
+                data,
+                files,
+                timeout=5,
+                unsupported_statuses=UNSUPPORTED_STATUSES,
+            )
+        except requests.exceptions.HTTPError as e:
+            self._logger.info(f"Telemetry batches not supported, disabling: {e}")
+            self.telemetry_batcher.supported = False
+
+    def check_quality(self, sample, frame, camera):
+        """
+        Runs a frame through the camera's quality gate, fetching a new frame
+        up to `quality_retries` times while it fails.
+
+        Args:
+            sample (dict): The sample, whose frame capture time is updated.
+            frame (FrameBuffer): The camera frame, released if it is replaced.
+            camera (Camera): The camera the frame came from.
+
+        Returns:
+            tuple: The frame (None if a refetch failed), whether it passed,
+                and its quality scores (None if the gate is off).
+        """
+        passed, quality = camera.quality_gate.check(frame.view())
+        for _ in range(camera.quality_gate.retries):
+            if passed:
+                break
+            self._logger.debug(f"Frame rejected ({quality['rejected']}), refetching")
+            self.frame_buffers.release(frame)
+            try:
+                frame, capture_time = self.capture_frame(max_age=0, camera=camera)
+            except Exception as e:
+                self._logger.error(f"Failed to refetch frame: {e}")
+                return None, False, quality
+            sample["frame_capture_times"][camera.name] = capture_time
+            passed, quality = camera.quality_gate.check(frame.view())
+        return frame, passed, quality
+
+    def check_frame(self, sample, frame, camera):
+        """
+        Checks a camera's frame with the quality gate and the change
+        detector, sending a heartbeat in its place if it is not uploaded.
+
+        Returns:
+            tuple: The frame, which may have been replaced by a refetch or be
+                None if the refetch failed, and the details of the checks, or
+                None for the details if the frame is not to be uploaded.
+        """
+        details = {}
+        # at the minimal work level frames are not decoded at all
+        if self.governor.skip_encoding:
+            return frame, details
+        try:
+            frame, passed, quality = self.check_quality(sample, frame, camera)
+            if quality is not None:
+                details["quality"] = quality
+            if not passed:
+                self._logger.info(f"Frame rejected by the quality gate: {quality}")
+                self.heartbeat_upload(sample, camera, details)
+                return frame, None
+            changed, change_score = camera.change_detector.check(frame.view())
+            if change_score is not None:
+                details["change_score"] = change_score
+            if not changed:
+                self.heartbeat_upload(sample, camera, details)
+                return frame, None
         except Exception as e:
             self._logger.error(e)
+            return frame, None
+        return frame, details
+
+    def update_images(self, sample, frames):
+        """
+        Uploads the frames of a sample, one per camera, under one image
+        count, or heartbeats in their place.
+
+        The frames to upload are all handed to the encoder before any result
+        is collected, so the encoder workers encode the cameras in parallel.
+        """
+        pending = []
+        for camera, frame in zip(self.cameras, frames):
+            if frame is None:
+                continue
+            frame, details = self.check_frame(sample, frame, camera)
+            if details is not None:
+                try:
+                    pending.append(
+                        (camera, frame, details, self.encode_frame(frame, camera))
+                    )
+                    continue
+                except Exception as e:
+                    self._logger.error(e)
+            if frame is not None:
+                self.frame_buffers.release(frame)
+        uploaded = False
+        for camera, frame, details, encoding in pending:
+            try:
+                self._logger.debug("Image fetched, about to upload")
+                self.image_upload(encoding.result(), sample, camera, details)
+                uploaded = True
+            except Exception as e:
+                self._logger.error(e)
+            finally:
+                self.frame_buffers.release(frame)
+        if uploaded:
+            self.image_count += 1
 
     def data_thread_loop(self):
         """
@@ -460,24 +1259,73 @@ class DataEngine:
         - to populate the CSV log
         - to capture image frames
 
-        This loop runs at a rate determined by SAMPLING_TIMEOUT.
+        Samples are taken on a fixed grid of deadlines kept by the sampling
+        scheduler, whose interval adapts to the upload latency and backlog.
+        With the layer capture trigger only some samples get a frame, and the
+        next deadline is brought forward to just after a predicted layer
+        change, or to the burst interval during the first layers. The
+        resource governor stretches the interval and defers the G-code
+        analysis while the host is busy.
 
         Returns:
             None
         """
         self._logger.info("Starting main data loop method.")
-        old_time = time.perf_counter()
-        time_buffer = 0.0
+        sampling = False
 
         while True:
-            current_time = time.perf_counter()
-            if (
-                self.is_new_job()
-                and (current_time - old_time) > SAMPLING_TIMEOUT - time_buffer
-            ):
-                time_buffer = max(0, current_time - old_time - SAMPLING_TIMEOUT)
-                old_time = current_time
-                self.update_csv()
-                self._logger.debug("CSV updated, about to update image")
-                self.update_image()
-            time.sleep(0.1)  # slow things down to 10ms to run other threads
+            self.scheduler.wait()
+            if self.is_new_job():
+                if not sampling:
+                    sampling = True
+                    self.scheduler.reset_stats()
+                    self.telemetry.activate()
+                with_frame = self.layer_trigger.wants_image()
+                sample, frames = self.capture_sample(with_frame)
+                if sample is not None:
+                    self.last_file_position = sample["file_position"]
+                    self.layer_trigger.update(
+                        sample["file_position"], sample["capture_time"]
+                    )
+                    if not with_frame and self.layer_trigger.wants_image():
+                        frames = self.capture_layer_frames(sample)
+                    self.backfill_gap(sample)
+                    self.update_csv(sample)
+                    self._logger.debug("CSV updated, about to update image")
+                if any(frame is not None for frame in frames):
+                    if sample is not None:
+                        self.layer_trigger.image_taken(sample["capture_time"])
+                        self.update_images(sample, frames)
+                    else:
+                        for frame in frames:
+                            if frame is not None:
+                                self.frame_buffers.release(frame)
+                if self.telemetry_batcher.is_due():
+                    self.telemetry_upload()
+                if self.job_checkpoint.is_due():
+                    self.save_checkpoint()
+                if self.analysis_pending and not self.governor.defer_analysis:
+                    self.analysis_pending = False
+                    try:
+                        self.gcode_analyse()
+                    except Exception as e:
+                        self._logger.error(f"Failed to analyse deferred G-code: {e}")
+            elif sampling:
+                sampling = False
+                self.telemetry.deactivate()
+                self._logger.info(
+                    f"Sampling stats for the last job: {self.scheduler.get_stats()}"
+                )
+            rate_interval = None
+            if self.rate_controller.enabled:
+                rate_interval = self.rate_controller.interval
+            self.scheduler.adapt(
+                len(self.upload_spool), rate_interval, self.governor.interval_factor
+            )
+            self.storage.enforce(self.get_job_dir(), self.upload_spool)
+            if self.frame_sender.unacked:
+                self.flush_images()
+            if sampling:
+                delay = self.layer_trigger.next_capture_delay()
+                if delay is not None:
+                    self.scheduler.expedite(delay)
@@ -0,0 +1,240 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+from .buffers import FrameBuffer
+from .images import encode_image, requires_decode
+
+DEFAULT_ENCODER_WORKERS = 2
+DEFAULT_ENCODER_NICE = 10
+
+
+def parse_cpu_affinity(value):
+    """
+    Parses a CPU affinity setting such as "2,3" or "1-3".
+
+    Args:
+        value (str): The comma separated list of CPUs and CPU ranges.
+
+    Returns:
+        set: The CPU indices, empty if no affinity is set.
+    """
+    cpus = set()
+    for part in str(value or "").replace(" ", "").split(","):
+        if part == "":
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def init_worker(nice, cpus):
+    """Lowers the priority of, and pins, an encoder worker process."""
+    if nice:
+        try:
+            os.nice(nice)
+        except OSError:
+            pass
+    if cpus and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError:
+            pass
+
+
+def encode_shared(name, size, settings):
+    """Encodes a frame held in a shared memory block (runs in a worker)."""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        with block.buf[:size] as image:
+            encoded = encode_image(image, settings)
+            if isinstance(encoded.data, memoryview):
+                encoded.data = encoded.data.tobytes()
+    finally:
+        block.close()
+    return encoded
+
+
+class ImageEncoder:
+    """
+    Encodes camera frames in a small pool of low priority worker processes,
+    keeping image work off the GIL and out of Klipper's way.
+
+    Frames are handed to the workers through shared memory, without a copy
+    when they already live in a shared FrameBuffer. With
+    `encoder_workers = 0`, on a single CPU where the pool would only add
+    overhead, or if the pool cannot be used, frames are encoded in the
+    calling thread. The frames of a sample are submitted together, so the
+    workers encode several cameras at once.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self._settings = settings
+        self.pool = None
+        try:
+            self.workers = int(
+                settings.get("encoder_workers", DEFAULT_ENCODER_WORKERS)
+            )
+            self.nice = int(settings.get("encoder_nice", DEFAULT_ENCODER_NICE))
+            self.cpus = parse_cpu_affinity(settings.get("encoder_cpu_affinity", ""))
+        except ValueError as e:
+            self._logger.error(f"Invalid image encoder settings: {e}")
+            self.workers, self.nice, self.cpus = 0, DEFAULT_ENCODER_NICE, set()
+        # leave a CPU to the plugin's threads and Klipper
+        self.workers = min(self.workers, max((os.cpu_count() or 1) - 1, 0))
+
+    def start_pool(self):
+        """Starts the worker pool if it is enabled and not already running."""
+        if self.pool is not None or self.workers <= 0 or shared_memory is None:
+            return self.pool
+        try:
+            methods = multiprocessing.get_all_start_methods()
+            # forkserver avoids forking the plugin's threads into the workers
+            context = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else None
+            )
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=init_worker,
+                initargs=(self.nice, self.cpus),
+            )
+            self._logger.info(
+                f"Image encoder pool started with {self.workers} workers, "
+                f"nice {self.nice}, CPUs {sorted(self.cpus) or 'any'}"
+            )
+        except Exception as e:
+            self._logger.error(f"Failed to start image encoder pool: {e}")
+            self.workers = 0
+            self.pool = None
+        return self.pool
+
+    def encode(
+        self, frame, quality=None, passthrough=False, settings=None, scale=None
+    ):
+        """
+        Encodes a camera frame for upload.
+
+        Args:
+            frame (FrameBuffer or bytes-like): The JPEG frame from the camera.
+            quality (int): The encoder quality, or None for the
+                `image_quality` setting.
+            passthrough (bool): Whether to send the camera's JPEG as it is,
+                whatever the encoding and ROI settings.
+            settings (Mapping): The settings of the frame's camera, or None
+                for the plugin settings.
+            scale (float): The fraction of the full frame size to encode at,
+                or None for full size. Only png frames are scaled.
+
+        Returns:
+            EncodedImage: The encoded frame. For passthrough encoding its data
+                is a view of `frame`, only valid until the frame is reused.
+        """
+        return self.submit(frame, quality, passthrough, settings, scale).result()
+
+    def submit(
+        self, frame, quality=None, passthrough=False, settings=None, scale=None
+    ):
+        """
+        Starts encoding a camera frame, so several frames, e.g. one per
+        camera, can be encoded by the workers at once.
+
+        Takes the same arguments as `encode`. The frame must not be reused
+        until the result has been collected.
+
+        Returns:
+            PendingEncode: The encoding, whose result() is the EncodedImage.
+        """
+        if isinstance(frame, FrameBuffer):
+            image, name = frame.view(), frame.name
+        else:
+            image, name = memoryview(frame), None
+
+        if settings is None:
+            settings = self._settings
+        if quality is not None:
+            settings = dict(settings, image_quality=quality)
+        if scale is not None:
+            settings = dict(settings, image_scale=scale)
+        if passthrough:
+            settings = dict(settings, image_encoding="passthrough", roi_enabled=False)
+        pool = None
+        if requires_decode(settings):
+            pool = self.start_pool()
+        if pool is None:
+            encoded = encode_image(image, settings)
+            return PendingEncode(self, image, settings, encoded=encoded)
+
+        block = None
+        if name is None:
+            block = shared_memory.SharedMemory(create=True, size=max(len(image), 1))
+            block.buf[: len(image)] = image
+            name = block.name
+        try:
+            future = pool.submit(encode_shared, name, len(image), dict(settings))
+        except (BrokenProcessPool, RuntimeError) as e:
+            self._logger.error(f"Image encoder pool broke, restarting: {e}")
+            self.pool = None
+            if block is not None:
+                block.close()
+                block.unlink()
+            encoded = encode_image(image, settings)
+            return PendingEncode(self, image, settings, encoded=encoded)
+        return PendingEncode(self, image, settings, future=future, block=block)
+
+    def shutdown(self):
+        """Stops the worker pool."""
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+
+class PendingEncode:
+    """
+    A frame being encoded by `ImageEncoder.submit`, or already encoded in
+    the calling thread.
+    """
+
+    def __init__(
+        self, encoder, image, settings, encoded=None, future=None, block=None
+    ):
+        self.encoder = encoder
+        self.image = image
+        self.settings = settings
+        self.encoded = encoded
+        self.future = future
+        self.block = block
+
+    def result(self):
+        """
+        Waits for the encoded frame, encoding it in the calling thread if
+        the worker pool broke meanwhile.
+
+        Returns:
+            EncodedImage: The encoded frame.
+        """
+        if self.future is None:
+            return self.encoded
+        try:
+            self.encoded = self.future.result()
+        except BrokenProcessPool as e:
+            self.encoder._logger.error(f"Image encoder pool broke, restarting: {e}")
+            self.encoder.pool = None
+            self.encoded = encode_image(self.image, self.settings)
+        finally:
+            self.future = None
+            if self.block is not None:
+                self.block.close()
+                self.block.unlink()
+                self.block = None
+        return self.encoded
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from .utils import MATTA_TMP_DATA_DIR
+
+HASH_STORE_PATH = os.path.join(MATTA_TMP_DATA_DIR, "gcode_hashes.json")
+HASH_CHUNK_SIZE = 1024 * 1024
+MAX_CONFIRMED_HASHES = 1000
+MAX_FILE_HASHES = 1000
+# Response header with which the backend advertises starting jobs by G-code
+# hash, and with the value HASH_START_KNOWN accepts a hash-only start
+HASH_START_HEADER = "X-Gcode-Hash-Start"
+HASH_START_KNOWN = "known"
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Computes the SHA-256 of a file, streaming it in fixed size chunks.
+
+    Args:
+        path (str): The file path.
+        chunk_size (int): The read size in bytes.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as file:
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+
+def trim(entries, limit):
+    """Drops the least recently used entries of a {key: [..., used]} dict."""
+    if len(entries) > limit:
+        for key in sorted(entries, key=lambda k: entries[k][-1])[: len(entries) - limit]:
+            del entries[key]
+
+
+class GcodeHashStore:
+    """
+    A local record of the G-code files the Matta backend already holds.
+
+    Files are identified by the SHA-256 of their content. Hashes are cached
+    against each file's path, size and modification time, so a file printed
+    again is not re-read, and a hash is only marked as confirmed once the
+    backend has accepted a full upload of it.
+
+    Jobs are only started by hash once the backend has advertised it, with
+    a `X-Gcode-Hash-Start` header on any response (see `update`). This is
+    kept in memory, so the first job after a restart uploads its file.
+
+    The record is a small JSON file, rewritten atomically when it changes.
+    """
+
+    def __init__(self, logger, path=HASH_STORE_PATH):
+        self._logger = logger
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}  # path: [size, mtime_ns, sha256, last used]
+        self.confirmed = {}  # sha256: [last used]
+        self.server_support = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as store:
+                record = json.load(store)
+            self.files = dict(record.get("files", {}))
+            self.confirmed = dict(record.get("confirmed", {}))
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError) as e:
+            self._logger.warning(f"Ignoring corrupt G-code hash record: {e}")
+
+    def save(self):
+        trim(self.files, MAX_FILE_HASHES)
+        trim(self.confirmed, MAX_CONFIRMED_HASHES)
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w") as store:
+                json.dump({"files": self.files, "confirmed": self.confirmed}, store)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self._logger.error(f"Failed to save G-code hash record: {e}")
+
+    def get_hash(self, path):
+        """
+        Returns the SHA-256 of a G-code file, hashing it only if it changed.
+
+        Args:
+            path (str): The G-code file path.
+
+        Returns:
+            str: The hex digest, or None if the file cannot be read.
+        """
+        try:
+            stat = os.stat(path)
+            with self.lock:
+                cached = self.files.get(path)
+            if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+                return cached[2]
+            digest = hash_file(path)
+        except OSError as e:
+            self._logger.error(f"Failed to hash G-code file: {e}")
+            return None
+        with self.lock:
+            self.files[path] = [stat.st_size, stat.st_mtime_ns, digest, time.time()]
+            self.save()
+        return digest
+
+    def update(self, resp, *args, **kwargs):
+        """
+        Records whether the backend starts jobs by hash, from a response's
+        headers. Usable as a `requests` response hook.
+        """
+        if resp.headers.get(HASH_START_HEADER) is not None:
+            self.server_support = True
+
+    @staticmethod
+    def is_known(resp):
+        """Checks whether a response explicitly accepts a hash-only start."""
+        return (
+            resp.ok
+            and resp.headers.get(HASH_START_HEADER, "").lower() == HASH_START_KNOWN
+        )
+
+    def is_confirmed(self, digest):
+        """Checks whether the backend has confirmed holding a G-code file."""
+        with self.lock:
+            return digest is not None and digest in self.confirmed
+
+    def confirm(self, digest):
+        """Records that the backend holds a G-code file."""
+        if digest is None:
+            return
+        with self.lock:
+            self.confirmed[digest] = [time.time()]
+            self.save()
+
+    def forget(self, digest):
+        """Records that the backend no longer knows a G-code file."""
+        with self.lock:
+            if self.confirmed.pop(digest, None) is not None:
+                self.save()
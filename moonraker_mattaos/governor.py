@@ -0,0 +1,213 @@
+import time
+import threading
+import psutil
+
+LEVELS = ("full", "reduced", "minimal")
+FULL, REDUCED, MINIMAL = range(len(LEVELS))
+INTERVAL_FACTORS = (1, 2, 4)  # sampling interval multiplier per level
+
+DEFAULT_MAX_CPU = 80.0  # percent
+DEFAULT_MAX_MEMORY = 90.0  # percent
+DEFAULT_MAX_TEMPERATURE = 75.0  # degrees Celsius
+CPU_MARGIN = 15.0  # percentage points above the limit for the minimal level
+MEMORY_MARGIN = 5.0  # percentage points above the limit for the minimal level
+TEMPERATURE_MARGIN = 5.0  # degrees above the limit for the minimal level
+CPU_SMOOTHING = 0.5  # EWMA weight of the newest CPU load sample
+CHECK_INTERVAL = 2.0  # seconds between checks
+RECOVERY_CHECKS = 5  # calm checks in a row before stepping up a level
+
+# Raspberry Pi firmware throttling flags (as `vcgencmd get_throttled`)
+THROTTLED_PATH = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+UNDER_VOLTAGE = 0x1
+FREQUENCY_CAPPED = 0x2
+THROTTLED = 0x4
+SOFT_TEMPERATURE_LIMIT = 0x8
+
+
+def metric_level(value, limit, margin):
+    """Returns the work level a measurement calls for."""
+    if value is None:
+        return FULL
+    if value >= limit + margin:
+        return MINIMAL
+    if value >= limit:
+        return REDUCED
+    return FULL
+
+
+def read_temperature():
+    """
+    Reads the hottest temperature sensor, usually the SoC's.
+
+    Returns:
+        float: The temperature in degrees Celsius, or None if unavailable.
+    """
+    if not hasattr(psutil, "sensors_temperatures"):
+        return None
+    try:
+        sensors = psutil.sensors_temperatures()
+    except Exception:
+        return None
+    readings = [
+        entry.current for entries in sensors.values() for entry in entries
+        if entry.current is not None
+    ]
+    return max(readings) if readings else None
+
+
+def read_throttled():
+    """
+    Reads the Raspberry Pi firmware throttling flags.
+
+    Returns:
+        int: The flags, or None if not running on a Raspberry Pi.
+    """
+    try:
+        with open(THROTTLED_PATH) as file:
+            return int(file.read().strip(), 16)
+    except (OSError, ValueError):
+        return None
+
+
+class ResourceGovernor:
+    """
+    Moves the plugin between full, reduced and minimal work levels, so it
+    does not starve Klipper of CPU on a small host.
+
+    A background thread checks the CPU load, memory use, SoC temperature and
+    the Raspberry Pi throttling flags every CHECK_INTERVAL. The level drops
+    as soon as a check calls for it, and steps back up one level at a time
+    after RECOVERY_CHECKS calm checks in a row.
+
+    At the reduced level frames are sampled half as often and the G-code
+    analysis is deferred. At the minimal level frames are sampled a quarter
+    as often and uploaded as the camera's JPEG, without the re-encoding,
+    quality gate or change detection.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self.enabled = bool(settings.get("resource_governor", False))
+        try:
+            self.max_cpu = float(settings.get("governor_max_cpu", DEFAULT_MAX_CPU))
+            self.max_memory = float(
+                settings.get("governor_max_memory", DEFAULT_MAX_MEMORY)
+            )
+            self.max_temperature = float(
+                settings.get("governor_max_temperature", DEFAULT_MAX_TEMPERATURE)
+            )
+        except (TypeError, ValueError):
+            self.max_cpu = DEFAULT_MAX_CPU
+            self.max_memory = DEFAULT_MAX_MEMORY
+            self.max_temperature = DEFAULT_MAX_TEMPERATURE
+        self.level = FULL
+        self.calm_checks = 0
+        self.reason = None
+        self.cpu = None
+        self.memory = None
+        self.temperature = None
+        self.throttled = None
+        self.thread = None
+
+    def start(self):
+        """Starts the governor thread if the governor is enabled."""
+        if not self.enabled or self.thread is not None:
+            return
+        psutil.cpu_percent(interval=None)  # the first call only sets a baseline
+        self.thread = threading.Thread(target=self.governor_thread_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def governor_thread_loop(self):
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            try:
+                self.check()
+            except Exception as e:
+                self._logger.error(f"Resource governor check failed: {e}")
+
+    @property
+    def level_name(self):
+        return LEVELS[self.level]
+
+    @property
+    def interval_factor(self):
+        """The factor to stretch the sampling interval by."""
+        return INTERVAL_FACTORS[self.level]
+
+    @property
+    def defer_analysis(self):
+        return self.level > FULL
+
+    @property
+    def skip_encoding(self):
+        return self.level == MINIMAL
+
+    def measure(self):
+        """Samples the host's resources."""
+        cpu = psutil.cpu_percent(interval=None)
+        if self.cpu is None:
+            self.cpu = cpu
+        else:
+            self.cpu += CPU_SMOOTHING * (cpu - self.cpu)
+        self.memory = psutil.virtual_memory().percent
+        self.temperature = read_temperature()
+        self.throttled = read_throttled()
+
+    def target_level(self):
+        """
+        Returns the work level the last measurements call for, and why.
+        """
+        levels = {
+            "cpu": metric_level(self.cpu, self.max_cpu, CPU_MARGIN),
+            "memory": metric_level(self.memory, self.max_memory, MEMORY_MARGIN),
+            "temperature": metric_level(
+                self.temperature, self.max_temperature, TEMPERATURE_MARGIN
+            ),
+            "throttled": FULL,
+        }
+        if self.throttled is not None:
+            if self.throttled & (UNDER_VOLTAGE | THROTTLED):
+                levels["throttled"] = MINIMAL
+            elif self.throttled & (FREQUENCY_CAPPED | SOFT_TEMPERATURE_LIMIT):
+                levels["throttled"] = REDUCED
+        reason = max(levels, key=levels.get)
+        return levels[reason], reason if levels[reason] > FULL else None
+
+    def check(self):
+        """Measures the host and moves to the work level it calls for."""
+        self.measure()
+        target, reason = self.target_level()
+        level = self.level
+        if target > self.level:
+            level = target
+            self.calm_checks = 0
+        elif target < self.level:
+            self.calm_checks += 1
+            if self.calm_checks >= RECOVERY_CHECKS:
+                level = self.level - 1
+                self.calm_checks = 0
+        else:
+            self.calm_checks = 0
+        if target > FULL:
+            self.reason = reason
+        if level != self.level:
+            self._logger.info(
+                f"Work level {LEVELS[self.level]} -> {LEVELS[level]} "
+                f"({self.get_stats()})"
+            )
+            self.level = level
+            if level == FULL:
+                self.reason = None
+
+    def get_stats(self):
+        """Returns the governor state for logging and reporting."""
+        return {
+            "enabled": self.enabled,
+            "level": self.level_name,
+            "reason": self.reason,
+            "cpu": round(self.cpu, 1) if self.cpu is not None else None,
+            "memory": self.memory,
+            "temperature": self.temperature,
+            "throttled": hex(self.throttled) if self.throttled is not None else None,
+        }
@@ -0,0 +1,381 @@
+import io
+import shutil
+import subprocess
+from dataclasses import dataclass
+from typing import Dict
+from PIL import Image
+
+# Supported values for the `image_encoding` setting
+IMAGE_ENCODINGS = ("passthrough", "lossless", "jpeg", "webp", "png")
+DEFAULT_IMAGE_ENCODING = "png"  # as uploaded before the other encodings
+DEFAULT_IMAGE_QUALITY = 90
+DEFAULT_ROI_SIZE = 480
+
+MIME_TYPES = {
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "png": "image/png",
+}
+
+FILE_EXTENSIONS = {
+    "jpeg": "jpg",
+    "webp": "webp",
+    "png": "png",
+}
+
+# jpegtran arguments for each combined PIL transpose method.
+# Note PIL rotates counter-clockwise while jpegtran rotates clockwise.
+JPEGTRAN_ARGS = {
+    Image.FLIP_LEFT_RIGHT: ["-flip", "horizontal"],
+    Image.FLIP_TOP_BOTTOM: ["-flip", "vertical"],
+    Image.ROTATE_90: ["-rotate", "270"],
+    Image.ROTATE_180: ["-rotate", "180"],
+    Image.ROTATE_270: ["-rotate", "90"],
+    Image.TRANSPOSE: ["-transpose"],
+    Image.TRANSVERSE: ["-transverse"],
+}
+
+# Transposes that swap the width and height of the image
+SWAPPING_METHODS = (
+    Image.ROTATE_90,
+    Image.ROTATE_270,
+    Image.TRANSPOSE,
+    Image.TRANSVERSE,
+)
+
+INVERSE_METHODS = {
+    Image.ROTATE_90: Image.ROTATE_270,
+    Image.ROTATE_270: Image.ROTATE_90,
+}
+
+
+@dataclass
+class EncodedImage:
+    data: bytes
+    extension: str
+    mime_type: str
+    transforms_applied: bool
+    roi: Dict[str, float] = None
+
+
+def get_transpose_method(flip_h, flip_v, rotate):
+    """
+    Combines the webcam flip and rotate settings into a single transpose.
+
+    The transforms are applied in the order flip horizontally, flip vertically,
+    then rotate 90 degrees counter-clockwise, matching the original chain of
+    transposes.
+
+    Args:
+        flip_h (bool): Flip the image horizontally.
+        flip_v (bool): Flip the image vertically.
+        rotate (bool): Rotate the image 90 degrees counter-clockwise.
+
+    Returns:
+        int: The PIL transpose method, or None if no transform is needed.
+    """
+    methods = {
+        (False, False, False): None,
+        (True, False, False): Image.FLIP_LEFT_RIGHT,
+        (False, True, False): Image.FLIP_TOP_BOTTOM,
+        (True, True, False): Image.ROTATE_180,
+        (False, False, True): Image.ROTATE_90,
+        (True, False, True): Image.TRANSPOSE,
+        (False, True, True): Image.TRANSVERSE,
+        (True, True, True): Image.ROTATE_270,
+    }
+    return methods[(bool(flip_h), bool(flip_v), bool(rotate))]
+
+
+def get_image_encoding(settings):
+    """
+    Gets the configured image encoding policy, falling back to the default.
+
+    Args:
+        settings (dict): The plugin settings.
+
+    Returns:
+        tuple: The encoding name and the encoder quality.
+    """
+    encoding = str(settings.get("image_encoding", DEFAULT_IMAGE_ENCODING)).lower()
+    if encoding not in IMAGE_ENCODINGS:
+        encoding = DEFAULT_IMAGE_ENCODING
+    try:
+        quality = int(settings.get("image_quality", DEFAULT_IMAGE_QUALITY))
+    except (TypeError, ValueError):
+        quality = DEFAULT_IMAGE_QUALITY
+    return encoding, min(max(quality, 1), 100)
+
+
+def jpegtran_transpose(image, method):
+    """
+    Applies a lossless transpose to JPEG bytes using jpegtran.
+
+    Args:
+        image (bytes): The JPEG image.
+        method (int): The PIL transpose method.
+
+    Returns:
+        bytes: The transformed JPEG, or None if jpegtran is unavailable or the
+            transform cannot be applied losslessly.
+    """
+    jpegtran = shutil.which("jpegtran")
+    if jpegtran is None:
+        return None
+    args = [jpegtran, "-copy", "all", "-perfect"] + JPEGTRAN_ARGS[method]
+    try:
+        result = subprocess.run(
+            args, input=image, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    except OSError:
+        return None
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return result.stdout
+
+
+def get_roi_settings(settings):
+    """
+    Gets the nozzle region of interest settings.
+
+    Args:
+        settings (dict): The plugin settings.
+
+    Returns:
+        tuple: Whether ROI cropping is enabled, the ROI window size and the
+            maximum output size (0 to disable downscaling).
+    """
+    enabled = bool(settings.get("roi_enabled", False))
+    try:
+        size = int(settings.get("roi_size", DEFAULT_ROI_SIZE))
+        output_size = int(settings.get("roi_output_size", 0))
+    except (TypeError, ValueError):
+        size, output_size = DEFAULT_ROI_SIZE, 0
+    return enabled and size > 0, max(size, 1), max(output_size, 0)
+
+
+def transpose_size(size, method):
+    """Returns the size of an image of `size` after the transpose `method`."""
+    if method in SWAPPING_METHODS:
+        return size[1], size[0]
+    return size
+
+
+def transpose_box(box, size, method):
+    """
+    Maps a box through a transpose.
+
+    Args:
+        box (tuple): The (left, upper, right, lower) box in the source image.
+        size (tuple): The (width, height) of the source image.
+        method (int): The PIL transpose method, or None.
+
+    Returns:
+        tuple: The box in the transposed image.
+    """
+    if method is None:
+        return box
+    width, height = size
+
+    def point(x, y):
+        if method == Image.FLIP_LEFT_RIGHT:
+            return width - x, y
+        if method == Image.FLIP_TOP_BOTTOM:
+            return x, height - y
+        if method == Image.ROTATE_180:
+            return width - x, height - y
+        if method == Image.ROTATE_90:
+            return y, width - x
+        if method == Image.ROTATE_270:
+            return height - y, x
+        if method == Image.TRANSPOSE:
+            return y, x
+        return height - y, width - x  # TRANSVERSE
+
+    x0, y0 = point(box[0], box[1])
+    x1, y1 = point(box[2], box[3])
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def get_roi_box(nozzle_x, nozzle_y, roi_size, size):
+    """
+    Gets a square window centred on the nozzle tip, clamped to the image.
+
+    Args:
+        nozzle_x (int): The nozzle tip x coordinate.
+        nozzle_y (int): The nozzle tip y coordinate.
+        roi_size (int): The side length of the window.
+        size (tuple): The (width, height) of the image.
+
+    Returns:
+        tuple: The (left, upper, right, lower) box.
+    """
+    width, height = size
+    roi_width = min(roi_size, width)
+    roi_height = min(roi_size, height)
+    left = min(max(nozzle_x - roi_width // 2, 0), width - roi_width)
+    upper = min(max(nozzle_y - roi_height // 2, 0), height - roi_height)
+    return left, upper, left + roi_width, upper + roi_height
+
+
+def get_raw_roi_box(raw_size, settings, method, roi_size):
+    """
+    Gets the nozzle window of a raw camera frame.
+
+    Args:
+        raw_size (tuple): The (width, height) of the raw frame.
+        settings (dict): The plugin settings.
+        method (int): The combined PIL transpose method, or None.
+        roi_size (int): The side length of the window.
+
+    Returns:
+        tuple: The window in transformed and in raw frame coordinates.
+    """
+    size = transpose_size(raw_size, method)
+    box = get_roi_box(
+        int(settings["nozzle_tip_coords_x"]),
+        int(settings["nozzle_tip_coords_y"]),
+        roi_size,
+        size,
+    )
+    return box, transpose_box(box, size, INVERSE_METHODS.get(method, method))
+
+
+def crop_roi(pil_image, settings, method, roi_size, output_size):
+    """
+    Crops the nozzle region of interest out of a camera frame.
+
+    The nozzle tip coordinates are in the transformed (flipped/rotated) frame,
+    so the window is mapped back into the raw frame and cropped before the
+    transpose. When an output size is set, the JPEG is decoded at a reduced
+    scale with PIL's draft mode so the full resolution frame is never decoded.
+
+    Args:
+        pil_image (PIL.Image.Image): The lazily loaded camera frame.
+        settings (dict): The plugin settings.
+        method (int): The combined PIL transpose method, or None.
+        roi_size (int): The side length of the window in full resolution pixels.
+        output_size (int): The maximum side length of the output, or 0.
+
+    Returns:
+        tuple: The cropped and transposed image, and the ROI metadata in
+            full resolution transformed coordinates.
+    """
+    raw_size = pil_image.size
+    box, raw_box = get_raw_roi_box(raw_size, settings, method, roi_size)
+
+    scale = 1.0
+    if output_size and roi_size > output_size:
+        # smallest decode size that keeps the window at least output_size wide
+        pil_image.draft(
+            "RGB",
+            (
+                -(-raw_size[0] * output_size // roi_size),
+                -(-raw_size[1] * output_size // roi_size),
+            ),
+        )
+        scale = raw_size[0] / pil_image.size[0]
+
+    pil_image = pil_image.crop(tuple(round(edge / scale) for edge in raw_box))
+    if method is not None:
+        pil_image = pil_image.transpose(method)
+    if output_size and max(pil_image.size) > output_size:
+        pil_image.thumbnail((output_size, output_size), Image.BILINEAR)
+
+    roi = {
+        "x": box[0],
+        "y": box[1],
+        "width": box[2] - box[0],
+        "height": box[3] - box[1],
+        "scale": pil_image.size[0] / (box[2] - box[0]),
+    }
+    return pil_image, roi
+
+
+def requires_decode(settings):
+    """Checks whether frames are decoded under the current settings."""
+    encoding, _ = get_image_encoding(settings)
+    roi_enabled, _, _ = get_roi_settings(settings)
+    return encoding != "passthrough" or roi_enabled
+
+
+def encode_image(image, settings):
+    """
+    Encodes a camera frame for upload according to the image encoding policy.
+
+    Policies:
+        passthrough: send the original JPEG, transforms are left to the server.
+        lossless: apply the transforms losslessly with jpegtran, falling back
+            to a JPEG re-encode if jpegtran is unavailable.
+        jpeg / webp / png: decode, transpose and re-encode.
+
+    When ROI cropping is enabled the frame always has to be decoded, so the
+    passthrough and lossless policies fall back to a JPEG re-encode.
+
+    An `image_scale` below 1, set by the upload rate control, downscales
+    full png frames. The JPEG is decoded at a reduced size where it can be.
+
+    Args:
+        image (bytes-like): The JPEG frame from the camera.
+        settings (dict): The plugin settings.
+
+    Returns:
+        EncodedImage: The encoded frame.
+    """
+    encoding, quality = get_image_encoding(settings)
+    roi_enabled, roi_size, output_size = get_roi_settings(settings)
+    method = get_transpose_method(
+        settings["flip_h"], settings["flip_v"], settings["rotate"]
+    )
+
+    if encoding == "passthrough" and not roi_enabled:
+        return EncodedImage(
+            image, FILE_EXTENSIONS["jpeg"], MIME_TYPES["jpeg"], method is None
+        )
+
+    if encoding == "lossless" and not roi_enabled:
+        transformed = image
+        if method is not None:
+            transformed = jpegtran_transpose(image, method)
+        if transformed is not None:
+            return EncodedImage(
+                transformed, FILE_EXTENSIONS["jpeg"], MIME_TYPES["jpeg"], True
+            )
+
+    if encoding in ("passthrough", "lossless"):
+        encoding = "jpeg"
+
+    pil_image = Image.open(io.BytesIO(image))
+    roi = None
+    if roi_enabled:
+        pil_image, roi = crop_roi(pil_image, settings, method, roi_size, output_size)
+    else:
+        scale = settings.get("image_scale", 1.0)
+        if encoding == "png" and scale < 1:
+            # before the transpose, so draft mode can decode at a reduced size
+            pil_image.thumbnail(
+                (
+                    max(round(pil_image.size[0] * scale), 1),
+                    max(round(pil_image.size[1] * scale), 1),
+                ),
+                Image.BILINEAR,
+            )
+        if method is not None:
+            pil_image = pil_image.transpose(method)
+
+    byte_arr = io.BytesIO()
+    if encoding == "jpeg":
+        if pil_image.mode not in ("RGB", "L"):
+            pil_image = pil_image.convert("RGB")
+        pil_image.save(byte_arr, format="JPEG", quality=quality)
+    elif encoding == "webp":
+        pil_image.save(byte_arr, format="WEBP", quality=quality, method=0)
+    else:
+        pil_image.save(byte_arr, format="PNG")
+    return EncodedImage(
+        byte_arr.getvalue(),
+        FILE_EXTENSIONS[encoding],
+        MIME_TYPES[encoding],
+        True,
+        roi,
+    )
@@ -0,0 +1,222 @@
+import re
+import mmap
+import time
+import array
+import bisect
+
+CAPTURE_TRIGGERS = ("time", "layer")
+DEFAULT_CAPTURE_TRIGGER = "time"
+DEFAULT_BURST_LAYERS = 1
+DEFAULT_BURST_INTERVAL = 0.5  # seconds
+DEFAULT_MAX_GAP = 30.0  # seconds without a frame in layer mode
+RATE_SMOOTHING = 0.3  # EWMA weight of the newest print rate sample
+EXPEDITE_MARGIN = 0.1  # seconds after a predicted layer change to capture
+
+# Layer change comments written by PrusaSlicer/SuperSlicer/OrcaSlicer,
+# Cura and Simplify3D
+LAYER_COMMENT = re.compile(rb"^;[ \t]*(?:LAYER_CHANGE|LAYER:-?\d+|layer[ \t]+\d+)", re.M)
+Z_MOVE = re.compile(rb"^G[01][ \t][^;\n]*?Z(-?\d*\.?\d+)", re.M)
+
+
+def find_layer_offsets(path):
+    """
+    Finds the byte offsets of the layer changes in a G-code file.
+
+    Slicer layer change comments are used when present. Otherwise each move
+    to a new greatest Z height counts as a layer change, which misses
+    layers printed below an earlier Z hop.
+
+    Args:
+        path (str): The G-code file path.
+
+    Returns:
+        list: The ascending byte offsets of the layer change lines.
+    """
+    with open(path, "rb") as file:
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return []
+        try:
+            offsets = [match.start() for match in LAYER_COMMENT.finditer(data)]
+            if offsets:
+                return offsets
+            top = None
+            for match in Z_MOVE.finditer(data):
+                try:
+                    z = float(match.group(1))
+                except ValueError:
+                    continue
+                if top is None or z > top + 1e-6:
+                    top = z
+                    offsets.append(match.start())
+            return offsets
+        finally:
+            data.close()
+
+
+class LayerTrigger:
+    """
+    Decides which samples get a camera frame from the layer changes of the
+    G-code being printed.
+
+    In layer mode a frame is taken when `virtual_sdcard.file_position` has
+    crossed a layer change since the last frame, at least every
+    `layer_max_gap` seconds, and every `layer_burst_interval` seconds
+    during the first `layer_burst_layers` layers. The print rate in bytes per
+    second is tracked so the scheduler can be woken just after the next
+    predicted layer change instead of on its next regular tick.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self.mode = str(settings.get("capture_trigger", DEFAULT_CAPTURE_TRIGGER))
+        if self.mode not in CAPTURE_TRIGGERS:
+            self._logger.error(f"Unknown capture trigger {self.mode}, using time")
+            self.mode = DEFAULT_CAPTURE_TRIGGER
+        try:
+            self.burst_layers = int(
+                settings.get("layer_burst_layers", DEFAULT_BURST_LAYERS)
+            )
+            self.burst_interval = float(
+                settings.get("layer_burst_interval", DEFAULT_BURST_INTERVAL)
+            )
+            self.max_gap = float(settings.get("layer_max_gap", DEFAULT_MAX_GAP))
+        except (TypeError, ValueError):
+            self.burst_layers = DEFAULT_BURST_LAYERS
+            self.burst_interval = DEFAULT_BURST_INTERVAL
+            self.max_gap = DEFAULT_MAX_GAP
+        self.offsets = []
+        self.reset()
+
+    def reset(self):
+        """Forgets the job's layers and progress."""
+        self.offsets = []
+        self.position = None
+        self.position_time = None
+        self.rate = None
+        self.image_layer = None
+        self.image_time = None
+
+    @property
+    def enabled(self):
+        return self.mode == "layer" and len(self.offsets) > 0
+
+    def load(self, path):
+        """Finds the layer changes of the job's G-code file."""
+        self.reset()
+        if self.mode != "layer":
+            return
+        try:
+            start_time = time.monotonic()
+            self.offsets = find_layer_offsets(path)
+            self._logger.info(
+                f"Found {len(self.offsets)} layer changes in "
+                f"{time.monotonic() - start_time:.2f}s"
+            )
+        except OSError as e:
+            self._logger.error(f"Failed to find the G-code's layer changes: {e}")
+
+    def save_index(self, path):
+        """
+        Writes the layer change offsets to a file, so a restarted plugin
+        can reload them instead of scanning the G-code again.
+
+        Returns:
+            str: The index path, or None if there was nothing to write.
+        """
+        if not self.offsets:
+            return None
+        try:
+            with open(path, "wb") as index:
+                array.array("Q", self.offsets).tofile(index)
+        except OSError as e:
+            self._logger.error(f"Failed to save the layer index: {e}")
+            return None
+        return path
+
+    def load_index(self, path):
+        """Reads layer change offsets written by `save_index`."""
+        self.reset()
+        if self.mode != "layer" or not path:
+            return
+        offsets = array.array("Q")
+        try:
+            with open(path, "rb") as index:
+                offsets.frombytes(index.read())
+        except (OSError, ValueError) as e:
+            self._logger.error(f"Failed to load the layer index: {e}")
+            return
+        self.offsets = offsets.tolist()
+
+    def layer_at(self, position):
+        """Returns the number of layer changes at or before a file position."""
+        return bisect.bisect_right(self.offsets, position)
+
+    def predicted_position(self, now):
+        if self.position is None:
+            return None
+        if self.rate is None:
+            return self.position
+        return self.position + self.rate * (now - self.position_time)
+
+    def in_burst(self):
+        """Checks whether the print is in the first `layer_burst_layers` layers."""
+        if self.position is None:
+            return False
+        return 0 < self.layer_at(self.position) <= self.burst_layers
+
+    def wants_image(self, now=None):
+        """Checks whether the sample about to be taken should get a frame."""
+        if not self.enabled or self.image_time is None:
+            return True
+        now = time.monotonic() if now is None else now
+        if now - self.image_time >= self.max_gap or self.in_burst():
+            return True
+        position = self.predicted_position(now)
+        return position is not None and self.layer_at(position) > self.image_layer
+
+    def update(self, position, now=None):
+        """
+        Records the file position of a sample.
+
+        Args:
+            position (int): `virtual_sdcard.file_position` in bytes.
+            now (float): The monotonic time of the sample.
+        """
+        now = time.monotonic() if now is None else now
+        if self.position is not None and position > self.position:
+            rate = (position - self.position) / max(now - self.position_time, 1e-3)
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate += RATE_SMOOTHING * (rate - self.rate)
+        self.position = position
+        self.position_time = now
+
+    def image_taken(self, now=None):
+        """Records that the last sample got a frame."""
+        self.image_time = time.monotonic() if now is None else now
+        if self.position is not None:
+            self.image_layer = self.layer_at(self.position)
+
+    def next_capture_delay(self, now=None):
+        """
+        Returns how long until a sample should be taken for the layers, or
+        None to wait for the next regular tick.
+        """
+        if not self.enabled or self.position is None:
+            return None
+        now = time.monotonic() if now is None else now
+        if self.in_burst():
+            return self.burst_interval
+        index = self.layer_at(self.position)
+        if self.rate is None or self.rate <= 0 or index >= len(self.offsets):
+            return None
+        delay = (self.offsets[index] - self.position) / self.rate - (
+            now - self.position_time
+        )
+        if delay < 0:
+            # the rate was overestimated, leave it to the regular ticks
+            return None
+        return delay + EXPEDITE_MARGIN
@@ -6,12 +6,18 @@ from configparser import ConfigParser
 import time
 import threading
 import os
+import signal
+import sys
 from logger import setup_logging
 import json
 
 from moonraker_mattaos.matta import MattaCore
 from moonraker_mattaos.printer import MattaPrinter
-from moonraker_mattaos.utils import init_sentry, update_auth_token
+from moonraker_mattaos.utils import (
+    init_sentry,
+    update_auth_token,
+    SAMPLING_TIMEOUT,
+)
 
 # ---------------------------------------------------
 # Set-up
@@ -53,6 +59,15 @@ class mattaosPlugin:
         # Default settings
         self.auth_token = self.config.get("mattaos_settings", "auth_token")
         self.snapshot_url = self.config.get("mattaos_settings", "camera_snapshot_url")
+        self.camera_source = self.config.get(
+            "mattaos_settings", "camera_source", fallback="snapshot"
+        )
+        self.stream_url = self.config.get(
+            "mattaos_settings", "camera_stream_url", fallback=""
+        )
+        self.frame_max_age = self.config.getfloat(
+            "mattaos_settings", "frame_max_age", fallback=0.5
+        )
         self.default_z_offset = 0.0
         self.nozzle_tip_coords_x = self.config.get(
             "mattaos_settings", "nozzle_tip_coords_x"
@@ -70,6 +85,146 @@ class mattaosPlugin:
         )
         self.rotate = self.config.getboolean("mattaos_settings", "rotate_webcam_90CC")
         self.cherry_pick_cmds = self.config.get("mattaos_settings", "cherry_pick_cmds")
+        self.image_encoding = self.config.get(
+            "mattaos_settings", "image_encoding", fallback="png"
+        )
+        self.image_quality = self.config.getint(
+            "mattaos_settings", "image_quality", fallback=90
+        )
+        self.roi_enabled = self.config.getboolean(
+            "mattaos_settings", "roi_enabled", fallback=False
+        )
+        self.roi_size = self.config.getint("mattaos_settings", "roi_size", fallback=480)
+        self.roi_output_size = self.config.getint(
+            "mattaos_settings", "roi_output_size", fallback=0
+        )
+        self.encoder_workers = self.config.getint(
+            "mattaos_settings", "encoder_workers", fallback=2
+        )
+        self.encoder_nice = self.config.getint(
+            "mattaos_settings", "encoder_nice", fallback=10
+        )
+        self.encoder_cpu_affinity = self.config.get(
+            "mattaos_settings", "encoder_cpu_affinity", fallback=""
+        )
+        self.spool_max_mb = self.config.getfloat(
+            "mattaos_settings", "spool_max_mb", fallback=200
+        )
+        self.sampling_min_interval = self.config.getfloat(
+            "mattaos_settings", "sampling_min_interval", fallback=SAMPLING_TIMEOUT
+        )
+        self.sampling_max_interval = self.config.getfloat(
+            "mattaos_settings", "sampling_max_interval", fallback=5.0
+        )
+        self.print_log_compression = self.config.get(
+            "mattaos_settings", "print_log_compression", fallback="zlib"
+        )
+        self.upload_compression = self.config.get(
+            "mattaos_settings", "upload_compression", fallback="auto"
+        )
+        self.change_detection = self.config.getboolean(
+            "mattaos_settings", "change_detection", fallback=False
+        )
+        self.change_threshold = self.config.getfloat(
+            "mattaos_settings", "change_threshold", fallback=0.02
+        )
+        self.change_keyframe_interval = self.config.getint(
+            "mattaos_settings", "change_keyframe_interval", fallback=10
+        )
+        self.quality_gate = self.config.getboolean(
+            "mattaos_settings", "quality_gate", fallback=False
+        )
+        self.quality_min_sharpness = self.config.getfloat(
+            "mattaos_settings", "quality_min_sharpness", fallback=5.0
+        )
+        self.quality_min_sharpness_ratio = self.config.getfloat(
+            "mattaos_settings", "quality_min_sharpness_ratio", fallback=0.3
+        )
+        self.quality_min_luminance = self.config.getfloat(
+            "mattaos_settings", "quality_min_luminance", fallback=20.0
+        )
+        self.quality_max_luminance = self.config.getfloat(
+            "mattaos_settings", "quality_max_luminance", fallback=235.0
+        )
+        self.quality_max_clipped = self.config.getfloat(
+            "mattaos_settings", "quality_max_clipped", fallback=0.3
+        )
+        self.quality_retries = self.config.getint(
+            "mattaos_settings", "quality_retries", fallback=1
+        )
+        self.image_batch_max = self.config.getint(
+            "mattaos_settings", "image_batch_max", fallback=8
+        )
+        self.image_batch_window = self.config.getfloat(
+            "mattaos_settings", "image_batch_window", fallback=10.0
+        )
+        self.upload_rate_control = self.config.getboolean(
+            "mattaos_settings", "upload_rate_control", fallback=False
+        )
+        self.upload_min_quality = self.config.getint(
+            "mattaos_settings", "upload_min_quality", fallback=40
+        )
+        self.upload_adaptive_scale = self.config.getboolean(
+            "mattaos_settings", "upload_adaptive_scale", fallback=False
+        )
+        self.upload_min_scale = self.config.getfloat(
+            "mattaos_settings", "upload_min_scale", fallback=0.5
+        )
+        self.storage_quota_mb = self.config.getfloat(
+            "mattaos_settings", "storage_quota_mb", fallback=1024.0
+        )
+        self.checkpoint_interval = self.config.getfloat(
+            "mattaos_settings", "checkpoint_interval", fallback=30.0
+        )
+        self.resource_governor = self.config.getboolean(
+            "mattaos_settings", "resource_governor", fallback=False
+        )
+        self.governor_max_cpu = self.config.getfloat(
+            "mattaos_settings", "governor_max_cpu", fallback=80.0
+        )
+        self.governor_max_memory = self.config.getfloat(
+            "mattaos_settings", "governor_max_memory", fallback=90.0
+        )
+        self.governor_max_temperature = self.config.getfloat(
+            "mattaos_settings", "governor_max_temperature", fallback=75.0
+        )
+        self.capture_trigger = self.config.get(
+            "mattaos_settings", "capture_trigger", fallback="time"
+        )
+        self.layer_burst_layers = self.config.getint(
+            "mattaos_settings", "layer_burst_layers", fallback=1
+        )
+        self.layer_burst_interval = self.config.getfloat(
+            "mattaos_settings", "layer_burst_interval", fallback=0.5
+        )
+        self.layer_max_gap = self.config.getfloat(
+            "mattaos_settings", "layer_max_gap", fallback=30.0
+        )
+        self.telemetry_rate = self.config.getfloat(
+            "mattaos_settings", "telemetry_rate", fallback=0.0
+        )
+        self.telemetry_window = self.config.getfloat(
+            "mattaos_settings", "telemetry_window", fallback=10.0
+        )
+        self.telemetry_batch_interval = self.config.getfloat(
+            "mattaos_settings", "telemetry_batch_interval", fallback=0.0
+        )
+        self.telemetry_backfill = self.config.getboolean(
+            "mattaos_settings", "telemetry_backfill", fallback=False
+        )
+        self.backfill_min_gap = self.config.getfloat(
+            "mattaos_settings", "backfill_min_gap", fallback=30.0
+        )
+        self.image_transport = self.config.get(
+            "mattaos_settings", "image_transport", fallback="http"
+        )
+        self.ws_frame_window = self.config.getint(
+            "mattaos_settings", "ws_frame_window", fallback=4
+        )
+        self.camera_name = self.config.get(
+            "mattaos_settings", "camera_name", fallback="main"
+        )
+        self.cameras = self.get_camera_definitions()
 
         self._settings = self.get_settings_defaults()
 
@@ -99,6 +254,9 @@ class mattaosPlugin:
         return {
             "auth_token": self.auth_token,
             "snapshot_url": self.snapshot_url,
+            "camera_source": self.camera_source,
+            "stream_url": self.stream_url,
+            "frame_max_age": self.frame_max_age,
             "default_z_offset": self.default_z_offset,
             "nozzle_tip_coords_x": self.nozzle_tip_coords_x,
             "nozzle_tip_coords_y": self.nozzle_tip_coords_y,
@@ -109,7 +267,92 @@ class mattaosPlugin:
             "flip_v": self.flip_v,
             "rotate": self.rotate,
             "cherry_pick_cmds": self.cherry_pick_cmds,
+            "image_encoding": self.image_encoding,
+            "image_quality": self.image_quality,
+            "roi_enabled": self.roi_enabled,
+            "roi_size": self.roi_size,
+            "roi_output_size": self.roi_output_size,
+            "encoder_workers": self.encoder_workers,
+            "encoder_nice": self.encoder_nice,
+            "encoder_cpu_affinity": self.encoder_cpu_affinity,
+            "spool_max_mb": self.spool_max_mb,
+            "sampling_min_interval": self.sampling_min_interval,
+            "sampling_max_interval": self.sampling_max_interval,
+            "print_log_compression": self.print_log_compression,
+            "upload_compression": self.upload_compression,
+            "change_detection": self.change_detection,
+            "change_threshold": self.change_threshold,
+            "change_keyframe_interval": self.change_keyframe_interval,
+            "quality_gate": self.quality_gate,
+            "quality_min_sharpness": self.quality_min_sharpness,
+            "quality_min_sharpness_ratio": self.quality_min_sharpness_ratio,
+            "quality_min_luminance": self.quality_min_luminance,
+            "quality_max_luminance": self.quality_max_luminance,
+            "quality_max_clipped": self.quality_max_clipped,
+            "quality_retries": self.quality_retries,
+            "image_batch_max": self.image_batch_max,
+            "image_batch_window": self.image_batch_window,
+            "upload_rate_control": self.upload_rate_control,
+            "upload_min_quality": self.upload_min_quality,
+            "upload_adaptive_scale": self.upload_adaptive_scale,
+            "upload_min_scale": self.upload_min_scale,
+            "storage_quota_mb": self.storage_quota_mb,
+            "checkpoint_interval": self.checkpoint_interval,
+            "resource_governor": self.resource_governor,
+            "governor_max_cpu": self.governor_max_cpu,
+            "governor_max_memory": self.governor_max_memory,
+            "governor_max_temperature": self.governor_max_temperature,
+            "capture_trigger": self.capture_trigger,
+            "layer_burst_layers": self.layer_burst_layers,
+            "layer_burst_interval": self.layer_burst_interval,
+            "layer_max_gap": self.layer_max_gap,
+            "telemetry_rate": self.telemetry_rate,
+            "telemetry_window": self.telemetry_window,
+            "telemetry_batch_interval": self.telemetry_batch_interval,
+            "telemetry_backfill": self.telemetry_backfill,
+            "backfill_min_gap": self.backfill_min_gap,
+            "image_transport": self.image_transport,
+            "ws_frame_window": self.ws_frame_window,
+            "camera_name": self.camera_name,
+            "cameras": self.cameras,
+        }
+
+    def get_camera_definitions(self):
+        """
+        Reads the extra cameras, each from a `[mattaos_camera <name>]` section
+        with its own snapshot URL, transforms and nozzle coordinates. Options
+        left out are taken from `[mattaos_settings]`.
+
+        Returns:
+            list: A dict of setting overrides for each extra camera.
+        """
+        options = {
+            "camera_snapshot_url": ("snapshot_url", self.config.get),
+            "camera_source": ("camera_source", self.config.get),
+            "camera_stream_url": ("stream_url", self.config.get),
+            "nozzle_tip_coords_x": ("nozzle_tip_coords_x", self.config.get),
+            "nozzle_tip_coords_y": ("nozzle_tip_coords_y", self.config.get),
+            "flip_webcam_horizontally": ("flip_h", self.config.getboolean),
+            "flip_webcam_vertically": ("flip_v", self.config.getboolean),
+            "rotate_webcam_90CC": ("rotate", self.config.getboolean),
+            "roi_enabled": ("roi_enabled", self.config.getboolean),
         }
+        cameras = []
+        for section in self.config.sections():
+            if not section.startswith("mattaos_camera "):
+                continue
+            camera = {"name": section[len("mattaos_camera ") :].strip()}
+            for option, (key, getter) in options.items():
+                if self.config.has_option(section, option):
+                    try:
+                        camera[key] = getter(section, option)
+                    except ValueError as e:
+                        self._logger.error(f"Invalid {option} in [{section}]: {e}")
+            if "snapshot_url" not in camera:
+                self._logger.error(f"[{section}] has no camera_snapshot_url, ignoring it")
+                continue
+            cameras.append(camera)
+        return cameras
 
     # ---------------------------------------------------
     # MattaOS Server API?
@@ -329,4 +572,6 @@ class mattaosPlugin:
 
 
 if __name__ == "__main__":
+    # exit normally on systemd's SIGTERM, so the atexit shutdown handlers run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     plugin = mattaosPlugin()
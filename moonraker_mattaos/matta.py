@@ -28,6 +28,7 @@ from moonraker_mattaos.utils import (
 from moonraker_mattaos.data import DataEngine
 from moonraker_mattaos.printer import MattaPrinter
 from moonraker_mattaos.ws import Socket
+from moonraker_mattaos.ws_frames import WebsocketFrameSender
 
 
 class MattaCore:
@@ -55,15 +56,20 @@ class MattaCore:
             self._logger, self._logger_cmd, self.MOONRAKER_API_URL, settings
         )
 
-        # Start websocket
+        # Start data loop, before the websocket whose messages report on it
         self.user_online = False
-        self.start_websocket_thread()
-
-        # Start data loop
+        self.frame_sender = WebsocketFrameSender(self._logger_ws, self._settings)
         self.data_engine = DataEngine(
-            self._logger, self._logger_cmd, self._settings, self._printer
+            self._logger,
+            self._logger_cmd,
+            self._settings,
+            self._printer,
+            frame_sender=self.frame_sender,
         )
 
+        # Start websocket
+        self.start_websocket_thread()
+
         # Check for updates at startup
         self.over_the_air_update()
 
@@ -186,17 +192,21 @@ class MattaCore:
         try:
             full_url = get_cloud_websocket_url() + "api/v1/ws/printer"
             if self.ws_connected():
+                self.frame_sender.detach()
                 self.ws.disconnect()
                 self.ws = None
                 if self.ws_thread:
                     self.ws_thread.join()
                     self.ws_thread = None
-            self.ws = Socket(
+            socket = Socket(
                 logger_ws=self._logger_ws,
                 on_message=lambda _, msg: self.ws_on_message(msg),
                 url=full_url,
                 token=self._settings["auth_token"],
+                on_open=lambda _: self.ws_on_open(socket),
+                on_close=lambda *_: self.frame_sender.detach(socket),
             )
+            self.ws = socket
             self.ws_thread = threading.Thread(target=self.ws.run)
             self.ws_thread.daemon = True
             self.ws_thread.start()
@@ -205,6 +215,17 @@ class MattaCore:
         except Exception as e:
             self._logger_ws.error("ws_on_close: %s", e)
 
+    def ws_on_open(self, socket):
+        """
+        Callback function called when the WebSocket connection opens, which
+        also shows the Matta servers can be reached again.
+
+        Args:
+            socket (Socket): The opened WebSocket.
+        """
+        self.frame_sender.attach(socket)
+        self.data_engine.upload_spool.link_up()
+
     def ws_on_message(self, incoming_msg):
         """
         Callback function called when a message is received over the WebSocket connection.
@@ -217,6 +238,9 @@ class MattaCore:
         try:
             # Get current thread's ID and print it
             json_msg = json.loads(incoming_msg)
+            # frame acknowledgements are not answered with printer data
+            if self.frame_sender.handle_message(json_msg):
+                return
             self._logger_ws.info("ws_on_message: %s", json_msg)
             msg = self.ws_data()  # default message
             if (
@@ -226,9 +250,11 @@ class MattaCore:
                 self._logger_ws.info("Token and interface match")
                 if json_msg.get("state", None) == "online":
                     self.user_online = True
+                    self._settings["live_upload"] = True
                     msg = self.ws_data()
                 elif json_msg.get("state", None) == "offline":
                     self.user_online = False
+                    self._settings["live_upload"] = False
                     msg = self.ws_data()
                 elif json_msg.get("webrtc", None) == "request":
                     # check if auth_key has already been received
@@ -341,7 +367,14 @@ class MattaCore:
                     "os": self.os,
                     "memory": get_current_memory_usage(self.os),
                     "plugin_version": self._plugin_version,
-
+                    "upload": self.data_engine.rate_controller.get_stats(),
+                    "governor": self.data_engine.governor.get_stats(),
+                    "storage": self.data_engine.storage.get_stats(),
+                    "frames": self.frame_sender.get_stats(),
+                    "telemetry": {
+                        "collector": self.data_engine.telemetry.get_stats(),
+                        "backfill": self.data_engine.backfill.get_stats(),
+                    },
                 },
                 "nozzle_tip_coords": {
                     "nozzle_tip_coords_x": int(self._settings["nozzle_tip_coords_x"]),
@@ -408,8 +441,11 @@ class MattaCore:
         """
         Takes a snapshot of the current print job.
 
+        The frame comes from the data engine's shared frame provider, so it
+        does not add to the camera load while a print is being sampled.
+
         Args:
-            url (str): The URL to send the snapshot to.
+            url (str): The snapshot URL, which must be configured.
 
         Returns:
             Image: The snapshot image.
@@ -421,17 +457,18 @@ class MattaCore:
             status_text = "Please add snapshot URL to the moonraker-mattaos.conf file."
             return success, status_text, image
         try:
-            resp = requests.get(url, stream=True)
-        except requests.exceptions.RequestException as e:
+            image, _ = self.data_engine.frame_provider.get()
+        except requests.exceptions.HTTPError as e:
+            status_text = "Error: received status code " + str(
+                e.response.status_code
+            )
+            return success, status_text, image
+        except (requests.exceptions.RequestException, TimeoutError) as e:
             self._logger.debug("Error when sending request: %s", e)
             status_text = "Error when sending request: " + str(e)
             return success, status_text, image
-        if resp.status_code == 200:
-            success = True
-            image = resp.content
-            status_text = "Image captured successfully."
-        else:
-            status_text = "Error: received status code " + str(resp.status_code)
+        success = True
+        status_text = "Image captured successfully."
         return success, status_text, image
 
     def websocket_thread_loop(self):
@@ -179,6 +179,53 @@ class MattaPrinter:
         result = content["result"]
         return result
 
+    def get_sample_objects(self):
+        """
+        Queries everything a data sample needs in a single request.
+
+        Returns:
+            dict: The query result, with the Klipper "eventtime" of the query
+                and the "status" of each object.
+        """
+        objects_query = ["gcode_move", "virtual_sdcard", "extruder", "heater_bed"]
+        query_string = ""
+        for obj in objects_query:
+            query_string += f"{obj}&"
+        content = self.get("/printer/objects/query?" + query_string[:-1])
+        return content["result"]
+
+    def get_telemetry_objects(self, session):
+        """
+        Queries the heater and extruder readings sampled between data
+        samples, on the caller's kept-alive session.
+
+        Returns:
+            dict: The query result, with the "status" of each object.
+        """
+        query_string = (
+            "extruder=temperature,power&heater_bed=temperature,power"
+            "&motion_report=live_extruder_velocity"
+        )
+        response = session.get(
+            self.MOONRAKER_API_URL + "/printer/objects/query?" + query_string,
+            timeout=2,
+        )
+        response.raise_for_status()
+        return response.json()["result"]
+
+    def get_temperature_store(self):
+        """
+        Gets the temperature history Moonraker keeps for each heater.
+
+        Returns:
+            dict: The "temperatures" and "targets" of each heater, oldest
+                first, or None if the request failed.
+        """
+        content = self.get("/server/temperature_store?include_monitors=false")
+        if content is None:
+            return None
+        return content["result"]
+
     def get_gcode_store(self):
         endpoint = "/server/gcode_store?count=10"
         content = self.get(endpoint)
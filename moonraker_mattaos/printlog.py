@@ -0,0 +1,345 @@
+import io
+import csv
+import json
+import lzma
+import math
+import struct
+import zlib
+from datetime import datetime, timezone
+
+MAGIC = b"MATTALOG"
+BLOCK_HEADER = struct.Struct("<I")
+DEFAULT_BATCH_ROWS = 64
+DEFAULT_COMPRESSION = "zlib"
+
+# Column names and types, in CSV order. Types are struct codes, or:
+#   "str": an index into the log's string table
+#   "timestamp": a make_timestamp() string stored as epoch milliseconds
+#   "bool": stored as a byte
+PRINT_LOG_COLUMNS = [
+    ("count", "I"),
+    ("timestamp", "timestamp"),
+    ("flow_rate", "d"),
+    ("feed_rate", "d"),
+    ("z_offset", "d"),
+    ("target_hotend", "d"),
+    ("hotend", "d"),
+    ("target_bed", "d"),
+    ("bed", "d"),
+    ("gcode_line_num_no_comments", "I"),
+    ("gcode_cmd", "str"),
+    ("file_position_bytes", "Q"),
+    ("nozzle_tip_coords_x", "i"),
+    ("nozzle_tip_coords_y", "i"),
+    ("flip_h", "bool"),
+    ("flip_v", "bool"),
+    ("rotate", "bool"),
+    ("sample_id", "I"),
+    ("capture_time", "d"),
+    ("eventtime", "d"),
+]
+
+STORAGE_CODES = {"str": "I", "timestamp": "q", "bool": "B"}
+
+COMPRESSORS = {
+    "none": (lambda data: data, lambda data: data),
+    "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+    "lzma": (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+}
+
+
+def timestamp_to_ms(timestamp):
+    dt = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
+    return int(round(dt.replace(tzinfo=timezone.utc).timestamp() * 1000))
+
+
+def ms_to_timestamp(ms):
+    dt = datetime.fromtimestamp(ms / 1000, tz=timezone.utc).replace(tzinfo=None)
+    return dt.isoformat(sep="T", timespec="milliseconds") + "Z"
+
+
+class PrintLog:
+    """
+    An append-only, columnar binary log of the per-sample print telemetry.
+
+    Rows are buffered and written in compressed blocks of `batch_rows` rows.
+    Each block stores its rows column by column as fixed-width values, plus
+    a table of the G-code strings used in the block. The table starts afresh
+    with every block, so its memory is bounded by the block rather than
+    growing with the job. The CSV is only produced on demand by `iter_csv`.
+
+    File layout:
+        MAGIC, then a length-prefixed JSON header with the columns and codec,
+        then length-prefixed compressed blocks of:
+            row count, string count, the strings, then each column.
+
+    Logs without "string_table": "block" in their header were written with
+    one string table for the whole log, each block adding its new strings.
+
+    With `resume`, an existing log is reopened to append to, keeping its
+    columns and codec and dropping a block torn by a crash.
+    """
+
+    def __init__(
+        self,
+        path,
+        columns=PRINT_LOG_COLUMNS,
+        compression=DEFAULT_COMPRESSION,
+        batch_rows=DEFAULT_BATCH_ROWS,
+        resume=False,
+    ):
+        if compression not in COMPRESSORS:
+            compression = DEFAULT_COMPRESSION
+        self.path = path
+        self.columns = columns
+        self.compression = compression
+        self.batch_rows = max(int(batch_rows), 1)
+        self.compress, _ = COMPRESSORS[compression]
+        self.rows = []
+        self.strings = {}
+        self.new_strings = []
+        self.row_count = 0
+        self.last_row = None
+        if resume:
+            self.reopen()
+            return
+        self.block_strings = True
+        self.file = open(path, "wb")
+        header = json.dumps(
+            {"columns": columns, "compression": compression, "string_table": "block"}
+        )
+        self.write_block(MAGIC, header.encode("utf-8"))
+
+    def reopen(self):
+        """
+        Reopens the existing log at the end of its last complete block.
+        Only the last block's columns are decoded, and for a log with one
+        string table, its string table is rebuilt in the order it was built.
+        """
+        last_block = None
+        with open(self.path, "rb") as log:
+            header = read_header(log)
+            self.columns = [tuple(column) for column in header["columns"]]
+            self.compression = header["compression"]
+            self.compress, decompress = COMPRESSORS[self.compression]
+            self.block_strings = header.get("string_table") == "block"
+            end = log.tell()
+            for row_count, new_strings, payload, offset in read_raw_blocks(
+                log, self.columns, decompress
+            ):
+                if not self.block_strings:
+                    for value in new_strings:
+                        self.string_id(value)
+                self.row_count += row_count
+                last_block = (payload, offset, row_count, new_strings)
+                end = log.tell()
+        if last_block is not None:
+            payload, offset, row_count, new_strings = last_block
+            strings = new_strings if self.block_strings else list(self.strings)
+            self.last_row = decode_rows(
+                self.columns, payload, offset, row_count, strings
+            )[-1]
+        self.new_strings = []
+        self.file = open(self.path, "r+b")
+        self.file.truncate(end)
+        self.file.seek(end)
+
+    @property
+    def offset(self):
+        """The size of the log written to disk, in bytes."""
+        return self.file.tell() if self.file is not None else None
+
+    def write_block(self, prefix, data):
+        self.file.write(prefix + BLOCK_HEADER.pack(len(data)) + data)
+
+    def string_id(self, value):
+        value = "" if value is None else str(value)
+        index = self.strings.get(value)
+        if index is None:
+            index = len(self.strings)
+            self.strings[value] = index
+            self.new_strings.append(value)
+        return index
+
+    def append(self, row):
+        """Buffers a row, writing a block once `batch_rows` are buffered."""
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def encode_value(self, kind, value):
+        if kind == "str":
+            return self.string_id(value)
+        if kind == "timestamp":
+            return timestamp_to_ms(value)
+        if kind == "bool":
+            return 1 if value else 0
+        if kind in ("f", "d"):
+            return math.nan if value is None else float(value)
+        return int(value or 0)
+
+    def flush(self):
+        """Compresses and writes the buffered rows as one block."""
+        if not self.rows:
+            return
+        rows = [
+            [
+                self.encode_value(kind, value)
+                for (_, kind), value in zip(self.columns, row)
+            ]
+            for row in self.rows
+        ]
+        payload = io.BytesIO()
+        payload.write(struct.pack("<II", len(rows), len(self.new_strings)))
+        for value in self.new_strings:
+            encoded = value.encode("utf-8")[:0xFFFF]
+            payload.write(struct.pack("<H", len(encoded)) + encoded)
+        for index, (_, kind) in enumerate(self.columns):
+            code = STORAGE_CODES.get(kind, kind)
+            payload.write(
+                struct.pack(f"<{len(rows)}{code}", *(row[index] for row in rows))
+            )
+        self.write_block(b"", self.compress(payload.getvalue()))
+        self.file.flush()
+        self.row_count += len(rows)
+        self.rows = []
+        self.new_strings = []
+        if self.block_strings:
+            self.strings = {}
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+def read_header(log):
+    """Reads the header of a print log from its start."""
+    if log.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{log.name} is not a print log")
+    (length,) = BLOCK_HEADER.unpack(log.read(BLOCK_HEADER.size))
+    return json.loads(log.read(length))
+
+
+def block_row_size(columns):
+    """Returns the bytes each row takes in a block's columns."""
+    return sum(
+        struct.calcsize(f"<{STORAGE_CODES.get(kind, kind)}") for _, kind in columns
+    )
+
+
+def read_raw_blocks(log, columns, decompress):
+    """
+    Reads the blocks of a print log without decoding their columns.
+
+    A block which is cut short or does not decode, e.g. the last block
+    written before a power cut, ends the log as a torn tail.
+
+    Args:
+        log (file): The log, positioned after its header.
+        columns (list): The log's column definitions.
+        decompress (callable): The log's decompressor.
+
+    Yields:
+        tuple: For each complete block, its row count, its strings (or for a
+            log with one string table, the strings it adds to the table), its
+            payload and the payload offset of its columns. The file position
+            is at the end of the block.
+    """
+    row_size = block_row_size(columns)
+    while True:
+        prefix = log.read(BLOCK_HEADER.size)
+        if len(prefix) < BLOCK_HEADER.size:
+            return
+        (length,) = BLOCK_HEADER.unpack(prefix)
+        data = log.read(length)
+        if len(data) < length:
+            return  # torn final block
+        try:
+            payload = memoryview(decompress(data))
+            row_count, string_count = struct.unpack_from("<II", payload)
+            offset = 8
+            new_strings = []
+            for _ in range(string_count):
+                (size,) = struct.unpack_from("<H", payload, offset)
+                offset += 2
+                new_strings.append(
+                    bytes(payload[offset : offset + size]).decode("utf-8", "replace")
+                )
+                offset += size
+        except (zlib.error, lzma.LZMAError, struct.error):
+            return  # corrupt final block
+        if len(payload) < offset + row_count * row_size:
+            return
+        yield row_count, new_strings, payload, offset
+
+
+def decode_rows(columns, payload, offset, row_count, strings):
+    """Decodes the columns of a block payload into rows."""
+    values = []
+    for _, kind in columns:
+        fmt = f"<{row_count}{STORAGE_CODES.get(kind, kind)}"
+        column = struct.unpack_from(fmt, payload, offset)
+        offset += struct.calcsize(fmt)
+        if kind == "str":
+            column = [strings[index] for index in column]
+        elif kind == "timestamp":
+            column = [ms_to_timestamp(ms) for ms in column]
+        elif kind == "bool":
+            column = [bool(value) for value in column]
+        elif kind in ("f", "d"):
+            column = [None if math.isnan(value) else value for value in column]
+        values.append(column)
+    return [list(row) for row in zip(*values)]
+
+
+def read_blocks(path):
+    """
+    Reads a print log back.
+
+    Yields:
+        tuple: The column definitions and a list of rows, first with no rows
+            for the header and then for each block.
+    """
+    with open(path, "rb") as log:
+        header = read_header(log)
+        columns = [tuple(column) for column in header["columns"]]
+        _, decompress = COMPRESSORS[header["compression"]]
+        block_strings = header.get("string_table") == "block"
+        yield columns, []
+        strings = []
+        for row_count, new_strings, payload, offset in read_raw_blocks(
+            log, columns, decompress
+        ):
+            if block_strings:
+                strings = new_strings
+            else:
+                strings.extend(new_strings)
+            yield columns, decode_rows(columns, payload, offset, row_count, strings)
+
+
+def iter_csv(path):
+    """
+    Streams a print log as CSV text, one block at a time.
+
+    Yields:
+        str: Chunks of CSV, starting with the header row.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=",")
+    for index, (columns, rows) in enumerate(read_blocks(path)):
+        if index == 0:
+            writer.writerow([name for name, _ in columns])
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def export_csv(path, csv_path):
+    """Writes a print log out as a CSV file, streaming block by block."""
+    with open(csv_path, "w", newline="") as csv_file:
+        for chunk in iter_csv(path):
+            csv_file.write(chunk)
+    return csv_path
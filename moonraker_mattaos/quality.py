@@ -0,0 +1,142 @@
+import io
+import numpy as np
+from PIL import Image
+
+DEFAULT_MIN_SHARPNESS = 5.0  # Laplacian variance
+DEFAULT_MIN_SHARPNESS_RATIO = 0.3  # of the recent average sharpness
+SHARPNESS_SMOOTHING = 0.1  # EWMA weight of the newest frame's sharpness
+DEFAULT_MIN_LUMINANCE = 20.0  # mean grey level
+DEFAULT_MAX_LUMINANCE = 235.0
+DEFAULT_MAX_CLIPPED = 0.3  # fraction of pixels
+DEFAULT_QUALITY_RETRIES = 1
+QUALITY_SIZE = 320  # width of the measured frame, in pixels
+CLIP_DARK = 3  # grey levels at or below which a pixel is clipped
+CLIP_BRIGHT = 252  # grey levels at or above which a pixel is clipped
+
+
+def measure_quality(image):
+    """
+    Measures the quality of a camera frame on a downscaled greyscale copy.
+
+    Args:
+        image (bytes-like): The JPEG frame from the camera.
+
+    Returns:
+        dict: The sharpness (variance of the Laplacian), mean luminance and
+            the fractions of pixels clipped to black and to white.
+    """
+    pil_image = Image.open(io.BytesIO(image))
+    width, height = pil_image.size
+    size = (QUALITY_SIZE, max(height * QUALITY_SIZE // max(width, 1), 1))
+    pil_image.draft("L", size)
+    # a fixed size keeps the sharpness comparable between cameras
+    pil_image = pil_image.convert("L").resize(size, Image.BOX)
+    grey = np.asarray(pil_image, dtype=np.float32)
+    laplacian = (
+        4 * grey[1:-1, 1:-1]
+        - grey[:-2, 1:-1]
+        - grey[2:, 1:-1]
+        - grey[1:-1, :-2]
+        - grey[1:-1, 2:]
+    )
+    return {
+        "sharpness": round(float(laplacian.var()), 2),
+        "luminance": round(float(grey.mean()), 2),
+        "clipped_dark": round(float(np.count_nonzero(grey <= CLIP_DARK)) / grey.size, 4),
+        "clipped_bright": round(
+            float(np.count_nonzero(grey >= CLIP_BRIGHT)) / grey.size, 4
+        ),
+    }
+
+
+class QualityGate:
+    """
+    Rejects camera frames the model cannot use: blurred by fast moves,
+    black, under or overexposed, or mostly clipped while auto-exposure
+    settles.
+
+    How sharp a frame can be depends on the scene, so besides an absolute
+    floor a frame is rejected as blurred when its sharpness falls well below
+    the moving average of recent frames.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self.enabled = bool(settings.get("quality_gate", False))
+        try:
+            self.min_sharpness = float(
+                settings.get("quality_min_sharpness", DEFAULT_MIN_SHARPNESS)
+            )
+            self.min_sharpness_ratio = float(
+                settings.get("quality_min_sharpness_ratio", DEFAULT_MIN_SHARPNESS_RATIO)
+            )
+            self.min_luminance = float(
+                settings.get("quality_min_luminance", DEFAULT_MIN_LUMINANCE)
+            )
+            self.max_luminance = float(
+                settings.get("quality_max_luminance", DEFAULT_MAX_LUMINANCE)
+            )
+            self.max_clipped = float(
+                settings.get("quality_max_clipped", DEFAULT_MAX_CLIPPED)
+            )
+            self.retries = int(settings.get("quality_retries", DEFAULT_QUALITY_RETRIES))
+        except (TypeError, ValueError) as e:
+            self._logger.error(f"Invalid quality gate settings: {e}")
+            self.min_sharpness = DEFAULT_MIN_SHARPNESS
+            self.min_sharpness_ratio = DEFAULT_MIN_SHARPNESS_RATIO
+            self.min_luminance = DEFAULT_MIN_LUMINANCE
+            self.max_luminance = DEFAULT_MAX_LUMINANCE
+            self.max_clipped = DEFAULT_MAX_CLIPPED
+            self.retries = DEFAULT_QUALITY_RETRIES
+        self.retries = max(self.retries, 0)
+        self.reset()
+
+    def reset(self):
+        """Forgets the average sharpness, e.g. for a new print job."""
+        self.average_sharpness = None
+
+    def check(self, image):
+        """
+        Checks whether a frame is good enough to upload.
+
+        Args:
+            image (bytes-like): The JPEG frame from the camera.
+
+        Returns:
+            tuple: Whether the frame passed, and its quality scores with the
+                reason it was rejected, if it was (None if the gate is off).
+        """
+        if not self.enabled:
+            return True, None
+        try:
+            quality = measure_quality(image)
+        except Exception as e:
+            self._logger.error(f"Failed to measure frame quality: {e}")
+            return True, None
+
+        reason = None
+        if quality["luminance"] < self.min_luminance:
+            reason = "dark"
+        elif quality["luminance"] > self.max_luminance:
+            reason = "bright"
+        elif quality["clipped_dark"] + quality["clipped_bright"] > self.max_clipped:
+            reason = "clipped"
+        elif quality["sharpness"] < self.min_sharpness:
+            reason = "blurred"
+        elif (
+            self.average_sharpness is not None
+            and quality["sharpness"] < self.average_sharpness * self.min_sharpness_ratio
+        ):
+            reason = "blurred"
+
+        # every frame feeds the average, so a lasting change of scene is
+        # adopted within a few tens of frames
+        if reason not in ("dark", "bright", "clipped"):
+            if self.average_sharpness is None:
+                self.average_sharpness = quality["sharpness"]
+            else:
+                self.average_sharpness += SHARPNESS_SMOOTHING * (
+                    quality["sharpness"] - self.average_sharpness
+                )
+        quality["rejected"] = reason
+        return reason is None, quality
@@ -0,0 +1,176 @@
+import time
+import threading
+from .images import get_image_encoding
+from .utils import SAMPLING_TIMEOUT
+
+DEFAULT_MAX_INTERVAL = 5.0  # seconds
+DEFAULT_MIN_QUALITY = 40
+DEFAULT_MIN_SCALE = 0.5
+RATE_STEP = 0.05  # frames per second added after each uncongested upload
+QUALITY_STEP = 1  # encoder quality added after each uncongested upload
+SCALE_STEP = 0.01  # frame scale added after each uncongested upload
+DECREASE_FACTOR = 0.5  # applied to the frame rate on congestion
+QUALITY_DECREASE_FACTOR = 0.75  # applied to the quality above the minimum
+# encodings whose size the encoder quality changes
+LOSSY_ENCODINGS = ("jpeg", "webp")
+BUSY_LIMIT = 0.8  # fraction of the frame interval an upload may take
+LINK_SMOOTHING = 0.3  # EWMA weight of the newest latency/throughput sample
+DEFAULT_TIMEOUT = 5.0  # seconds, until the throughput is known
+MIN_TIMEOUT = 3.0  # seconds
+MAX_TIMEOUT = 30.0  # seconds
+TIMEOUT_FACTOR = 3.0  # timeout as a multiple of the expected upload time
+
+
+class UploadRateController:
+    """
+    Adapts the frame rate and the encoder quality to the uplink with
+    additive increase, multiplicative decrease (AIMD).
+
+    The latency and throughput of each image upload are measured. An upload
+    is congested if it failed, or kept the uplink busy for more than
+    BUSY_LIMIT of the frame interval: the frame rate is then halved and the
+    quality moved a quarter of the way down to `upload_min_quality`, at most
+    once per round trip. Every uncongested upload adds RATE_STEP frames per
+    second and QUALITY_STEP of quality, up to the `sampling_min_interval` and
+    `image_quality` settings. Upload timeouts follow the expected upload
+    time instead of a fixed 5 seconds.
+
+    The quality only changes the size of lossy (jpeg and webp) frames, and
+    is left alone for the other encodings. For png frames the resolution is
+    adapted instead if `upload_adaptive_scale` is on: the frame scale moves
+    the same way as the quality would, between `upload_min_scale` and full
+    size. Passthrough and lossless frames only have their rate adapted.
+
+    The link is measured whether or not `upload_rate_control` is on.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self.enabled = bool(settings.get("upload_rate_control", False))
+        encoding, self.max_quality = get_image_encoding(settings)
+        self.adapts_quality = encoding in LOSSY_ENCODINGS
+        self.adapts_scale = encoding == "png" and bool(
+            settings.get("upload_adaptive_scale", False)
+        )
+        try:
+            self.min_interval = float(
+                settings.get("sampling_min_interval", SAMPLING_TIMEOUT)
+            )
+            self.max_interval = float(
+                settings.get("sampling_max_interval", DEFAULT_MAX_INTERVAL)
+            )
+            self.min_quality = int(
+                settings.get("upload_min_quality", DEFAULT_MIN_QUALITY)
+            )
+            self.min_scale = float(settings.get("upload_min_scale", DEFAULT_MIN_SCALE))
+        except (TypeError, ValueError):
+            self.min_interval = SAMPLING_TIMEOUT
+            self.max_interval = DEFAULT_MAX_INTERVAL
+            self.min_quality = DEFAULT_MIN_QUALITY
+            self.min_scale = DEFAULT_MIN_SCALE
+        self.min_interval = max(self.min_interval, 0.01)
+        self.max_interval = max(self.max_interval, self.min_interval)
+        self.min_quality = min(max(self.min_quality, 1), self.max_quality)
+        self.min_scale = min(max(self.min_scale, 0.1), 1.0)
+        self.lock = threading.Lock()
+        self.rate = 1 / self.min_interval
+        self.quality = self.max_quality
+        self.scale = 1.0
+        self.latency = None
+        self.throughput = None
+        self.last_decrease = 0.0
+        self.decreases = 0
+
+    @property
+    def interval(self):
+        """The frame interval in seconds."""
+        return 1 / self.rate
+
+    def timeout(self, size):
+        """
+        Returns the timeout for an upload.
+
+        Args:
+            size (int): The upload size in bytes.
+
+        Returns:
+            float: The timeout in seconds.
+        """
+        if not self.enabled or self.throughput is None:
+            return DEFAULT_TIMEOUT
+        expected = size / self.throughput
+        return min(max(TIMEOUT_FACTOR * expected, MIN_TIMEOUT), MAX_TIMEOUT)
+
+    def record(self, start_time, size, frames, sent, end_time=None):
+        """
+        Records the result of an image upload and adapts the rate to it.
+
+        Args:
+            start_time (float): The monotonic time the upload started.
+            size (int): The bytes uploaded.
+            frames (int): The frames in the upload.
+            sent (bool): Whether the upload succeeded.
+            end_time (float): The monotonic time the upload completed, e.g.
+                when a websocket frame was acknowledged, or None for now.
+        """
+        now = time.monotonic() if end_time is None else end_time
+        seconds = max(now - start_time, 1e-3)
+        with self.lock:
+            if sent:
+                if self.latency is None:
+                    self.latency = seconds
+                    self.throughput = size / seconds
+                else:
+                    self.latency += LINK_SMOOTHING * (seconds - self.latency)
+                    self.throughput += LINK_SMOOTHING * (
+                        size / seconds - self.throughput
+                    )
+            if not self.enabled:
+                return
+            congested = not sent or seconds / frames > BUSY_LIMIT * self.interval
+            if congested:
+                # uploads started before the last decrease saw the old rate
+                if start_time < self.last_decrease:
+                    return
+                self.rate = max(self.rate * DECREASE_FACTOR, 1 / self.max_interval)
+                if self.adapts_quality:
+                    self.quality = max(
+                        self.min_quality,
+                        round(
+                            self.min_quality
+                            + (self.quality - self.min_quality)
+                            * QUALITY_DECREASE_FACTOR
+                        ),
+                    )
+                if self.adapts_scale:
+                    self.scale = (
+                        self.min_scale
+                        + (self.scale - self.min_scale) * QUALITY_DECREASE_FACTOR
+                    )
+                self.last_decrease = now
+                self.decreases += 1
+                self._logger.debug(
+                    f"Upload congested, {self.rate:.2f} frames/s at quality "
+                    f"{self.quality}, scale {self.scale:.2f}"
+                )
+            else:
+                self.rate = min(self.rate + RATE_STEP, 1 / self.min_interval)
+                if self.adapts_quality:
+                    self.quality = min(self.quality + QUALITY_STEP, self.max_quality)
+                if self.adapts_scale:
+                    self.scale = min(self.scale + SCALE_STEP, 1.0)
+
+    def get_stats(self):
+        """Returns the controller state for the websocket `system` block."""
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "frame_rate": round(self.rate, 3),
+                "quality": self.quality if self.adapts_quality else None,
+                "scale": round(self.scale, 3) if self.adapts_scale else None,
+                "latency": round(self.latency, 3) if self.latency is not None else None,
+                "throughput": (
+                    round(self.throughput) if self.throughput is not None else None
+                ),
+                "decreases": self.decreases,
+            }
@@ -0,0 +1,155 @@
+import time
+import bisect
+import threading
+from .utils import SAMPLING_TIMEOUT
+
+DEFAULT_MAX_INTERVAL = 5.0  # seconds
+LATENCY_HEADROOM = 1.25  # keep the interval this much above upload latency
+LATENCY_SMOOTHING = 0.2  # EWMA weight of the newest latency sample
+QUEUE_DEPTH_SCALE = 10  # queued uploads that double the interval
+INTERVAL_STEP = 0.25  # fraction of the gap to the target moved per tick
+
+# Upper edges, in milliseconds, of the sampling jitter histogram buckets
+JITTER_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class SamplingScheduler:
+    """
+    Schedules data loop samples on a fixed grid of monotonic deadlines.
+
+    A missed deadline is skipped rather than caught up in a burst, and the
+    grid spacing adapts between the configured minimum and maximum interval
+    according to the measured upload latency and the upload queue depth.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        try:
+            self.min_interval = float(
+                settings.get("sampling_min_interval", SAMPLING_TIMEOUT)
+            )
+            self.max_interval = float(
+                settings.get("sampling_max_interval", DEFAULT_MAX_INTERVAL)
+            )
+        except (TypeError, ValueError):
+            self.min_interval = SAMPLING_TIMEOUT
+            self.max_interval = DEFAULT_MAX_INTERVAL
+        self.max_interval = max(self.max_interval, self.min_interval)
+        self.interval = self.min_interval
+        self.deadline = None
+        self.next_deadline = None
+        self.upload_latency = None
+        self.missed = 0
+        self.lock = threading.Lock()
+        self.jitter_counts = [0] * (len(JITTER_BUCKETS_MS) + 1)
+
+    def wait(self):
+        """
+        Sleeps until the next deadline on the grid.
+
+        Returns:
+            float: The monotonic deadline of this tick.
+        """
+        now = time.monotonic()
+        if self.next_deadline is None:
+            self.next_deadline = now
+        if self.next_deadline > now:
+            time.sleep(self.next_deadline - now)
+            now = time.monotonic()
+        lateness = now - self.next_deadline
+        self.record_jitter(lateness)
+
+        # skip any deadlines which have already passed
+        missed = int(lateness // self.interval)
+        self.missed += missed
+        self.deadline = self.next_deadline + missed * self.interval
+        self.next_deadline = self.deadline + self.interval
+        return self.deadline
+
+    def record_jitter(self, lateness):
+        index = bisect.bisect_left(JITTER_BUCKETS_MS, lateness * 1000)
+        with self.lock:
+            self.jitter_counts[index] += 1
+
+    def record_latency(self, seconds):
+        """Records the latency of an upload made by the data loop."""
+        with self.lock:
+            if self.upload_latency is None:
+                self.upload_latency = seconds
+            else:
+                self.upload_latency += LATENCY_SMOOTHING * (
+                    seconds - self.upload_latency
+                )
+
+    def adapt(self, queue_depth=0, rate_interval=None, scale=1):
+        """
+        Moves the sampling interval towards what the uplink can sustain.
+
+        Args:
+            queue_depth (int): The number of uploads waiting to be sent.
+            rate_interval (float): The interval set by the upload rate
+                controller, which is followed at once in place of the
+                latency estimate, or None.
+            scale (float): A factor to stretch the interval by, e.g. from the
+                resource governor.
+        """
+        target = self.min_interval
+        if rate_interval is not None:
+            target = max(target, rate_interval)
+        elif self.upload_latency is not None:
+            target = max(target, self.upload_latency * LATENCY_HEADROOM)
+        target *= (1 + queue_depth / QUEUE_DEPTH_SCALE) * scale
+        target = min(max(target, self.min_interval), self.max_interval)
+
+        interval = target
+        if rate_interval is None:
+            interval = self.interval + INTERVAL_STEP * (target - self.interval)
+            if abs(interval - target) < 0.01:
+                interval = target
+        if interval != self.interval:
+            self.interval = interval
+            if self.deadline is not None:
+                # re-anchor the grid on the last deadline
+                self.next_deadline = self.deadline + self.interval
+
+    def expedite(self, delay):
+        """
+        Brings the next deadline forward to `delay` seconds from now, if it
+        is later than that, and re-anchors the grid on it.
+        """
+        deadline = time.monotonic() + max(delay, 0)
+        if self.next_deadline is None or deadline < self.next_deadline:
+            self.next_deadline = deadline
+
+    def jitter_histogram(self):
+        """
+        Returns the sampling jitter histogram.
+
+        Returns:
+            dict: Sample counts keyed by bucket, e.g. "<=5ms" and ">1000ms".
+        """
+        with self.lock:
+            counts = list(self.jitter_counts)
+        histogram = {
+            f"<={edge}ms": count for edge, count in zip(JITTER_BUCKETS_MS, counts)
+        }
+        histogram[f">{JITTER_BUCKETS_MS[-1]}ms"] = counts[-1]
+        return histogram
+
+    def get_stats(self):
+        """Returns the scheduler state for logging and reporting."""
+        return {
+            "interval": round(self.interval, 3),
+            "upload_latency": (
+                round(self.upload_latency, 3)
+                if self.upload_latency is not None
+                else None
+            ),
+            "missed": self.missed,
+            "jitter": self.jitter_histogram(),
+        }
+
+    def reset_stats(self):
+        with self.lock:
+            self.jitter_counts = [0] * (len(JITTER_BUCKETS_MS) + 1)
+        self.missed = 0
@@ -0,0 +1,504 @@
+import os
+import json
+import random
+import time
+import shutil
+import threading
+from collections import deque
+import requests
+from contextlib import ExitStack
+from .batching import UNSUPPORTED_STATUSES
+from .buffers import ChunkStream, MultipartBody
+from .utils import get_api_url, generate_auth_headers, MATTA_TMP_DATA_DIR
+
+SPOOL_DIR = os.path.join(MATTA_TMP_DATA_DIR, "spool")
+JOURNAL_NAME = "journal.log"
+DEFAULT_SPOOL_MAX_MB = 200
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_MAX = 300.0  # seconds
+BACKOFF_MAX_EXPONENT = 16  # well past BACKOFF_MAX, keeps the power finite
+
+# Entries of this kind are dropped first when the spool is full
+DROPPABLE_KINDS = ("image", "image_batch", "heartbeat", "telemetry")
+IMAGE_ENDPOINT = "images/print/predict/new-image"
+
+
+def is_retryable(error):
+    """
+    Checks whether a failed upload is worth retrying.
+
+    Connection problems, timeouts, server errors and rate limiting are
+    retried; other client errors will never succeed and are not.
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = error.response.status_code if error.response is not None else 0
+        return status >= 500 or status in (408, 429)
+    return isinstance(error, requests.exceptions.RequestException)
+
+
+def is_unsupported(error):
+    """Checks whether a failed upload means the server has no such endpoint."""
+    return (
+        isinstance(error, requests.exceptions.HTTPError)
+        and error.response is not None
+        and error.response.status_code in UNSUPPORTED_STATUSES
+    )
+
+
+def fsync_dir(path):
+    """Flushes a directory entry to disk so renames survive a crash."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class UploadSpool:
+    """
+    A crash-safe, size-capped on-disk queue of uploads to the Matta API.
+
+    Uploads that fail, and every upload queued behind them, are written to
+    the spool directory and an append-only journal. A background drainer
+    retries them in order with exponential backoff and jitter, and an entry
+    is only removed once the server has acknowledged it.
+
+    Journal lines are either `ADD <entry json>` or `ACK <seq>`; on start-up the
+    journal is replayed to recover pending entries, in journal order.
+    """
+
+    def __init__(self, logger, settings, spool_dir=SPOOL_DIR, compressor=None):
+        self._logger = logger
+        self._settings = settings
+        self.compressor = compressor
+        # used by the drainer thread only, as sessions are not thread-safe
+        self.session = requests.Session()
+        self.spool_dir = spool_dir
+        self.journal_path = os.path.join(spool_dir, JOURNAL_NAME)
+        try:
+            max_mb = float(settings.get("spool_max_mb", DEFAULT_SPOOL_MAX_MB))
+        except (TypeError, ValueError):
+            max_mb = DEFAULT_SPOOL_MAX_MB
+        self.max_bytes = int(max_mb * 1024**2)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = deque()
+        self.total_bytes = 0
+        self.next_seq = 0
+        self.attempts = 0
+        self.next_attempt = 0.0  # monotonic time of the next retry
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.recover()
+        self.start_drain_thread()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def is_empty(self):
+        return len(self.pending) == 0
+
+    # ---------------------------------------------------
+    # Journal
+    # ---------------------------------------------------
+
+    def recover(self):
+        """Replays the journal and removes payloads that were never journalled."""
+        entries = {}
+        try:
+            with open(self.journal_path, "r") as journal:
+                for line in journal:
+                    op, _, arg = line.strip().partition(" ")
+                    try:
+                        if op == "ADD":
+                            entry = json.loads(arg)
+                            entries[entry["seq"]] = entry
+                        elif op == "ACK":
+                            entries.pop(int(arg), None)
+                    except (ValueError, KeyError):
+                        # a torn final line from a crash mid-append
+                        continue
+        except FileNotFoundError:
+            pass
+
+        # entries are journalled in queue order, which is also seq order
+        # unless a batch was split into single images at the head of the queue
+        for seq, entry in entries.items():
+            if all(os.path.exists(self.payload_path(f)) for f in entry["files"]):
+                self.pending.append(entry)
+                self.total_bytes += entry["size"]
+            self.next_seq = max(self.next_seq, seq + 1)
+
+        known = {JOURNAL_NAME}
+        for entry in self.pending:
+            known.update(f["payload"] for f in entry["files"])
+        for name in os.listdir(self.spool_dir):
+            if name not in known:
+                self.remove_payload(name)
+
+        self.compact()
+        if self.pending:
+            self._logger.info(
+                f"Recovered {len(self.pending)} spooled uploads "
+                f"({self.total_bytes} bytes)"
+            )
+
+    def append_journal(self, line):
+        with open(self.journal_path, "a") as journal:
+            journal.write(line + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def compact(self):
+        """Atomically rewrites the journal with only the pending entries."""
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w") as journal:
+            for entry in self.pending:
+                journal.write("ADD " + json.dumps(entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(tmp_path, self.journal_path)
+        fsync_dir(self.spool_dir)
+
+    # ---------------------------------------------------
+    # Payloads
+    # ---------------------------------------------------
+
+    def payload_path(self, spooled_file):
+        return os.path.join(self.spool_dir, spooled_file["payload"])
+
+    def remove_payload(self, name):
+        try:
+            os.remove(os.path.join(self.spool_dir, name))
+        except OSError:
+            pass
+
+    def write_payload(self, name, source):
+        """
+        Stores a file's content in the spool.
+
+        Args:
+            name (str): The payload file name.
+            source (str, bytes-like or callable): A path to hard link (or
+                copy), data, or a callable returning an iterable of chunks.
+
+        Returns:
+            tuple: The payload size in bytes, and whether it is a hard link.
+        """
+        path = os.path.join(self.spool_dir, name)
+        tmp_path = path + ".tmp"
+        linked = False
+        if isinstance(source, str):
+            try:
+                os.link(source, tmp_path)
+                linked = True
+            except OSError:
+                shutil.copyfile(source, tmp_path)
+        else:
+            with open(tmp_path, "wb") as payload:
+                if callable(source):
+                    stream = ChunkStream(source)
+                    for chunk in iter(stream.read, b""):
+                        payload.write(chunk)
+                else:
+                    payload.write(source)
+                payload.flush()
+                os.fsync(payload.fileno())
+        os.replace(tmp_path, path)
+        return os.path.getsize(path), linked
+
+    # ---------------------------------------------------
+    # Queue
+    # ---------------------------------------------------
+
+    def add(self, kind, endpoint, data, files, timeout=None, compress=False):
+        """
+        Spools an upload for the drainer to send.
+
+        Args:
+            kind (str): The kind of upload, e.g. "image", "gcode" or "finished".
+            endpoint (str): The API endpoint, relative to the API URL.
+            data (dict): The form fields.
+            files (dict): Form field names and (filename, source, content type)
+                tuples, where source is a file path, bytes-like data, or a
+                callable returning an iterable of chunks.
+            timeout (float): The request timeout, or None.
+            compress (bool): Whether to compress the body when it is sent.
+        """
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            entry = {
+                "seq": seq,
+                "kind": kind,
+                "endpoint": endpoint,
+                "data": data,
+                "files": [],
+                "timeout": timeout,
+                "compress": compress,
+                "size": 0,
+            }
+            try:
+                for index, (field, (filename, source, content_type)) in enumerate(
+                    files.items()
+                ):
+                    payload = f"{seq:012d}_{index}"
+                    size, linked = self.write_payload(payload, source)
+                    entry["size"] += size
+                    entry["files"].append(
+                        {
+                            "field": field,
+                            "filename": filename,
+                            "content_type": content_type,
+                            "payload": payload,
+                            "linked": linked,
+                        }
+                    )
+                fsync_dir(self.spool_dir)
+                self.make_room(entry)
+                self.append_journal("ADD " + json.dumps(entry))
+            except OSError as e:
+                self._logger.error(f"Failed to spool {kind} upload: {e}")
+                for spooled_file in entry["files"]:
+                    self.remove_payload(spooled_file["payload"])
+                return False
+            self.pending.append(entry)
+            self.total_bytes += entry["size"]
+        self._logger.debug(f"Spooled {kind} upload {seq} ({len(self)} pending)")
+        self.wake.set()
+        return True
+
+    def disk_bytes(self):
+        """
+        Returns the disk space the spooled payloads take. A payload hard
+        linked to a file which still exists elsewhere, e.g. the G-code file
+        being printed, shares its inode and takes no space of its own.
+        """
+        with self.lock:
+            total = self.total_bytes
+            linked = [
+                spooled_file
+                for entry in self.pending
+                for spooled_file in entry["files"]
+                if spooled_file.get("linked")
+            ]
+        for spooled_file in linked:
+            try:
+                stat = os.stat(self.payload_path(spooled_file))
+            except OSError:
+                continue
+            if stat.st_nlink > 1:
+                total -= stat.st_size
+        return total
+
+    def make_room(self, entry):
+        """Drops the oldest droppable entries until `entry` fits under the cap."""
+        if self.drop_until(self.max_bytes - entry["size"]) is None:
+            self._logger.warning("Upload spool is over its size limit")
+
+    def drop_until(self, max_bytes):
+        """
+        Drops the oldest droppable entries until the spool holds at most
+        `max_bytes`.
+
+        Returns:
+            int: The bytes freed, or None if the spool could not be shrunk
+                that far.
+        """
+        freed = 0
+        while self.total_bytes > max_bytes:
+            victim = next(
+                (e for e in self.pending if e["kind"] in DROPPABLE_KINDS), None
+            )
+            if victim is None:
+                return None
+            self._logger.warning(
+                f"Upload spool full, dropping {victim['kind']} upload {victim['seq']}"
+            )
+            self.pending.remove(victim)
+            self.finish(victim)
+            freed += victim["size"]
+        return freed
+
+    def shrink(self, max_bytes):
+        """
+        Drops the oldest droppable entries, e.g. to meet the storage quota.
+
+        Returns:
+            int: The bytes freed.
+        """
+        with self.lock:
+            start_bytes = self.total_bytes
+            self.drop_until(max_bytes)
+            return start_bytes - self.total_bytes
+
+    def finish(self, entry):
+        """
+        Journals an entry as done and deletes its payloads. The payloads are
+        deleted even if the journal cannot be written, e.g. on a full disk,
+        as recovery skips entries whose payloads are gone.
+        """
+        try:
+            self.append_journal(f"ACK {entry['seq']}")
+        except OSError as e:
+            self._logger.error(f"Failed to journal spooled upload {entry['seq']}: {e}")
+        for spooled_file in entry["files"]:
+            self.remove_payload(spooled_file["payload"])
+        self.total_bytes -= entry["size"]
+        if not self.pending:
+            try:
+                self.compact()
+            except OSError as e:
+                self._logger.error(f"Failed to compact the spool journal: {e}")
+
+    def split_batch(self, entry):
+        """
+        Replaces a spooled image batch, which the server has no endpoint for,
+        with an image upload per frame at the head of the queue. The frames
+        keep their payloads, and the journal is rewritten in the new order.
+
+        Returns:
+            bool: True if the batch was split, False if its payloads are gone.
+        """
+        with self.lock:
+            if not self.pending or self.pending[0] is not entry:
+                return False
+            images = []
+            try:
+                metadata = json.loads(entry["data"]["data"])
+                for spooled_file, image_metadata in zip(entry["files"], metadata):
+                    images.append(
+                        {
+                            "seq": self.next_seq + len(images),
+                            "kind": "image",
+                            "endpoint": IMAGE_ENDPOINT,
+                            "data": {"data": json.dumps(image_metadata)},
+                            "files": [dict(spooled_file, field="image_obj")],
+                            "timeout": entry["timeout"],
+                            "compress": False,
+                            "size": os.path.getsize(self.payload_path(spooled_file)),
+                        }
+                    )
+            except (OSError, ValueError, KeyError) as e:
+                self._logger.error(f"Failed to split spooled batch {entry['seq']}: {e}")
+                return False
+            self.next_seq += len(images)
+            self.pending.popleft()
+            self.pending.extendleft(reversed(images))
+            self.total_bytes += sum(image["size"] for image in images) - entry["size"]
+            try:
+                self.compact()
+            except OSError as e:
+                self._logger.error(f"Failed to compact the spool journal: {e}")
+        self._logger.info(
+            f"Image batches not supported, split spooled batch {entry['seq']} "
+            f"into {len(images)} images"
+        )
+        return True
+
+    # ---------------------------------------------------
+    # Drainer
+    # ---------------------------------------------------
+
+    def start_drain_thread(self):
+        """Starts the background thread which uploads spooled entries."""
+        self.drain_thread = threading.Thread(target=self.drain_thread_loop)
+        self.drain_thread.daemon = True
+        self.drain_thread.start()
+
+    def backoff(self):
+        """Returns the next retry delay, with full jitter around the exponent."""
+        exponent = min(self.attempts, BACKOFF_MAX_EXPONENT)
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**exponent)
+        return delay * random.uniform(0.5, 1.5)
+
+    def link_up(self):
+        """
+        Retries at once if the drainer is backing off, as the server is known
+        to be reachable again, e.g. after the cloud websocket reconnected or
+        a live request succeeded. New uploads do not shorten the backoff.
+        """
+        if self.next_attempt > time.monotonic():
+            self.next_attempt = 0.0
+            self.wake.set()
+
+    def send(self, entry):
+        """Posts a spooled entry. Raises on failure."""
+        url = get_api_url() + entry["endpoint"]
+        headers = generate_auth_headers(self._settings["auth_token"])
+        with ExitStack() as stack:
+            body = MultipartBody(
+                entry["data"],
+                {
+                    spooled_file["field"]: (
+                        spooled_file["filename"],
+                        stack.enter_context(
+                            open(self.payload_path(spooled_file), "rb")
+                        ),
+                        spooled_file["content_type"],
+                    )
+                    for spooled_file in entry["files"]
+                },
+            )
+            if entry.get("compress") and self.compressor is not None:
+                resp = self.compressor.post(
+                    self.session, url, body, headers, entry["timeout"]
+                )
+            else:
+                headers["Content-Type"] = body.content_type
+                resp = self.session.post(
+                    url=url,
+                    data=body.request_data(),
+                    headers=headers,
+                    timeout=entry["timeout"],
+                )
+        resp.raise_for_status()
+
+    def drain_thread_loop(self):
+        """Uploads spooled entries oldest first, backing off on failure."""
+        while True:
+            if not self.pending:
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            remaining = self.next_attempt - time.monotonic()
+            if remaining > 0:
+                # woken by new uploads too, which leave the deadline as it is
+                self.wake.wait(remaining)
+                self.wake.clear()
+                continue
+            entry = self.pending[0]
+            try:
+                self.send(entry)
+                self._logger.debug(
+                    f"Spooled {entry['kind']} upload {entry['seq']} sent"
+                )
+            except Exception as e:
+                if is_retryable(e):
+                    delay = self.backoff()
+                    self.attempts += 1
+                    self._logger.info(
+                        f"Spooled upload {entry['seq']} failed ({e}), "
+                        f"retrying in {delay:.1f}s"
+                    )
+                    self.next_attempt = time.monotonic() + delay
+                    continue
+                if (
+                    entry["kind"] == "image_batch"
+                    and is_unsupported(e)
+                    and self.split_batch(entry)
+                ):
+                    continue
+                self._logger.error(
+                    f"Dropping spooled {entry['kind']} upload {entry['seq']}: {e}"
+                )
+            self.attempts = 0
+            with self.lock:
+                if self.pending and self.pending[0] is entry:
+                    self.pending.popleft()
+                    self.finish(entry)
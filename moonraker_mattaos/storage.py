@@ -0,0 +1,212 @@
+import os
+import time
+import shutil
+from .utils import MATTA_TMP_DATA_DIR
+
+DEFAULT_STORAGE_QUOTA_MB = 1024  # 0 disables the quota
+CHECK_INTERVAL = 30.0  # seconds between quota checks
+SPOOL_DIR_NAME = "spool"
+JOB_MARKER_NAME = ".matta-job"
+# files marking a job directory, the print logs for directories made before
+# the marker was written
+JOB_FILE_NAMES = (JOB_MARKER_NAME, "print_log.bin", "print_log.csv")
+
+
+def get_tree_size(path):
+    """Returns the total size in bytes of the files under a directory."""
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += get_tree_size(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return total
+
+
+def mark_job_dir(path):
+    """Marks a directory as a job's, so it can be evicted once the job ends."""
+    with open(os.path.join(path, JOB_MARKER_NAME), "a"):
+        pass
+
+
+def is_job_dir(path):
+    """Checks whether a directory holds a job's data."""
+    return any(os.path.exists(os.path.join(path, name)) for name in JOB_FILE_NAMES)
+
+
+class StorageManager:
+    """
+    Keeps the plugin's data directory under a byte quota.
+
+    The directory is scanned once at start-up. Job directories, which hold
+    a marker file, left there are from jobs that have already ended, as a
+    finished job's directory is deleted once the job has been reset, and
+    they do not change afterwards, so their sizes are indexed then and not
+    scanned again. The active job's size comes from listing its one
+    directory and the spool's size from its own count, so checking the
+    quota never walks the data directory. Other directories are counted,
+    but never evicted.
+
+    When the quota is exceeded, ended job directories are evicted oldest
+    first, then the oldest spooled images and heartbeats. The active job's
+    directory and the spooled G-code and end-of-job uploads are never
+    removed. Spooled G-code hard linked to the file being printed takes no
+    space of its own, and is not counted while the file exists.
+    """
+
+    def __init__(self, logger, settings, data_dir=MATTA_TMP_DATA_DIR):
+        self._logger = logger
+        self.data_dir = data_dir
+        try:
+            quota_mb = float(
+                settings.get("storage_quota_mb", DEFAULT_STORAGE_QUOTA_MB)
+            )
+        except (TypeError, ValueError):
+            quota_mb = DEFAULT_STORAGE_QUOTA_MB
+        self.quota = int(quota_mb * 1024**2)
+        self.ended_jobs = {}  # path: (mtime, size)
+        self.other_bytes = 0
+        self.evicted_bytes = 0
+        self.last_check = 0.0
+        self.last_usage = None
+        self.index()
+
+    def index(self):
+        """Indexes the data directory."""
+        self.ended_jobs = {}
+        self.other_bytes = 0
+        try:
+            with os.scandir(self.data_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.name == SPOOL_DIR_NAME:
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            if is_job_dir(entry.path):
+                                self.ended_jobs[entry.path] = (
+                                    entry.stat(follow_symlinks=False).st_mtime,
+                                    get_tree_size(entry.path),
+                                )
+                            else:
+                                self.other_bytes += get_tree_size(entry.path)
+                        else:
+                            self.other_bytes += entry.stat(
+                                follow_symlinks=False
+                            ).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        if self.ended_jobs:
+            self._logger.info(
+                f"Found {len(self.ended_jobs)} ended job directories "
+                f"({sum(size for _, size in self.ended_jobs.values())} bytes)"
+            )
+
+    def claim(self, path):
+        """Stops counting a directory as an ended job's, as its job resumed."""
+        self.ended_jobs.pop(path, None)
+
+    def active_job_bytes(self, job_dir):
+        """Returns the size of the active job's files."""
+        if job_dir is None:
+            return 0
+        total = 0
+        try:
+            with os.scandir(job_dir) as entries:
+                for entry in entries:
+                    try:
+                        total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return total
+
+    def usage(self, job_dir=None, spool=None):
+        """
+        Returns the disk usage of the data directory by category.
+
+        Args:
+            job_dir (str): The active job's directory, or None.
+            spool (UploadSpool): The upload spool, or None.
+
+        Returns:
+            dict: The bytes used by the active job, ended jobs, the upload
+                spool and other files, their total and the quota.
+        """
+        usage = {
+            "active_job": self.active_job_bytes(job_dir),
+            "ended_jobs": sum(
+                size
+                for path, (_, size) in self.ended_jobs.items()
+                if path != job_dir
+            ),
+            "spool": spool.disk_bytes() if spool is not None else 0,
+            "other": self.other_bytes,
+        }
+        usage["total"] = sum(usage.values())
+        usage["quota"] = self.quota
+        usage["evicted"] = self.evicted_bytes
+        return usage
+
+    def evict_job(self, path):
+        """Deletes an ended job's directory."""
+        _, size = self.ended_jobs.pop(path)
+        try:
+            shutil.rmtree(path)
+        except OSError as e:
+            self._logger.error(f"Failed to evict {path}: {e}")
+            return 0
+        self._logger.info(f"Evicted ended job directory {path} ({size} bytes)")
+        self.evicted_bytes += size
+        return size
+
+    def enforce(self, job_dir=None, spool=None, force=False):
+        """
+        Evicts data until the data directory fits in the quota, checking
+        at most every CHECK_INTERVAL unless forced. The usage found is kept
+        for `get_stats`.
+
+        Args:
+            job_dir (str): The active job's directory, never evicted.
+            spool (UploadSpool): The upload spool, or None.
+            force (bool): Whether to check even if checked recently.
+        """
+        now = time.monotonic()
+        if not force and now - self.last_check < CHECK_INTERVAL:
+            return
+        self.last_check = now
+        usage = self.usage(job_dir, spool)
+        self.last_usage = usage
+        excess = usage["total"] - self.quota
+        if self.quota <= 0 or excess <= 0:
+            return
+        for path in sorted(self.ended_jobs, key=lambda path: self.ended_jobs[path][0]):
+            if excess <= 0:
+                break
+            if path != job_dir:
+                excess -= self.evict_job(path)
+        if excess > 0 and spool is not None:
+            freed = spool.shrink(spool.total_bytes - excess)
+            self.evicted_bytes += freed
+            excess -= freed
+        self.last_usage = self.usage(job_dir, spool)
+        if excess > 0:
+            self._logger.warning(
+                f"Data directory is {excess} bytes over its quota of {self.quota}"
+            )
+
+    def get_stats(self):
+        """
+        Returns the disk usage found by the last check, for the websocket
+        `system` block, or None before the first check.
+        """
+        return self.last_usage
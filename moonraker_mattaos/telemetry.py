@@ -0,0 +1,253 @@
+import math
+import time
+import threading
+import numpy as np
+import requests
+from .governor import INTERVAL_FACTORS
+from .scheduler import DEFAULT_MAX_INTERVAL
+
+DEFAULT_TELEMETRY_RATE = 0.0  # Hz, 0 disables the collector
+DEFAULT_TELEMETRY_WINDOW = 10.0  # seconds of readings kept
+MAX_TELEMETRY_RATE = 20.0  # Hz
+
+# Channel name, Klipper object and field of each reading
+TELEMETRY_CHANNELS = (
+    ("hotend", "extruder", "temperature"),
+    ("hotend_power", "extruder", "power"),
+    ("bed", "heater_bed", "temperature"),
+    ("bed_power", "heater_bed", "power"),
+    ("extruder_velocity", "motion_report", "live_extruder_velocity"),
+)
+TELEMETRY_STATS = ("min", "max", "mean", "slope")
+
+
+def telemetry_columns():
+    """Returns the print log columns of the per-sample aggregates."""
+    return [
+        (f"{channel}_{stat}", "f")
+        for channel, _, _ in TELEMETRY_CHANNELS
+        for stat in TELEMETRY_STATS
+    ]
+
+
+class RingBuffer:
+    """
+    A fixed-size buffer of timestamped readings, overwriting the oldest.
+
+    Args:
+        capacity (int): The number of readings kept.
+        channels (int): The number of values in each reading.
+    """
+
+    def __init__(self, capacity, channels):
+        self.times = np.zeros(capacity)
+        self.values = np.zeros((capacity, channels))
+        self.capacity = capacity
+        self.head = 0  # the next slot to write
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def append(self, timestamp, values):
+        self.times[self.head] = timestamp
+        self.values[self.head] = values
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def window(self, start, end):
+        """
+        Returns copies of the readings taken after `start` and up to `end`.
+
+        Returns:
+            tuple: The times and an array of the values, a row per reading,
+                oldest first.
+        """
+        if self.count < self.capacity:
+            times = self.times[: self.count]
+            values = self.values[: self.count]
+        else:
+            times = np.roll(self.times, -self.head)
+            values = np.roll(self.values, -self.head, axis=0)
+        mask = (times > start) & (times <= end)
+        return times[mask], values[mask]
+
+
+def aggregate(times, values):
+    """
+    Computes the minimum, maximum, mean and least squares slope per second
+    of each channel, vectorized over the channels.
+
+    Args:
+        times (ndarray): The reading times in seconds.
+        values (ndarray): The readings, a row per time and a column per
+            channel. Missing readings are NaN.
+
+    Returns:
+        dict: Each stat's array, with a value per channel (NaN if there
+            were too few readings).
+    """
+    channels = values.shape[1]
+    if len(times) == 0:
+        empty = np.full(channels, np.nan)
+        return {stat: empty for stat in TELEMETRY_STATS}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        valid = ~np.isnan(values)
+        counts = valid.sum(axis=0)
+        mean = np.where(valid, values, 0.0).sum(axis=0) / counts
+        t_mean = (valid * times[:, None]).sum(axis=0) / counts
+        dt = np.where(valid, times[:, None] - t_mean, 0.0)
+        dv = np.where(valid, values - mean, 0.0)
+        slope = (dt * dv).sum(axis=0) / (dt * dt).sum(axis=0)
+        minimum = np.where(valid, values, np.inf).min(axis=0)
+        maximum = np.where(valid, values, -np.inf).max(axis=0)
+    minimum[counts == 0] = np.nan
+    maximum[counts == 0] = np.nan
+    slope[counts < 2] = np.nan
+    return {"min": minimum, "max": maximum, "mean": mean, "slope": slope}
+
+
+class TelemetryCollector:
+    """
+    Samples the heaters and the extruder at `telemetry_rate` Hz between the
+    print data samples, so each sample can carry the minimum, maximum, mean
+    and slope of every reading since the previous one rather than a single
+    instantaneous value.
+
+    Readings are kept in a ring buffer holding `telemetry_window` seconds,
+    so the memory used does not grow with the job. The window is raised to
+    the longest the sampling interval can be stretched to by the resource
+    governor, so no readings are overwritten before they are summarized.
+    A background thread polls Moonraker over a kept-alive connection only
+    while a job is sampled.
+    """
+
+    def __init__(self, logger, settings, printer):
+        self._logger = logger
+        self._printer = printer
+        try:
+            self.rate = float(settings.get("telemetry_rate", DEFAULT_TELEMETRY_RATE))
+            self.window = float(
+                settings.get("telemetry_window", DEFAULT_TELEMETRY_WINDOW)
+            )
+            max_interval = float(
+                settings.get("sampling_max_interval", DEFAULT_MAX_INTERVAL)
+            )
+        except (TypeError, ValueError):
+            self.rate = DEFAULT_TELEMETRY_RATE
+            self.window = DEFAULT_TELEMETRY_WINDOW
+            max_interval = DEFAULT_MAX_INTERVAL
+        self.rate = min(max(self.rate, 0.0), MAX_TELEMETRY_RATE)
+        longest_interval = max_interval * max(INTERVAL_FACTORS)
+        if self.rate > 0 and self.window < longest_interval:
+            self._logger.info(
+                f"Telemetry window raised from {self.window:g}s to "
+                f"{longest_interval:g}s, the longest sampling interval"
+            )
+            self.window = longest_interval
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.buffer = None
+        self.last_end = None
+        self.readings = 0
+        self.errors = 0
+        self.thread = None
+        if self.enabled:
+            capacity = max(int(math.ceil(self.rate * max(self.window, 1.0))), 2)
+            self.buffer = RingBuffer(capacity, len(TELEMETRY_CHANNELS))
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def start(self):
+        """Starts the collector thread if the collector is enabled."""
+        if not self.enabled or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.telemetry_thread_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def activate(self):
+        """Starts sampling, e.g. as a job starts being sampled."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.buffer.clear()
+            self.last_end = None
+        self.active.set()
+
+    def deactivate(self):
+        """Stops sampling, e.g. once a job has ended."""
+        self.active.clear()
+
+    def telemetry_thread_loop(self):
+        session = requests.Session()
+        period = 1 / self.rate
+        while True:
+            self.active.wait()
+            start_time = time.monotonic()
+            try:
+                self.poll(session)
+            except Exception as e:
+                self.errors += 1
+                if self.errors == 1 or self.errors % 100 == 0:
+                    self._logger.error(f"Failed to sample telemetry: {e}")
+            time.sleep(max(period - (time.monotonic() - start_time), 0.0))
+
+    def poll(self, session):
+        """Takes one reading of every channel."""
+        request_time = time.monotonic()
+        status = self._printer.get_telemetry_objects(session)["status"]
+        timestamp = (request_time + time.monotonic()) / 2
+        values = []
+        for _, obj, field in TELEMETRY_CHANNELS:
+            value = status.get(obj, {}).get(field)
+            values.append(math.nan if value is None else float(value))
+        with self.lock:
+            self.buffer.append(timestamp, values)
+        self.readings += 1
+
+    def summarize(self, end):
+        """
+        Aggregates the readings since the last summary.
+
+        Args:
+            end (float): The monotonic time of the sample being summarized.
+
+        Returns:
+            dict: The stats of each channel, as {channel: {stat: value}}
+                with None for a missing value, or None if the collector is
+                disabled.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            start = -math.inf if self.last_end is None else self.last_end
+            self.last_end = end
+            times, values = self.buffer.window(start, end)
+        stats = aggregate(times, values)
+        return {
+            channel: {
+                stat: (
+                    None
+                    if math.isnan(stats[stat][index])
+                    else round(float(stats[stat][index]), 4)
+                )
+                for stat in TELEMETRY_STATS
+            }
+            for index, (channel, _, _) in enumerate(TELEMETRY_CHANNELS)
+        }
+
+    def get_stats(self):
+        """Returns the collector state for logging and reporting."""
+        return {
+            "enabled": self.enabled,
+            "rate": self.rate,
+            "readings": self.readings,
+            "errors": self.errors,
+        }
@@ -0,0 +1,397 @@
+import math
+import time
+import zlib
+import struct
+from .printlog import timestamp_to_ms, ms_to_timestamp
+
+DEFAULT_BATCH_INTERVAL = 0.0  # seconds between batches, 0 disables them
+BATCH_VERSION = 1
+BATCH_MIME_TYPE = "application/x-matta-telemetry"
+
+FLOAT_WIDTHS = {"f": 32, "d": 64}
+FLOAT_FORMATS = {32: ("<f", "<I"), 64: ("<d", "<Q")}
+MAX_DECIMAL_SCALE = 4  # decimal places of floats stored as scaled integers
+GORILLA, DECIMAL = range(2)
+
+
+def write_varint(out, value):
+    """Appends an unsigned LEB128 varint to a bytearray."""
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, position):
+    """
+    Reads an unsigned LEB128 varint.
+
+    Returns:
+        tuple: The value and the position after it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+
+class BitWriter:
+    def __init__(self):
+        self.bits = 0
+        self.length = 0
+
+    def write(self, value, width):
+        self.bits = (self.bits << width) | value
+        self.length += width
+
+    def getvalue(self):
+        padding = -self.length % 8
+        return (self.bits << padding).to_bytes((self.length + padding) // 8, "big")
+
+
+class BitReader:
+    def __init__(self, data):
+        self.bits = int.from_bytes(data, "big")
+        self.remaining = len(data) * 8
+
+    def read(self, width):
+        self.remaining -= width
+        return (self.bits >> self.remaining) & ((1 << width) - 1)
+
+
+def encode_ints(values):
+    """Encodes integers as zigzag varint deltas from the previous value."""
+    out = bytearray()
+    previous = 0
+    for value in values:
+        write_varint(out, zigzag(value - previous))
+        previous = value
+    return bytes(out)
+
+
+def decode_ints(data, count):
+    values = []
+    previous = 0
+    position = 0
+    for _ in range(count):
+        delta, position = read_varint(data, position)
+        previous += unzigzag(delta)
+        values.append(previous)
+    return values
+
+
+def encode_timestamps(values):
+    """Encodes integers as zigzag varint deltas of deltas, for steady clocks."""
+    out = bytearray()
+    previous = 0
+    previous_delta = 0
+    for value in values:
+        delta = value - previous
+        write_varint(out, zigzag(delta - previous_delta))
+        previous = value
+        previous_delta = delta
+    return bytes(out)
+
+
+def decode_timestamps(data, count):
+    values = []
+    previous = 0
+    previous_delta = 0
+    position = 0
+    for _ in range(count):
+        delta_delta, position = read_varint(data, position)
+        previous_delta += unzigzag(delta_delta)
+        previous += previous_delta
+        values.append(previous)
+    return values
+
+
+def encode_floats(values, width=64):
+    """
+    Encodes floats Gorilla-style: each value's bits are XORed with the
+    previous value's, and only the bits that changed are written, reusing
+    the previous leading and trailing zero counts when they still fit.
+    """
+    float_format, int_format = FLOAT_FORMATS[width]
+    writer = BitWriter()
+    previous = 0
+    leading = trailing = None
+    for value in values:
+        bits = struct.unpack(int_format, struct.pack(float_format, value))[0]
+        xor = bits ^ previous
+        previous = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        writer.write(1, 1)
+        new_leading = min(width - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+        if leading is not None and new_leading >= leading and new_trailing >= trailing:
+            writer.write(0, 1)
+            writer.write(xor >> trailing, width - leading - trailing)
+        else:
+            leading, trailing = new_leading, new_trailing
+            significant = width - leading - trailing
+            writer.write(1, 1)
+            writer.write(leading, 5)
+            writer.write(significant & 0x3F, 6)  # 64 is written as 0
+            writer.write(xor >> trailing, significant)
+    return writer.getvalue()
+
+
+def decode_floats(data, count, width=64):
+    float_format, int_format = FLOAT_FORMATS[width]
+    reader = BitReader(data)
+    values = []
+    previous = 0
+    leading = trailing = 0
+    for _ in range(count):
+        if reader.read(1):
+            if reader.read(1):
+                leading = reader.read(5)
+                significant = reader.read(6) or 64
+                trailing = width - leading - significant
+            previous ^= reader.read(width - leading - trailing) << trailing
+        values.append(struct.unpack(float_format, struct.pack(int_format, previous))[0])
+    return values
+
+
+def encode_decimals(values):
+    """
+    Encodes floats with at most MAX_DECIMAL_SCALE decimal places, e.g.
+    temperatures, as integer deltas in units of their last decimal place,
+    which is far smaller than their XORed bits.
+
+    Returns:
+        bytes: The scale and the deltas, or None if the values do not round
+            trip at any scale.
+    """
+    for scale in range(MAX_DECIMAL_SCALE + 1):
+        factor = 10**scale
+        try:
+            scaled = [round(value * factor) for value in values]
+        except (ValueError, OverflowError):  # NaN or infinity
+            return None
+        if all(
+            units / factor == value and (value or math.copysign(1.0, value) > 0)
+            for units, value in zip(scaled, values)
+        ):
+            return bytes([scale]) + encode_ints(scaled)
+    return None
+
+
+def decode_decimals(data, count):
+    factor = 10 ** data[0]
+    return [units / factor for units in decode_ints(data[1:], count)]
+
+
+def encode_strings(values):
+    """Encodes strings as varint indices into a table of the batch's strings."""
+    table = {}
+    indices = bytearray()
+    for value in values:
+        write_varint(indices, table.setdefault(value, len(table)))
+    out = bytearray()
+    write_varint(out, len(table))
+    for value in table:
+        encoded = value.encode("utf-8")
+        write_varint(out, len(encoded))
+        out += encoded
+    return bytes(out + indices)
+
+
+def decode_strings(data, count):
+    size, position = read_varint(data, 0)
+    table = []
+    for _ in range(size):
+        length, position = read_varint(data, position)
+        table.append(data[position : position + length].decode("utf-8"))
+        position += length
+    values = []
+    for _ in range(count):
+        index, position = read_varint(data, position)
+        values.append(table[index])
+    return values
+
+
+def column_values(kind, values):
+    """Normalizes a column's values as the print log stores them."""
+    if kind == "str":
+        return ["" if value is None else str(value) for value in values]
+    if kind == "timestamp":
+        return [timestamp_to_ms(value) for value in values]
+    if kind in FLOAT_WIDTHS:
+        return [math.nan if value is None else float(value) for value in values]
+    return [int(value or 0) for value in values]
+
+
+def encode_column(kind, values):
+    if kind == "str":
+        return encode_strings(values)
+    if kind == "timestamp":
+        return encode_timestamps(values)
+    if kind == "d":
+        decimals = encode_decimals(values)
+        if decimals is not None:
+            return bytes([DECIMAL]) + decimals
+    if kind in FLOAT_WIDTHS:
+        return bytes([GORILLA]) + encode_floats(values, FLOAT_WIDTHS[kind])
+    return encode_ints(values)
+
+
+def decode_column(kind, data, count):
+    if kind == "str":
+        return decode_strings(data, count)
+    if kind == "timestamp":
+        return [ms_to_timestamp(value) for value in decode_timestamps(data, count)]
+    if kind in FLOAT_WIDTHS:
+        if data[0] == DECIMAL:
+            return decode_decimals(data[1:], count)
+        return decode_floats(data[1:], count, FLOAT_WIDTHS[kind])
+    if kind == "bool":
+        return [bool(value) for value in decode_ints(data, count)]
+    return decode_ints(data, count)
+
+
+def encode_batch(columns, rows):
+    """
+    Encodes print log rows column by column and compresses them.
+
+    Integers are stored as varint deltas, timestamps as varint deltas of
+    deltas, floats with few decimal places as scaled integer deltas and
+    other floats Gorilla-style (float32 for "f" columns, as in the print
+    log), and strings as indices into the batch's string table.
+
+    Args:
+        columns (list): The (name, kind) of each column, as in the print log.
+        rows (list): The rows, each a list of values in column order.
+
+    Returns:
+        bytes: The encoded batch.
+    """
+    payload = bytearray()
+    write_varint(payload, len(rows))
+    write_varint(payload, len(columns))
+    for index, (name, kind) in enumerate(columns):
+        for text in (name, kind):
+            encoded = text.encode("utf-8")
+            write_varint(payload, len(encoded))
+            payload += encoded
+        data = encode_column(
+            kind, column_values(kind, [row[index] for row in rows])
+        )
+        write_varint(payload, len(data))
+        payload += data
+    return bytes([BATCH_VERSION]) + zlib.compress(bytes(payload), 9)
+
+
+def decode_batch(batch):
+    """
+    Decodes a batch made by `encode_batch`.
+
+    Returns:
+        tuple: The (name, kind) of each column and the decoded rows.
+
+    Raises:
+        ValueError: If the batch is of an unknown version.
+    """
+    if not batch or batch[0] != BATCH_VERSION:
+        raise ValueError("Unknown telemetry batch version")
+    payload = zlib.decompress(batch[1:])
+    row_count, position = read_varint(payload, 0)
+    column_count, position = read_varint(payload, position)
+    columns = []
+    values = []
+    for _ in range(column_count):
+        texts = []
+        for _ in range(2):
+            length, position = read_varint(payload, position)
+            texts.append(payload[position : position + length].decode("utf-8"))
+            position += length
+        name, kind = texts
+        length, position = read_varint(payload, position)
+        columns.append((name, kind))
+        values.append(
+            decode_column(kind, payload[position : position + length], row_count)
+        )
+        position += length
+    return columns, [list(row) for row in zip(*values)]
+
+
+class TelemetryBatcher:
+    """
+    Collects print log rows into batches sent every
+    `telemetry_batch_interval` seconds, so the cloud sees the telemetry
+    while the job runs and not only in the CSV uploaded at its end.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        try:
+            self.interval = float(
+                settings.get("telemetry_batch_interval", DEFAULT_BATCH_INTERVAL)
+            )
+        except (TypeError, ValueError):
+            self.interval = DEFAULT_BATCH_INTERVAL
+        self.supported = True
+        self.rows = []
+        self.started = None
+        self.batches = 0
+        self.bytes_sent = 0
+
+    @property
+    def enabled(self):
+        return self.interval > 0 and self.supported
+
+    def __len__(self):
+        return len(self.rows)
+
+    def reset(self):
+        self.rows = []
+        self.started = None
+
+    def add(self, row):
+        """Queues a print log row."""
+        if not self.enabled:
+            return
+        if not self.rows:
+            self.started = time.monotonic()
+        self.rows.append(row)
+
+    def is_due(self):
+        """Checks whether the queued rows should be sent now."""
+        return (
+            self.enabled
+            and bool(self.rows)
+            and time.monotonic() - self.started >= self.interval
+        )
+
+    def take(self, columns):
+        """
+        Encodes and clears the queued rows.
+
+        Args:
+            columns (list): The print log columns the rows follow.
+
+        Returns:
+            tuple: The number of rows and the encoded batch.
+        """
+        rows = self.rows
+        self.reset()
+        batch = encode_batch(columns, rows)
+        self.batches += 1
+        self.bytes_sent += len(batch)
+        return len(rows), batch
@@ -1,14 +1,15 @@
 import json
 import logging
 import websocket
+from websocket import ABNF
 
 import os
 
 
 class Socket:
-    def __init__(self, logger_ws, on_message, url, token):
+    def __init__(self, logger_ws, on_message, url, token, on_open=None, on_close=None):
         self._logger_ws = logger_ws
-        self.connect(on_message, url, token)
+        self.connect(on_message, url, token, on_open, on_close)
 
     def run(self):
         try:
@@ -27,14 +28,32 @@ class Socket:
             self._logger_ws.error("Socket send_msg: %s", e)
             self.disconnect()
 
+    def send_binary(self, data):
+        """
+        Sends a binary message.
+
+        Returns:
+            bool: True if the message was sent.
+        """
+        try:
+            if self.connected() and self.socket is not None:
+                self.socket.send(data, opcode=ABNF.OPCODE_BINARY)
+                return True
+        except Exception as e:
+            self._logger_ws.error("Socket send_binary: %s", e)
+            self.disconnect()
+        return False
+
     def connected(self):
         return self.socket and self.socket.sock and self.socket.sock.connected
 
-    def connect(self, on_message, url, token):
+    def connect(self, on_message, url, token, on_open=None, on_close=None):
         url = url + "?token=" + token
         self.socket = websocket.WebSocketApp(
             url,
             on_message=on_message,
+            on_open=on_open,
+            on_close=on_close,
         )
 
     def disconnect(self):
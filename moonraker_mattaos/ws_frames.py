@@ -0,0 +1,322 @@
+import json
+import time
+import struct
+import threading
+
+IMAGE_TRANSPORTS = ("http", "websocket")
+DEFAULT_IMAGE_TRANSPORT = "http"
+DEFAULT_FRAME_WINDOW = 4  # frames sent but not yet acknowledged
+FRAME_VERSION = 1
+
+# Binary frame header: magic, version, kind, reserved, sequence number and
+# metadata length, followed by the JSON metadata and the image bytes
+FRAME_MAGIC = b"MTFR"
+FRAME_HEADER = struct.Struct(">4sBBHII")
+KIND_IMAGE = 1
+KIND_TELEMETRY = 2
+FRAME_KINDS = (KIND_IMAGE, KIND_TELEMETRY)
+
+
+def pack_frame(sequence, metadata, data, kind=KIND_IMAGE):
+    """
+    Packs an image, or another binary payload, into a binary websocket
+    message.
+
+    Args:
+        sequence (int): The frame's sequence number, 0 for payloads which
+            are not acknowledged.
+        metadata (dict): The frame's metadata, including its name and MIME
+            type.
+        data (bytes-like): The image.
+        kind (int): The payload kind, e.g. KIND_IMAGE or KIND_TELEMETRY.
+
+    Returns:
+        bytes: The message.
+    """
+    meta = json.dumps(metadata, separators=(",", ":")).encode("utf-8")
+    header = FRAME_HEADER.pack(
+        FRAME_MAGIC, FRAME_VERSION, kind, 0, sequence, len(meta)
+    )
+    return b"".join((header, meta, data))
+
+
+def unpack_frame(message):
+    """
+    Unpacks a message made by `pack_frame`.
+
+    Returns:
+        tuple: The payload kind, the sequence number, the metadata dict and
+            a memoryview of the payload.
+
+    Raises:
+        ValueError: If the message is not a binary frame.
+    """
+    view = memoryview(message)
+    if len(view) < FRAME_HEADER.size:
+        raise ValueError("Binary frame too short")
+    magic, version, kind, _, sequence, meta_length = FRAME_HEADER.unpack_from(view)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION or kind not in FRAME_KINDS:
+        raise ValueError("Not a binary frame")
+    meta_end = FRAME_HEADER.size + meta_length
+    metadata = json.loads(bytes(view[FRAME_HEADER.size : meta_end]))
+    return kind, sequence, metadata, view[meta_end:]
+
+
+class WebsocketFrameSender:
+    """
+    Sends frames as binary messages over the printer's cloud websocket,
+    instead of one HTTPS multipart POST per frame.
+
+    Each message is a 16 byte header, the frame's JSON metadata and the
+    image bytes. When the socket opens a `frame_transport` hello is sent,
+    and frames only go over the socket once the server has answered it, so
+    a server without binary frame support keeps getting HTTP posts.
+
+    The server acknowledges frames cumulatively with `frame_ack` messages.
+    At most `ws_frame_window` frames are in flight: a frame waiting longer
+    than its upload timeout for the window to open makes the transport fall
+    back to HTTP until the socket reconnects. Frames not acknowledged when
+    the socket closes or falls back are handed back to be posted over HTTP.
+    """
+
+    def __init__(self, logger, settings):
+        self._logger = logger
+        self.mode = str(
+            settings.get("image_transport", DEFAULT_IMAGE_TRANSPORT)
+        ).lower()
+        if self.mode not in IMAGE_TRANSPORTS:
+            self._logger.error(f"Unknown image transport {self.mode}, using http")
+            self.mode = DEFAULT_IMAGE_TRANSPORT
+        try:
+            self.window = int(settings.get("ws_frame_window", DEFAULT_FRAME_WINDOW))
+        except (TypeError, ValueError):
+            self.window = DEFAULT_FRAME_WINDOW
+        self.window = max(self.window, 1)
+        self.condition = threading.Condition()
+        self.socket = None
+        self.supported = False
+        self.server_window = None
+        self.sequence = 0
+        self.in_flight = {}  # sequence: (name, data, mime type, metadata, sent time)
+        self.unacked = []
+        self.acked = []  # (sent time, ack time, size)
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.fallbacks = 0
+
+    @property
+    def enabled(self):
+        return self.mode == "websocket"
+
+    def available(self):
+        """Checks whether frames can go over the websocket now."""
+        return (
+            self.enabled
+            and self.supported
+            and self.socket is not None
+            and self.socket.connected()
+        )
+
+    def attach(self, socket):
+        """
+        Offers binary frames to the server on a newly opened socket.
+
+        Args:
+            socket (Socket): The cloud websocket.
+        """
+        if not self.enabled:
+            return
+        with self.condition:
+            self.drop_in_flight()
+            self.socket = socket
+            self.supported = False
+            self.server_window = None
+        socket.send_msg(
+            {
+                "type": "frame_transport",
+                "version": FRAME_VERSION,
+                "window": self.window,
+            }
+        )
+
+    def detach(self, socket=None):
+        """Stops sending on a closed socket, e.g. before reconnecting."""
+        with self.condition:
+            if socket is not None and socket is not self.socket:
+                return
+            self.socket = None
+            self.supported = False
+            self.drop_in_flight()
+            self.condition.notify_all()
+
+    def drop_in_flight(self):
+        """Moves the frames in flight to be posted over HTTP instead."""
+        for sequence in sorted(self.in_flight):
+            name, data, mime_type, metadata, _ = self.in_flight[sequence]
+            self.unacked.append((name, data, mime_type, metadata))
+        self.in_flight = {}
+
+    def handle_message(self, message):
+        """
+        Handles the server's answers to the frame transport.
+
+        Args:
+            message (dict): A JSON message received on the websocket.
+
+        Returns:
+            bool: True if the message was for the frame transport.
+        """
+        kind = message.get("type")
+        if kind == "frame_transport":
+            accepted = message.get("version") == FRAME_VERSION
+            with self.condition:
+                self.supported = accepted and self.socket is not None
+                if accepted:
+                    try:
+                        self.server_window = int(message.get("window") or 0) or None
+                    except (TypeError, ValueError):
+                        self.server_window = None
+            self._logger.info(
+                "Binary websocket frames "
+                + ("accepted" if accepted else "not supported, posting frames")
+            )
+            return True
+        if kind == "frame_ack":
+            try:
+                sequence = int(message["seq"])
+            except (KeyError, TypeError, ValueError):
+                return True
+            now = time.monotonic()
+            with self.condition:
+                for acked in [s for s in self.in_flight if s <= sequence]:
+                    _, data, _, _, sent_time = self.in_flight.pop(acked)
+                    self.acked.append((sent_time, now, len(data)))
+                self.condition.notify_all()
+            return True
+        return False
+
+    def window_size(self):
+        if self.server_window is None:
+            return self.window
+        return min(self.window, self.server_window)
+
+    def send(self, name, data, mime_type, metadata, timeout):
+        """
+        Sends a frame over the websocket, waiting for room in the window.
+
+        Args:
+            name (str): The image file name.
+            data (bytes-like): The encoded image.
+            mime_type (str): The image MIME type.
+            metadata (dict): The frame's metadata.
+            timeout (float): Seconds to wait for room in the window.
+
+        Returns:
+            bool: True if the frame was sent, False if it must be posted.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.available() and len(self.in_flight) >= self.window_size():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._logger.info(
+                        "Binary websocket frames not acknowledged, posting frames"
+                    )
+                    self.supported = False
+                    self.fallbacks += 1
+                    self.drop_in_flight()
+                    return False
+                self.condition.wait(remaining)
+            if not self.available():
+                return False
+            self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+            sequence = self.sequence
+            message = pack_frame(
+                sequence, dict(metadata, name=name, mime_type=mime_type), data
+            )
+            # the data may be a view of a buffer which is about to be reused
+            self.in_flight[sequence] = (
+                name,
+                bytes(data),
+                mime_type,
+                metadata,
+                time.monotonic(),
+            )
+            socket = self.socket
+        if not socket.send_binary(message):
+            self.detach(socket)
+            return False
+        self.frames_sent += 1
+        self.bytes_sent += len(message)
+        return True
+
+    def send_telemetry(self, metadata, data):
+        """
+        Sends a telemetry batch over the websocket. Batches are not
+        acknowledged or resent, as the print log uploaded at the end of the
+        job holds the same rows.
+
+        Returns:
+            bool: True if the batch was sent, False if it must be posted.
+        """
+        with self.condition:
+            if not self.available():
+                return False
+            socket = self.socket
+        message = pack_frame(0, metadata, data, kind=KIND_TELEMETRY)
+        if not socket.send_binary(message):
+            self.detach(socket)
+            return False
+        self.bytes_sent += len(message)
+        return True
+
+    def take_acked(self):
+        """
+        Returns and clears the acknowledged frames.
+
+        Returns:
+            list: The sent and acknowledged monotonic times and the size of
+                each frame.
+        """
+        with self.condition:
+            acked, self.acked = self.acked, []
+        return acked
+
+    def take_unacked(self):
+        """
+        Returns and clears the frames to post over HTTP instead.
+
+        Returns:
+            list: The name, data, MIME type and metadata of each frame.
+        """
+        with self.condition:
+            unacked, self.unacked = self.unacked, []
+        return unacked
+
+    def drop_pending(self):
+        """
+        Forgets the frames in flight and those to post over HTTP, e.g. as a
+        job ends, so a later detach can never post them under the next job.
+        Frames in flight may still reach the server, and acknowledgements
+        for them are ignored.
+
+        Returns:
+            int: The number of frames dropped.
+        """
+        with self.condition:
+            dropped = len(self.in_flight) + len(self.unacked)
+            self.in_flight = {}
+            self.unacked = []
+            self.condition.notify_all()
+        return dropped
+
+    def get_stats(self):
+        """Returns the transport state for the websocket `system` block."""
+        with self.condition:
+            return {
+                "transport": "websocket" if self.available() else "http",
+                "frames_sent": self.frames_sent,
+                "bytes_sent": self.bytes_sent,
+                "in_flight": len(self.in_flight),
+                "fallbacks": self.fallbacks,
+            }